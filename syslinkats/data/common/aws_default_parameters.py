@@ -35,5 +35,23 @@ DEFAULT_AWS_REGION = 'us-east-1'
 DEFAULT_SUBNET_ID = 'subnet-01e7368d67dc888c9'
 DEFAULT_BLOCK_DEV_MAPPINGS = [{'DeviceName': '/dev/sda1', 'Ebs': {'DeleteOnTermination': True}}]
 
+# The number of seconds that cached EC2 describe results (instances, images, tags) stay valid.
+DEFAULT_DESCRIBE_CACHE_TTL = 30
+# The HTTP connection-pool size of each shared boto3 client (botocore's default is 10).
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+# The number of seconds after which the (opt-in) local SQLite inventory is re-synced.
+DEFAULT_INVENTORY_MAX_AGE = 300
+# The eviction policy of the baked-AMI cache: the most baked images kept, and their maximum age.
+DEFAULT_BAKED_IMAGE_MAX_COUNT = 5
+DEFAULT_BAKED_IMAGE_MAX_AGE_DAYS = 14
+# Client-side rate limits of AWS API calls: '<service>.<Operation>' patterns (first match wins)
+# mapped to (tokens per second, burst).  They sit just under the EC2 / SSM account throttles.
+DEFAULT_API_RATE_LIMITS = {
+    'ec2.Describe*': (20, 100),
+    'ec2.*': (5, 50),
+    'ssm.SendCommand': (3, 10),
+    'ssm.*': (10, 20),
+}
+
 # Defaults to use for feed creation, removal, etc.
 DEFAULT_MAJ_MIN_BUILD = '19.6.0'
@@ -6,11 +6,30 @@ aws_base.py
 import abc
 import argparse
 import datetime
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import Union
 
-import boto3
+from botocore.exceptions import ClientError
+
+from syslinkats.framework.aws.aws_describe_cache import ALL_KINDS, AWSDescribeCache
+from syslinkats.framework.aws.aws_inventory import AWSInventory
+from syslinkats.framework.aws.aws_session_registry import AWSSessionRegistry
+from syslinkats.framework.common.adaptive_waiter import AdaptiveWaiter, get_default_clock
+from syslinkats.framework.errors.custom_errors import WaiterFailedError
+from syslinkats.framework.logging.auto_indent import AutoIndent
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+# Image states from which an image will never become available.
+FAILED_IMAGE_STATES = ('failed', 'error', 'invalid', 'deregistered')
 
 
 class AWSHTTPStatusError(Exception):
@@ -23,9 +42,246 @@ class AWSBase(metaclass=abc.ABCMeta):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, **kwargs):
-        self.ec2_client = boto3.client('ec2', **kwargs)
-        self.ec2_resource = boto3.resource('ec2', **kwargs)
-        self.ssm_client = boto3.client('ssm', **kwargs)
+        # The TTL (seconds) of the region's shared describe cache.  If omitted, the cache keeps
+        # its current TTL (DEFAULT_DESCRIBE_CACHE_TTL unless changed).
+        describe_cache_ttl = kwargs.pop('describe_cache_ttl', None)
+        # The clock used by all polling loops (see adaptive_waiter.ManualClock for tests).
+        self.clock = kwargs.pop('clock', None) or get_default_clock()
+        # An AWSInventory (or the path of its SQLite database) to answer describe queries from.
+        inventory = kwargs.pop('inventory', None)
+
+        # Clients come from the process-wide registry (shared by every object with the same
+        # region and profile) and are only created on first use.
+        self._client_kwargs = kwargs
+        self._ec2_client = None
+        self._ec2_resource = None
+        self._ssm_client = None
+        self._s3_client = None
+        self.region_name = kwargs.get('region_name') or \
+            AWSSessionRegistry.get_session(**self._session_kwargs).region_name
+        self.describe_cache = AWSDescribeCache.for_region(
+            self.region_name, ttl=describe_cache_ttl)
+        # The (opt-in) local inventory which describe queries are answered from.
+        self.inventory = inventory if not isinstance(inventory, str) \
+            else AWSInventory(inventory, region_name=self.region_name)
+
+    @property
+    def _session_kwargs(self) -> Dict[str, Any]:
+        """The kwargs which configure the boto3 session (see AWSSessionRegistry.SESSION_ARGS)."""
+        return AWSSessionRegistry.split_kwargs(self._client_kwargs)[0]
+
+    @property
+    def ec2_client(self) -> Any:
+        """The (shared) EC2 client."""
+        if self._ec2_client is None:
+            self._ec2_client = AWSSessionRegistry.get_client('ec2', **self._client_kwargs)
+        return self._ec2_client
+
+    @ec2_client.setter
+    def ec2_client(self, value: Any) -> None:
+        self._ec2_client = value
+
+    @property
+    def ec2_resource(self) -> Any:
+        """The EC2 resource of the calling thread, as resources are not thread-safe."""
+        if self._ec2_resource is not None:
+            return self._ec2_resource
+        return AWSSessionRegistry.get_resource('ec2', **self._client_kwargs)
+
+    @ec2_resource.setter
+    def ec2_resource(self, value: Any) -> None:
+        self._ec2_resource = value
+
+    @property
+    def ssm_client(self) -> Any:
+        """The (shared) SSM client."""
+        if self._ssm_client is None:
+            self._ssm_client = AWSSessionRegistry.get_client('ssm', **self._client_kwargs)
+        return self._ssm_client
+
+    @ssm_client.setter
+    def ssm_client(self, value: Any) -> None:
+        self._ssm_client = value
+
+    @property
+    def s3_client(self) -> Any:
+        """The (shared) S3 client."""
+        if self._s3_client is None:
+            self._s3_client = AWSSessionRegistry.get_client('s3', **self._client_kwargs)
+        return self._s3_client
+
+    @s3_client.setter
+    def s3_client(self, value: Any) -> None:
+        self._s3_client = value
+
+    def invalidate_describe_results(self, kinds: Iterable[str] = ALL_KINDS,
+                                    resource_ids: Optional[Iterable[str]] = None) -> None:
+        """Invalidate the cached describe results (and inventory) after a mutating operation.
+
+        Args:
+            kinds (Iterable[str]): The kinds of describe results to invalidate.
+            resource_ids (Optional[Iterable[str]]): The resources which were changed.  If None,
+            every entry of the given kinds is dropped.
+        """
+        self.describe_cache.invalidate(kinds=kinds, resource_ids=resource_ids)
+        if self.inventory is not None:
+            self.inventory.mark_stale(kinds)
+
+    def make_waiter(self, **kwargs) -> AdaptiveWaiter:
+        """Create an AdaptiveWaiter which uses this object's clock.
+
+        Args:
+            **kwargs: Arguments for AdaptiveWaiter.
+
+        Returns:
+            AdaptiveWaiter: The waiter.
+        """
+        return AdaptiveWaiter(clock=self.clock, **kwargs)
+
+    @staticmethod
+    def make_image_tag_specifications(tags: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Build the CreateImage TagSpecifications which tag the image when it is created.
+
+        Args:
+            tags (List[Dict[str, str]]): The tags.  If a key appears more than once, the last
+            value wins.
+
+        Returns:
+            List[Dict[str, Any]]: The TagSpecifications (empty if there are no tags).
+        """
+        unique_tags = {_['Key']: _['Value'] for _ in tags or []}
+        if not unique_tags:
+            return []
+        return [{
+            'ResourceType': 'image',
+            'Tags': [{'Key': key, 'Value': value} for key, value in unique_tags.items()]
+        }]
+
+    def create_images_concurrently(self, image_requests: List[Dict[str, Any]],
+                                   max_workers: int = 8) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """Submit many CreateImage calls at once.
+
+        Args:
+            image_requests (List[Dict[str, Any]]): The CreateImage arguments of each image
+            (InstanceId, Name, Description, TagSpecifications, etc.).
+            max_workers (int): The number of calls submitted concurrently.
+
+        Returns:
+            Tuple[List[str], List[Dict[str, Any]]]: The Ids of the created images (in request
+            order), and the failed requests as {'ResourceIds': [<instance id>], 'Error': '<error>'}
+            dicts.
+        """
+        def _create_image(image_request: Dict[str, Any]) -> Dict[str, Any]:
+            try:
+                response = self.ec2_client.create_image(**image_request)
+                self._validate_response_status(response)
+            except (ClientError, AWSHTTPStatusError) as ex:
+                LOGGER.write(
+                    f'CreateImage failed for instance {image_request["InstanceId"]}: {ex}', 'error')
+                return {'ResourceIds': [image_request['InstanceId']], 'Error': str(ex)}
+            LOGGER.write(f'Creating image {response["ImageId"]} ({image_request["Name"]}) from '
+                         f'instance {image_request["InstanceId"]}.')
+            return {'ImageId': response['ImageId']}
+
+        created_image_ids = []
+        failures = []
+        if not image_requests:
+            return created_image_ids, failures
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(image_requests)))) \
+                as executor:
+            for result in executor.map(_create_image, image_requests):
+                if 'ImageId' in result:
+                    created_image_ids.append(result['ImageId'])
+                else:
+                    failures.append(result)
+        return created_image_ids, failures
+
+    def wait_for_images_available(self, image_ids: List[str],
+                                  timeout: float = 7200) -> Dict[str, str]:
+        """Wait for images to become available, polling all of them with one describe call.
+
+        Images which are not visible yet (shortly after CreateImage) are treated as pending.
+        The state of each image is logged whenever it changes, and the wait ends early if any
+        image reaches a failed state.
+
+        Args:
+            image_ids (List[str]): The Ids of the images to wait for.
+            timeout (float): The total time (seconds) allowed.
+
+        Returns:
+            Dict[str, str]: The final state of each image.
+
+        Raises:
+            TimeoutError
+            WaiterFailedError
+        """
+        last_states: Dict[str, str] = {}
+        state_reasons: Dict[str, str] = {}
+
+        def _poll() -> Dict[str, str]:
+            try:
+                response = self.ec2_client.describe_images(ImageIds=image_ids)
+            except ClientError as ex:
+                if ex.response.get('Error', {}).get('Code') != 'InvalidAMIID.NotFound':
+                    raise
+                response = {'Images': []}
+            states = {_: 'pending' for _ in image_ids}
+            for image in response['Images']:
+                states[image['ImageId']] = image['State']
+                if 'StateReason' in image:
+                    state_reasons[image['ImageId']] = image['StateReason'].get('Message', '')
+            if states != last_states:
+                available_count = sum(_ == 'available' for _ in states.values())
+                LOGGER.write(f'Image states ({available_count}/{len(states)} available): {states}')
+                last_states.update(states)
+            return states
+
+        waiter = self.make_waiter(
+            initial_delay=5, max_delay=30, timeout=timeout, description=f'images {image_ids}')
+        try:
+            return waiter.wait(
+                _poll,
+                is_done=lambda states: all(_ == 'available' for _ in states.values()),
+                is_failed=lambda states: any(_ in FAILED_IMAGE_STATES for _ in states.values()),
+                progress=lambda states: states
+            )
+        except WaiterFailedError:
+            failed_images = {
+                _: f'{state}: {state_reasons.get(_, "")}'
+                for _, state in last_states.items() if state in FAILED_IMAGE_STATES
+            }
+            raise WaiterFailedError(f'Images failed while being created: {failed_images}')
+
+    @staticmethod
+    def _hydrate_resource_objects(factory: Callable[[str], Any], records: List[Dict[str, Any]],
+                                  id_key: str, resource_ids: List[str] = None) -> List[Any]:
+        """Create boto3 resource objects whose data is loaded from describe results.
+
+        A bare resource object runs its own describe call the first time an attribute (such as
+        tags) is read.  Setting meta.data up front from one bulk describe result avoids that,
+        so reading attributes of N objects costs one API call instead of N.
+
+        Args:
+            factory (Callable[[str], Any]): Creates a resource object from an Id (for example
+            ec2_resource.Instance).
+            records (List[Dict[str, Any]]): The describe results of the resources.
+            id_key (str): The key of the Id in each record (for example 'InstanceId').
+            resource_ids (List[str]): (OPTIONAL) The Ids of the objects to create, in order.  Ids
+            without a record get an un-hydrated (lazily loaded) object.  Defaults to the Ids of
+            the records.
+
+        Returns:
+            List[Any]: The resource objects.
+        """
+        records_by_id = {_[id_key]: _ for _ in records}
+        resource_objects = []
+        for resource_id in resource_ids if resource_ids is not None else list(records_by_id):
+            resource_object = factory(resource_id)
+            if resource_id in records_by_id:
+                resource_object.meta.data = records_by_id[resource_id]
+            resource_objects.append(resource_object)
+        return resource_objects
 
     @staticmethod
     def _parse_date_range(date_range: Tuple[datetime.date, Union[datetime.date, None]] = None) \
@@ -0,0 +1,206 @@
+"""
+aws_call_metrics.py
+
+This module holds in-process metrics of AWS API calls: for every operation
+('<service>.<Operation>', e.g. 'ec2.DescribeInstances' or 'ssm.SendCommand') the number of calls
+and errors, a latency histogram, and the number of retries and throttled attempts.  They show
+which operations use up the API budget (and get throttled).
+
+The metrics are fed by botocore event handlers (see AWSSessionRegistry), can be queried with
+snapshot, and can be written to a JSON file or a Prometheus textfile (for the node exporter's
+textfile collector), either on demand or when the process exits.
+"""
+__author__ = 'sedwards'
+
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+from syslinkats.framework.aws.aws_rate_limiter import THROTTLING_ERROR_CODES
+
+# The upper bounds (seconds) of the latency histogram buckets.  Calls slower than the last
+# bound are only counted by the implicit +Inf bucket.
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# The request context key which holds the start time of an API call.
+_START_CONTEXT_KEY = 'syslinkats_call_start'
+
+
+class AWSCallMetrics:
+    """Thread-safe call counts, latency histograms, retries and throttles per AWS operation."""
+
+    def __init__(self, latency_buckets: tuple = DEFAULT_LATENCY_BUCKETS):
+        """Initialize the metrics.
+
+        Args:
+            latency_buckets (tuple): The ascending upper bounds (seconds) of the latency
+            histogram buckets.
+        """
+        self.latency_buckets = tuple(latency_buckets)
+        self._lock = threading.Lock()
+        self._operations: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _operation_name(model: Any) -> str:
+        """Build the '<service>.<Operation>' name of an operation model."""
+        return f'{model.service_model.endpoint_prefix}.{model.name}'
+
+    def _get_operation(self, operation: str) -> Dict[str, Any]:
+        """Get the metrics of an operation (the caller holds the lock)."""
+        return self._operations.setdefault(operation, {
+            'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0,
+            'latency_sum': 0.0, 'latency_max': 0.0,
+            'latency_buckets': [0] * (len(self.latency_buckets) + 1)
+        })
+
+    def record_call(self, operation: str, latency: float = None, error: bool = False,
+                    retries: int = 0) -> None:
+        """Record a completed API call.
+
+        Args:
+            operation (str): The operation ('<service>.<Operation>').
+            latency (float): (OPTIONAL) The latency (seconds) of the call, retries included.
+            error (bool): Whether the call failed.
+            retries (int): The number of retries the call took.
+        """
+        with self._lock:
+            metrics = self._get_operation(operation)
+            metrics['calls'] += 1
+            metrics['errors'] += bool(error)
+            metrics['retries'] += retries
+            if latency is not None:
+                metrics['latency_sum'] += latency
+                metrics['latency_max'] = max(metrics['latency_max'], latency)
+                metrics['latency_buckets'][
+                    bisect.bisect_left(self.latency_buckets, latency)] += 1
+
+    def record_throttle(self, operation: str) -> None:
+        """Record a throttled attempt of an operation."""
+        with self._lock:
+            self._get_operation(operation)['throttles'] += 1
+
+    def reset(self) -> None:
+        """Discard every metric."""
+        with self._lock:
+            self._operations = {}
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Get the metrics of every operation.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The metrics of each operation, busiest first, with the
+            structure:
+                {'<service>.<Operation>': {
+                    'calls': <int>, 'errors': <int>, 'retries': <int>, 'throttles': <int>,
+                    'latency_sum': <seconds>, 'latency_max': <seconds>,
+                    'latency_buckets': {'<upper bound>' | '+Inf': <cumulative count>}}}
+        """
+        with self._lock:
+            operations = {key: dict(value) for key, value in self._operations.items()}
+        for metrics in operations.values():
+            bounds = [str(_) for _ in self.latency_buckets] + ['+Inf']
+            counts, total = [], 0
+            for count in metrics['latency_buckets']:
+                total += count
+                counts.append(total)
+            metrics['latency_buckets'] = dict(zip(bounds, counts))
+        return dict(sorted(operations.items(), key=lambda _: _[1]['calls'], reverse=True))
+
+    def to_json(self) -> str:
+        """Format the metrics (see snapshot) as JSON."""
+        return json.dumps({'timestamp': time.time(), 'operations': self.snapshot()}, indent=4)
+
+    def to_prometheus(self) -> str:
+        """Format the metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP syslinkats_aws_calls_total AWS API calls per operation.',
+            '# TYPE syslinkats_aws_calls_total counter',
+            '# HELP syslinkats_aws_errors_total Failed AWS API calls per operation.',
+            '# TYPE syslinkats_aws_errors_total counter',
+            '# HELP syslinkats_aws_retries_total AWS API call retries per operation.',
+            '# TYPE syslinkats_aws_retries_total counter',
+            '# HELP syslinkats_aws_throttles_total Throttled AWS API attempts per operation.',
+            '# TYPE syslinkats_aws_throttles_total counter',
+            '# HELP syslinkats_aws_call_latency_seconds AWS API call latency per operation.',
+            '# TYPE syslinkats_aws_call_latency_seconds histogram'
+        ]
+        for operation, metrics in self.snapshot().items():
+            label = f'operation="{operation}"'
+            for counter in ('calls', 'errors', 'retries', 'throttles'):
+                lines.append(f'syslinkats_aws_{counter}_total{{{label}}} {metrics[counter]}')
+            for bound, count in metrics['latency_buckets'].items():
+                lines.append(
+                    f'syslinkats_aws_call_latency_seconds_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(
+                f'syslinkats_aws_call_latency_seconds_sum{{{label}}} {metrics["latency_sum"]}')
+            lines.append(
+                f'syslinkats_aws_call_latency_seconds_count{{{label}}} '
+                f'{metrics["latency_buckets"]["+Inf"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str) -> None:
+        """Write the metrics to a file.
+
+        The file is a Prometheus textfile if its path ends with '.prom', and JSON otherwise.
+        It is written to a temporary path and renamed, so collectors never read a partially
+        written file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        content = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(temp_path, path)
+
+    def dump_at_exit(self, path: str) -> None:
+        """Write the metrics to a file (see dump) when the process exits."""
+        atexit.register(self.dump, path)
+
+    def summary_lines(self, limit: int = 10) -> List[str]:
+        """Describe the busiest operations, one line each."""
+        return [
+            f'{operation}: {_["calls"]} calls, {_["errors"]} errors, {_["retries"]} retries, '
+            f'{_["throttles"]} throttles, '
+            f'{_["latency_sum"] / max(1, _["latency_buckets"]["+Inf"]):.3f}s mean latency'
+            for operation, _ in list(self.snapshot().items())[:limit]
+        ]
+
+    # region botocore event handlers
+    @staticmethod
+    def _before_call(context: Dict[str, Any] = None, **_: Any) -> None:
+        """botocore before-call handler: note the start time of the call."""
+        if context is not None:
+            context[_START_CONTEXT_KEY] = time.perf_counter()
+
+    def _after_call(self, model: Any, http_response: Any = None, parsed: Dict[str, Any] = None,
+                    context: Dict[str, Any] = None, **_: Any) -> None:
+        """botocore after-call handler: record the call, its latency and retries."""
+        start = (context or {}).pop(_START_CONTEXT_KEY, None)
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self.record_call(
+            self._operation_name(model),
+            latency=None if start is None else time.perf_counter() - start,
+            error=http_response is not None and http_response.status_code >= 300,
+            retries=retries or 0)
+
+    def _after_call_error(self, context: Dict[str, Any] = None, **kwargs: Any) -> None:
+        """botocore after-call-error handler: record a call which raised (e.g. timed out)."""
+        start = (context or {}).pop(_START_CONTEXT_KEY, None)
+        event_name = kwargs.get('event_name', '')
+        # The event name is 'after-call-error.<service-id>.<Operation>'.
+        operation = '.'.join(event_name.split('.')[1:]) or 'unknown'
+        self.record_call(
+            operation, latency=None if start is None else time.perf_counter() - start,
+            error=True)
+
+    def _needs_retry(self, operation: Any, response: Any = None, **_: Any) -> None:
+        """botocore needs-retry handler: count throttled attempts."""
+        if response is None or not isinstance(response, tuple):
+            return
+        if response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            self.record_throttle(self._operation_name(operation))
+    # endregion
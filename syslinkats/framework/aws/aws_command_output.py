@@ -0,0 +1,112 @@
+"""
+aws_command_output.py
+
+This module streams the output of SSM commands from S3.  get_command_invocation truncates
+standard output at 24,000 characters (and list_command_invocations at 2,500), whereas a command
+sent with an S3 output location has its full output uploaded under
+
+    <key_prefix>/<command_id>/<instance_id>/<plugin>/<step>/stdout (and stderr)
+
+S3CommandOutputStream follows those objects with ranged reads, so each poll only downloads the
+bytes which appeared since the previous one.  It only needs an S3 client, so it works the same
+against a local S3 stand-in (such as moto) as against AWS.
+"""
+__author__ = 'sedwards'
+
+import codecs
+from typing import Any, Dict, List, Tuple
+
+from botocore.exceptions import ClientError
+
+# The object names under which SSM uploads each plugin's standard output and standard error.
+OUTPUT_STREAM_NAMES = ('stdout', 'stderr')
+
+
+class S3CommandOutputStream:
+    """Incrementally reads the S3 output of one SSM command."""
+
+    def __init__(self, s3_client: Any, bucket_name: str, key_prefix: str, command_id: str):
+        """Initialize the stream.
+
+        Args:
+            s3_client (Any): The S3 client.
+            bucket_name (str): The bucket the command's output is uploaded to.
+            key_prefix (str): The key prefix the command was sent with (may be empty).
+            command_id (str): The Id of the SSM command.
+        """
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key_prefix = key_prefix.strip('/') if key_prefix else ''
+        self.command_id = command_id
+        # Per object key: the number of bytes read and the incremental UTF-8 decoder, which
+        # holds back multi-byte characters split across reads.
+        self._offsets: Dict[str, int] = {}
+        self._decoders: Dict[str, Any] = {}
+        self._output: Dict[Tuple[str, str], List[str]] = {}
+
+    def instance_prefix(self, instance_id: str) -> str:
+        """Build the key prefix under which the output of an instance is uploaded."""
+        return '/'.join(_ for _ in (self.key_prefix, self.command_id, instance_id) if _) + '/'
+
+    def poll(self, instance_id: str) -> List[Dict[str, str]]:
+        """Read the output an instance uploaded since the previous poll.
+
+        Args:
+            instance_id (str): The Id of the instance.
+
+        Returns:
+            List[Dict[str, str]]: The new output, in key order, with the following structure:
+                [{'InstanceId': '<id>', 'Key': '<object key>',
+                  'Stream': 'stdout' | 'stderr', 'Content': '<new text>'}]
+        """
+        chunks = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=self.instance_prefix(instance_id)):
+            for s3_object in page.get('Contents', []):
+                key = s3_object['Key']
+                stream_name = key.rsplit('/', 1)[-1]
+                if stream_name not in OUTPUT_STREAM_NAMES \
+                        or s3_object['Size'] <= self._offsets.get(key, 0):
+                    continue
+
+                content = self._read_new_bytes(key)
+                if content:
+                    self._output.setdefault((instance_id, stream_name), []).append(content)
+                    chunks.append({'InstanceId': instance_id, 'Key': key,
+                                   'Stream': stream_name, 'Content': content})
+        return chunks
+
+    def _read_new_bytes(self, key: str) -> str:
+        """Read (and decode) the bytes of an object past the previous read."""
+        offset = self._offsets.get(key, 0)
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=key, Range=f'bytes={offset}-')
+        except ClientError as ex:
+            # The object was replaced by a shorter one between the listing and the read.
+            if ex.response.get('Error', {}).get('Code') == 'InvalidRange':
+                return ''
+            raise
+
+        data = response['Body'].read()
+        self._offsets[key] = offset + len(data)
+        decoder = self._decoders.setdefault(
+            key, codecs.getincrementaldecoder('utf-8')(errors='replace'))
+        return decoder.decode(data)
+
+    def get_output(self, instance_id: str, stream_name: str = 'stdout') -> str:
+        """Get all of an instance's output read so far.
+
+        Args:
+            instance_id (str): The Id of the instance.
+            stream_name (str): 'stdout' or 'stderr'.
+
+        Returns:
+            str: The output of every plugin step, in the order it was read.
+        """
+        return ''.join(self._output.get((instance_id, stream_name), []))
+
+    def has_output(self, instance_id: str) -> bool:
+        """Whether any output of an instance (on either stream) has been read."""
+        return any((instance_id, _) in self._output for _ in OUTPUT_STREAM_NAMES)
@@ -0,0 +1,242 @@
+"""
+aws_describe_cache.py
+
+This module holds a per-region cache of EC2 describe results (instances, images and tags) which
+is shared by every AWSInstance and AWSImage object created for that region.
+
+Cached values are returned as copies, so callers may modify the results they get.
+"""
+__author__ = 'sedwards'
+
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from syslinkats.data.common.aws_default_parameters import DEFAULT_DESCRIBE_CACHE_TTL
+
+# The kinds of describe results held by the cache.
+INSTANCES = 'instances'
+IMAGES = 'images'
+TAGS = 'tags'
+ALL_KINDS = (INSTANCES, IMAGES, TAGS)
+
+
+# The container types of describe results, which are copied (see _copy_value).
+_CONTAINER_TYPES = (dict, list)
+
+
+def _copy_value(value: Any) -> Any:
+    """Copy a describe result.
+
+    Describe results are nested dicts and lists whose leaves (strings, numbers, datetimes) are
+    immutable, so only the containers are copied, which is much faster than copy.deepcopy.
+    """
+    if type(value) is dict:  # pylint: disable=unidiomatic-typecheck
+        return {key: _copy_value(item) if type(item) in _CONTAINER_TYPES else item
+                for key, item in value.items()}
+    if type(value) is list:  # pylint: disable=unidiomatic-typecheck
+        return [_copy_value(_) if type(_) in _CONTAINER_TYPES else _ for _ in value]
+    return value
+
+
+class _CacheEntry:
+    """A single cached describe result."""
+
+    __slots__ = ('expires_at', 'value', 'resource_ids', 'pinned')
+
+    def __init__(self, expires_at: float, value: Any, resource_ids: frozenset, pinned: bool):
+        self.expires_at = expires_at
+        self.value = value
+        self.resource_ids = resource_ids
+        self.pinned = pinned
+
+
+class AWSDescribeCache:
+    """A thread-safe TTL cache of EC2 describe results for a single region.
+
+    Entries are keyed by their kind (instances, images or tags) and the query which produced
+    them.  Each entry remembers the resource Ids it contains and whether the query was pinned to
+    explicit resource Ids.  Mutating operations invalidate every entry which contains one of the
+    affected resources, as well as every un-pinned (filter-based) entry of the affected kinds, as
+    those queries may now match a different set of resources.
+
+    Each kind also has a generation, which invalidation bumps, so that a describe result loaded
+    while an invalidation happened (e.g. a terminate on another thread) is not cached.
+    """
+
+    _registry: Dict[str, 'AWSDescribeCache'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, region_name: str = None, ttl: float = DEFAULT_DESCRIBE_CACHE_TTL,
+                 time_func: Callable[[], float] = time.monotonic):
+        """Initialize the cache.
+
+        Args:
+            region_name (str): The AWS region whose describe results are cached.
+            ttl (float): The number of seconds an entry stays valid.  A value <= 0 disables
+            caching.
+            time_func (Callable[[], float]): The monotonic clock used to expire entries.
+        """
+        self.region_name = region_name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._time_func = time_func
+        self._entries: Dict[Tuple[str, str], _CacheEntry] = {}
+        # The number of invalidations of each kind.
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_region(cls, region_name: str, ttl: Optional[float] = None) -> 'AWSDescribeCache':
+        """Get (or create) the process-wide cache for a region.
+
+        Args:
+            region_name (str): The AWS region.
+            ttl (Optional[float]): If provided, the TTL (seconds) to set on the region's cache.
+
+        Returns:
+            AWSDescribeCache: The cache shared by all AWS objects for the region.
+        """
+        with cls._registry_lock:
+            cache = cls._registry.get(region_name)
+            if cache is None:
+                cache = cls(region_name=region_name)
+                cls._registry[region_name] = cache
+        if ttl is not None:
+            cache.ttl = ttl
+        return cache
+
+    @staticmethod
+    def make_key(**query: Any) -> str:
+        """Build a stable cache key from the arguments of a describe query."""
+        return json.dumps(query, sort_keys=True, default=str)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """The hit / miss counters and the current number of entries."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """Get a cached value, or None if it is missing or has expired.
+
+        Args:
+            kind (str): The kind of describe result (INSTANCES, IMAGES or TAGS).
+            key (str): The query key (see make_key).
+
+        Returns:
+            Optional[Any]: A copy of the cached value.
+        """
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is not None and entry.expires_at > self._time_func():
+                self.hits += 1
+                value = entry.value
+            else:
+                if entry is not None:
+                    del self._entries[(kind, key)]
+                self.misses += 1
+                return None
+        # Cached values are never modified, so they can be copied outside the lock.
+        return _copy_value(value)
+
+    # pylint: disable=too-many-arguments
+    def put(self, kind: str, key: str, value: Any, resource_ids: Iterable[str] = None,
+            pinned: bool = False) -> None:
+        """Store a value in the cache.
+
+        Args:
+            kind (str): The kind of describe result (INSTANCES, IMAGES or TAGS).
+            key (str): The query key (see make_key).
+            value (Any): The describe result to cache.
+            resource_ids (Iterable[str]): The Ids of the resources contained in the result.
+            pinned (bool): Whether the query was restricted to explicit resource Ids.
+        """
+        value = _copy_value(value)
+        with self._lock:
+            self._store(kind, key, value, resource_ids, pinned)
+
+    # pylint: disable=too-many-arguments
+    def _store(self, kind: str, key: str, value: Any, resource_ids: Optional[Iterable[str]],
+               pinned: bool) -> None:
+        """Store a (copied) value in the cache (the caller holds the lock)."""
+        if self.ttl <= 0:
+            return
+
+        self._entries[(kind, key)] = _CacheEntry(
+            expires_at=self._time_func() + self.ttl,
+            value=value,
+            resource_ids=frozenset(resource_ids or []),
+            pinned=pinned
+        )
+
+    # pylint: disable=too-many-arguments
+    def get_or_load(self, kind: str, key: str, loader: Callable[[], Any],
+                    resource_ids_func: Callable[[Any], Iterable[str]] = None,
+                    pinned: bool = False) -> Any:
+        """Get a cached value, calling loader() and caching its result on a miss.
+
+        The loaded value is not cached if the kind was invalidated while loader() ran, as it may
+        predate the mutation.
+
+        Args:
+            kind (str): The kind of describe result (INSTANCES, IMAGES or TAGS).
+            key (str): The query key (see make_key).
+            loader (Callable[[], Any]): Performs the describe call.
+            resource_ids_func (Callable[[Any], Iterable[str]]): Extracts the resource Ids from
+            the loaded value.
+            pinned (bool): Whether the query was restricted to explicit resource Ids.
+
+        Returns:
+            Any: A copy of the cached value, or the freshly loaded value.
+        """
+        value = self.get(kind, key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            generation = self._generations.get(kind, 0)
+        value = loader()
+        if self.ttl <= 0:
+            return value
+        resource_ids = resource_ids_func(value) if resource_ids_func else None
+        cached_value = _copy_value(value)
+        with self._lock:
+            if self._generations.get(kind, 0) == generation:
+                self._store(kind, key, cached_value, resource_ids, pinned)
+        return value
+
+    def invalidate(self, kinds: Iterable[str] = ALL_KINDS,
+                   resource_ids: Optional[Iterable[str]] = None) -> None:
+        """Invalidate cached entries after a mutating operation.
+
+        Args:
+            kinds (Iterable[str]): The kinds of describe results to invalidate.
+            resource_ids (Optional[Iterable[str]]): The resources which were changed.  If None,
+            every entry of the given kinds is dropped.
+        """
+        kinds = set(kinds)
+        changed_ids = None if resource_ids is None else set(resource_ids)
+        with self._lock:
+            for kind in kinds:
+                self._generations[kind] = self._generations.get(kind, 0) + 1
+            stale_keys: List[Tuple[str, str]] = []
+            for entry_key, entry in self._entries.items():
+                if entry_key[0] not in kinds:
+                    continue
+                if changed_ids is None or not entry.pinned \
+                        or not entry.resource_ids.isdisjoint(changed_ids):
+                    stale_keys.append(entry_key)
+            for entry_key in stale_keys:
+                del self._entries[entry_key]
+
+    def clear(self) -> None:
+        """Drop all entries and reset the hit / miss counters."""
+        with self._lock:
+            for kind in ALL_KINDS:
+                self._generations[kind] = self._generations.get(kind, 0) + 1
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,210 @@
+"""
+aws_fleet.py
+
+This module holds a facade which runs AWSInstance and AWSImage operations across many regions
+at once.  Each region's work runs on a bounded thread pool, so a multi-region query or teardown
+takes about as long as the slowest region rather than the sum of all of them.  Merged results
+are annotated with the region they came from.
+"""
+__author__ = 'sedwards'
+
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Type, TypeVar
+
+from syslinkats.framework.aws.aws_base import AWSBase
+from syslinkats.framework.aws.aws_image import AWSImage
+from syslinkats.framework.aws.aws_instance import AWSInstance
+from syslinkats.framework.errors.custom_errors import BulkOperationError
+from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.validators.validate_args import validate_args_for_value
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+T = TypeVar('T')
+
+
+class AWSFleet:
+    """Runs AWS operations concurrently across a list of regions."""
+
+    def __init__(self, region_names: List[str], max_workers: int = 8, **kwargs):
+        """Initialize the fleet.
+
+        Args:
+            region_names (List[str]): The AWS regions.
+            max_workers (int): The most regions worked on at the same time.
+            **kwargs: Other arguments for the per-region AWSInstance / AWSImage objects (for
+            example profile_name or clock).
+        """
+        validate_args_for_value(region_names=region_names)
+        self.region_names = list(region_names)
+        self.max_workers = max_workers
+        self._kwargs = kwargs
+        self._objects: Dict[tuple, AWSBase] = {}
+        self._lock = threading.Lock()
+
+    def instance(self, region_name: str) -> AWSInstance:
+        """Get the AWSInstance of a region."""
+        return self._get_object(AWSInstance, region_name)
+
+    def image(self, region_name: str) -> AWSImage:
+        """Get the AWSImage of a region."""
+        return self._get_object(AWSImage, region_name)
+
+    def _get_object(self, object_type: Type[AWSBase], region_name: str) -> Any:
+        """Get (or create) the AWSInstance / AWSImage of a region."""
+        with self._lock:
+            key = (object_type, region_name)
+            if key not in self._objects:
+                self._objects[key] = object_type(region_name=region_name, **self._kwargs)
+            return self._objects[key]
+
+    def map_regions(self, func: Callable[[AWSBase], T], object_type: Type[AWSBase] = AWSInstance,
+                    region_names: Optional[List[str]] = None,
+                    raise_on_error: bool = True) -> Dict[str, T]:
+        """Call a function with each region's AWSInstance (or AWSImage) concurrently.
+
+        Args:
+            func (Callable[[AWSBase], T]): The per-region operation.
+            object_type (Type[AWSBase]): AWSInstance or AWSImage.
+            region_names (Optional[List[str]]): (OPTIONAL) A subset of the fleet's regions.
+            raise_on_error (bool): Whether to raise once all regions are done if any failed.
+            Otherwise the failed regions are logged and left out of the results.
+
+        Returns:
+            Dict[str, T]: The result of each region, in the order of the regions.
+
+        Raises:
+            BulkOperationError: If raise_on_error is True and any region failed.  Its failures
+            are {'Region': '<region>', 'Error': '<error>'} dicts.
+        """
+        region_names = self.region_names if region_names is None else region_names
+
+        def _run(region_name: str) -> Dict[str, Any]:
+            try:
+                return {'Result': func(self._get_object(object_type, region_name))}
+            except Exception as ex:  # pylint: disable=broad-except
+                LOGGER.write(f'The operation failed in {region_name}: {ex}', 'error')
+                return {'Region': region_name, 'Error': str(ex)}
+
+        results: Dict[str, T] = {}
+        failures = []
+        if not region_names:
+            return results
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(region_names)))) \
+                as executor:
+            for region_name, outcome in zip(region_names, executor.map(_run, region_names)):
+                if 'Result' in outcome:
+                    results[region_name] = outcome['Result']
+                else:
+                    failures.append(outcome)
+
+        if failures and raise_on_error:
+            raise BulkOperationError(f'The operation failed in {len(failures)} region(s): '
+                                     f'{failures}', failures)
+        return results
+
+    @staticmethod
+    def _annotate(results: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Merge per-region lists of describe records, adding a 'Region' key to each record."""
+        return [
+            dict(record, Region=region_name)
+            for region_name, records in results.items() for record in records
+        ]
+
+    def describe_instances(self, **kwargs) -> List[Dict[str, Any]]:
+        """Describe the instances of every region (see AWSInstance.describe_instances).
+
+        Args:
+            **kwargs: Arguments for AWSInstance.describe_instances (newest_only is ignored).
+
+        Returns:
+            List[Dict[str, Any]]: The instance dicts of all regions, each with a 'Region' key.
+        """
+        kwargs['newest_only'] = False
+        return self._annotate(self.map_regions(
+            lambda aws_instance: aws_instance.describe_instances(**kwargs)))
+
+    def describe_images(self, **kwargs) -> List[Dict[str, Any]]:
+        """Describe the images of every region (see AWSImage.describe_images).
+
+        Args:
+            **kwargs: Arguments for AWSImage.describe_images (newest_only is ignored).
+
+        Returns:
+            List[Dict[str, Any]]: The image dicts of all regions, each with a 'Region' key.
+        """
+        kwargs['newest_only'] = False
+        return self._annotate(self.map_regions(
+            lambda aws_image: aws_image.describe_images(**kwargs) or [], object_type=AWSImage))
+
+    def map_public_dns_names_to_ids(self, public_dns_names: List[str]) \
+            -> Dict[str, Optional[Dict[str, str]]]:
+        """Find the region and instance Id of each public DNS name.
+
+        Args:
+            public_dns_names (List[str]): The public DNS names to resolve.
+
+        Returns:
+            Dict[str, Optional[Dict[str, str]]]: Each public DNS name (in the order provided)
+            mapped to {'Region': '<region>', 'InstanceId': '<id>'}, or to None if no region has
+            a matching instance.
+        """
+        results = self.map_regions(
+            lambda aws_instance: aws_instance.map_public_dns_names_to_ids(public_dns_names))
+
+        resolved: Dict[str, Optional[Dict[str, str]]] = {_: None for _ in public_dns_names}
+        for region_name, ids_by_name in results.items():
+            for public_dns_name, instance_id in ids_by_name.items():
+                if instance_id and resolved[public_dns_name] is None:
+                    resolved[public_dns_name] = {'Region': region_name, 'InstanceId': instance_id}
+        return resolved
+
+    def cleanup_instances(self, instance_ids_by_region: Dict[str, List[str]] = None,
+                          **kwargs) -> Dict[str, List[str]]:
+        """Stop or terminate instances in every region (see AWSInstance.cleanup_instances).
+
+        Args:
+            instance_ids_by_region (Dict[str, List[str]]): (OPTIONAL) The instance Ids of each
+            region.  If omitted, the other arguments (filters, etc.) select the instances of
+            every region.
+            **kwargs: Arguments for AWSInstance.cleanup_instances.
+
+        Returns:
+            Dict[str, List[str]]: The Ids of the stopped / terminated instances of each region.
+        """
+        if instance_ids_by_region is None:
+            return self.map_regions(lambda aws_instance: aws_instance.cleanup_instances(**kwargs))
+
+        return self.map_regions(
+            lambda aws_instance: aws_instance.cleanup_instances(
+                instance_ids=instance_ids_by_region[aws_instance.region_name], **kwargs),
+            region_names=[_ for _ in instance_ids_by_region if instance_ids_by_region[_]])
+
+    def create_or_update_tag_value(self, resource_ids_by_region: Dict[str, List[str]],
+                                   tags: List[Dict[str, str]]) -> None:
+        """Create or update tags on resources in every region.
+
+        Args:
+            resource_ids_by_region (Dict[str, List[str]]): The resource Ids of each region.
+            tags (List[Dict[str, str]]): The tags to set ([{'Key': '<name>', 'Value': <value>}]).
+        """
+        self.map_regions(
+            lambda aws_instance: aws_instance.create_or_update_tag_value(
+                resource_ids=resource_ids_by_region[aws_instance.region_name], tags=tags),
+            region_names=[_ for _ in resource_ids_by_region if resource_ids_by_region[_]])
+
+    def get_instances_with_expired_termination_date(self, **kwargs) -> Dict[str, List[str]]:
+        """Find the instances whose TerminationDate has passed, in every region.
+
+        Args:
+            **kwargs: Arguments for AWSInstance.get_instances_with_expired_termination_date.
+
+        Returns:
+            Dict[str, List[str]]: The expired instance Ids of each region.
+        """
+        return self.map_regions(
+            lambda aws_instance: aws_instance.get_instances_with_expired_termination_date(
+                **kwargs))
@@ -12,8 +12,12 @@ from typing import Optional
 from typing import Tuple
 from typing import Union
 
+from botocore.exceptions import ClientError
+
+from syslinkats.framework.errors.custom_errors import BulkOperationError
 from syslinkats.framework.logging.auto_indent import AutoIndent
 from syslinkats.framework.aws import AWSBase
+from syslinkats.framework.aws.aws_describe_cache import IMAGES, TAGS
 
 # Set up AutoIndent for logging.
 LOGGER = AutoIndent(stream=sys.stdout)
@@ -132,16 +136,16 @@ class AWSImage(AWSBase):
         else:
             raise TypeError('The provided image must be a valid image dict.')
 
-    def _create_image_from_data_object(self, image_data: Dict[str, str] = None,
-                                       **kwargs) -> Optional[str]:
-        """
+    def _image_request_from_data_object(self, image_data: Dict[str, str] = None,
+                                        **kwargs) -> Optional[Dict[str, Any]]:
+        """Build the CreateImage arguments for an image data object.
 
         Args:
             image_data:
             **kwargs:
 
         Returns:
-
+            The CreateImage arguments, or None if the data object has no InstanceId.
         """
         if image_data is not None and isinstance(image_data, dict):
             if 'InstanceId' not in image_data:
@@ -162,38 +166,37 @@ class AWSImage(AWSBase):
                 else:
                     image_tags = []
 
-                created_image_id = self.ec2_client.create_image(
+                image_request = dict(
                     InstanceId=image_data['InstanceId'],
                     Name=name,
                     Description=description,
                     **kwargs)
+                # Tag the image as part of CreateImage instead of with a separate call.
+                tag_specifications = self.make_image_tag_specifications(image_tags)
+                if tag_specifications:
+                    image_request['TagSpecifications'] = tag_specifications
 
-                if len(image_tags) > 0:
-                    image_object = self.ec2_resource.Image(created_image_id)
-                    image_object.create_tags(Tags=image_tags)
-
-                return created_image_id
+                return image_request
         else:
             raise TypeError('You must provide a valid image data object.')
 
-    def _create_image_from_instance_id(self, instance_id: str = None,
-                                       **kwargs) -> Optional[str]:
-        """
+    @staticmethod
+    def _image_request_from_instance_id(instance_id: str = None, **kwargs) -> Dict[str, Any]:
+        """Build the CreateImage arguments for an instance Id.
 
         Args:
             instance_id:
             **kwargs:
 
         Returns:
-
+            The CreateImage arguments.
         """
         if instance_id is not None and isinstance(instance_id, str):
-            created_image_id = self.ec2_client.create_image(
+            return dict(
                 InstanceId=instance_id,
                 Name='auto-gen-' + instance_id,
                 Description='',
                 **kwargs)
-            return created_image_id
         else:
             raise TypeError('You must provide a valid instance id.')
 
@@ -226,6 +229,7 @@ class AWSImage(AWSBase):
             LOGGER.write('Image {} will be de-registered.'.format(image_object.image_id))
             _image_ids.append(image_object.image_id)
             image_object.deregister()
+        self.invalidate_describe_results(kinds=[IMAGES, TAGS], resource_ids=_image_ids)
 
     def create_images(self, instance_ids: List[str], image_data: List[Dict[str, str]] = None,
                       do_wait: bool = True, **kwargs) -> List[str]:
@@ -240,27 +244,32 @@ class AWSImage(AWSBase):
         Returns:
 
         """
-        created_image_ids = []
         if image_data is not None and len(image_data) > 0:
-            for data in image_data:
-                created_image_id = self._create_image_from_data_object(image_data=data, **kwargs)
-                if created_image_id:
-                    created_image_ids.append(created_image_id)
+            image_requests = [
+                _ for _ in (self._image_request_from_data_object(image_data=data, **kwargs)
+                            for data in image_data) if _]
         elif instance_ids is not None and len(instance_ids) > 0:
-            for instance_id in instance_ids:
-                created_image_id = self._create_image_from_instance_id(
-                    instance_id=instance_id, **kwargs)
-                created_image_ids.append(created_image_id)
+            image_requests = [
+                self._image_request_from_instance_id(instance_id=_, **kwargs)
+                for _ in instance_ids]
         else:
             raise TypeError(
                 'You must provide either a list of instance Ids or instance data object.')
 
-        if do_wait:
-            if do_wait:
-                LOGGER.write('Waiting for images to become available.')
-                waiter = self.ec2_client.get_waiter('image_available')
-                waiter.wait(ImageIds=created_image_ids)
-                LOGGER.write('Images available.')
+        # All images are requested concurrently, then waited on together.
+        created_image_ids, failures = self.create_images_concurrently(image_requests)
+        self.invalidate_describe_results(kinds=[IMAGES, TAGS], resource_ids=created_image_ids)
+
+        if do_wait and created_image_ids:
+            LOGGER.write('Waiting for images to become available.')
+            self.wait_for_images_available(created_image_ids)
+            self.invalidate_describe_results(kinds=[IMAGES, TAGS], resource_ids=created_image_ids)
+            LOGGER.write('Images available.')
+
+        if failures:
+            raise BulkOperationError(
+                f'CreateImage failed for {len(failures)} instance(s) (created images: '
+                f'{created_image_ids}): {failures}', failures)
 
         return created_image_ids
 
@@ -329,6 +338,8 @@ class AWSImage(AWSBase):
                         newest_only: bool = True) -> Union[List[Dict], Dict, None]:
         """
         NOTE: Querying with empty Filters, InstanceIds or Owners returns all instances.
+        The raw query results are served from the local inventory (if this object has one and
+        owners is ['self']) or from the region's describe cache while they are fresh.
 
         Args:
             image_ids:
@@ -341,12 +352,24 @@ class AWSImage(AWSBase):
         Returns:
 
         """
-        response = self.ec2_client.describe_images(
-            Filters=filters or [], ImageIds=image_ids or [], Owners=owners or [])
-        self._validate_response_status(response)
+        images = None
+        # The inventory only holds the images owned by this account.
+        if self.inventory is not None and owners == ['self']:
+            images = self.inventory.find(
+                self.ec2_client, IMAGES, resource_ids=image_ids, filters=filters)
+        if images is None:
+            images = self.describe_cache.get_or_load(
+                IMAGES,
+                self.describe_cache.make_key(image_ids=image_ids, filters=filters, owners=owners),
+                loader=lambda: self._describe_images_response(
+                    image_ids=image_ids, filters=filters, owners=owners)['Images'],
+                resource_ids_func=lambda images_: [_['ImageId'] for _ in images_] + list(
+                    image_ids or []),
+                pinned=bool(image_ids)
+            )
 
         filtered_images = []
-        for image in response['Images']:
+        for image in images:
             if date_range is not None:
                 start_date, end_date = self._parse_date_range(date_range)
                 creation_date = self._get_creation_date_value(image)
@@ -379,11 +402,29 @@ class AWSImage(AWSBase):
         else:
             return filtered_images
 
+    def _describe_images_response(self, image_ids: List[str] = None,
+                                  filters: List[Dict[str, Union[str, List[str]]]] = None,
+                                  owners: List[str] = None) -> Dict[str, Any]:
+        """Calls describe_images and validates the response status.
+
+        Args:
+            image_ids:
+            filters:
+            owners:
+
+        Returns:
+
+        """
+        response = self.ec2_client.describe_images(
+            Filters=filters or [], ImageIds=image_ids or [], Owners=owners or [])
+        self._validate_response_status(response)
+        return response
+
     def get_image_objects(self, image_ids: List[str] = None,
                           filters: List[Dict[str, Union[str, List[str]]]] = None,
                           date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
                           state: List[str] = None, owners: List[str] = None,
-                          newest_only: bool = True) -> List[Any]:
+                          newest_only: bool = True, hydrate: bool = True) -> List[Any]:
         """
 
         Args:
@@ -393,33 +434,53 @@ class AWSImage(AWSBase):
             state:
             owners:
             newest_only:
+            hydrate: Whether to load the data of all the image objects up front from one
+            describe query.  Otherwise, each object runs its own describe call the first time
+            one of its attributes is read.
 
         Returns:
 
         """
-        _image_ids = []
         if image_ids is not None and len(image_ids) > 0:
-            _image_ids = image_ids
-        elif filters is not None and len(filters) > 0:
-            _image_ids = self.describe_image_ids(
+            if not hydrate:
+                return [self.ec2_resource.Image(_) for _ in image_ids]
+
+            try:
+                images = self.describe_images(image_ids=image_ids, newest_only=False)
+            except ClientError as ex:
+                if ex.response['Error']['Code'] not in ('InvalidAMIID.NotFound',
+                                                        'InvalidAMIID.Unavailable'):
+                    raise
+                images = []
+            return self._hydrate_resource_objects(
+                self.ec2_resource.Image, images, 'ImageId', resource_ids=image_ids)
+
+        if filters is not None and len(filters) > 0:
+            images = self.describe_images(
                 filters=filters, date_range=date_range, owners=owners, newest_only=newest_only)
         elif date_range is not None and isinstance(date_range, tuple):
-            _image_ids = self.describe_image_ids(
+            images = self.describe_images(
                 date_range=date_range, owners=owners, newest_only=newest_only)
         elif state is not None and len(state) > 0:
-            _image_ids = self.describe_image_ids(
-                state=state, owners=owners, newest_only=newest_only)
+            images = self.describe_images(state=state, owners=owners, newest_only=newest_only)
         else:
             raise TypeError('You must provide a valid list of instance ids.')
 
-        if isinstance(_image_ids, str):
-            return self.ec2_resource.Image(_image_ids)
+        if images is None:
+            return []
+
+        # When only the newest image is requested, return a single image object.
+        is_newest_only = isinstance(images, dict)
+        if is_newest_only:
+            images = [images]
 
-        image_objects = []
-        for image_id in _image_ids:
-            image_objects.append(self.ec2_resource.Image(image_id))
+        if hydrate:
+            image_objects = self._hydrate_resource_objects(
+                self.ec2_resource.Image, images, 'ImageId')
+        else:
+            image_objects = [self.ec2_resource.Image(_['ImageId']) for _ in images]
 
-        return image_objects
+        return image_objects[0] if is_newest_only else image_objects
 
 
 # if __name__ == '__main__':
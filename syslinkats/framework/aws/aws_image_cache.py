@@ -0,0 +1,165 @@
+"""
+aws_image_cache.py
+
+This module holds a cache of "baked" AMIs: images of instances which already have a given
+SystemLink suite and feed set installed.  Each baked image is tagged with a cache key (a hash
+of the feeds and of the configuration applied before baking), so an instance needing the same
+software can be launched from the baked image instead of installing everything again.
+
+Baked images are evicted (deregistered, and their snapshots deleted) once there are more than
+max_images of them or once they are older than max_age_days.
+"""
+__author__ = 'sedwards'
+
+import datetime
+import hashlib
+import json
+import sys
+from typing import Any, List, Optional
+
+from botocore.exceptions import ClientError
+
+from syslinkats.data.common.aws_default_parameters import (
+    DEFAULT_BAKED_IMAGE_MAX_AGE_DAYS,
+    DEFAULT_BAKED_IMAGE_MAX_COUNT
+)
+from syslinkats.framework.aws.aws_describe_cache import IMAGES, TAGS
+from syslinkats.framework.aws.aws_image import AWSImage
+from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.validators.validate_args import validate_args_for_value
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+# The Category tag value of baked images, and the tag which holds their cache key.
+BAKED_IMAGE_CATEGORY = 'BakedImage'
+BAKED_IMAGE_KEY_TAG = 'BakeKey'
+
+
+class BakedImageCache:
+    """Finds, bakes and evicts AMIs keyed by the software installed on them."""
+
+    def __init__(self, aws_image: AWSImage, max_images: int = DEFAULT_BAKED_IMAGE_MAX_COUNT,
+                 max_age_days: int = DEFAULT_BAKED_IMAGE_MAX_AGE_DAYS):
+        """Initialize the cache.
+
+        Args:
+            aws_image (AWSImage): The AWSImage of the region the images are kept in.
+            max_images (int): The most baked images kept (the newest are kept).
+            max_age_days (int): The age (days) after which baked images are evicted.
+        """
+        self.aws_image = aws_image
+        self.max_images = max_images
+        self.max_age_days = max_age_days
+
+    @staticmethod
+    def compute_cache_key(*key_parts: Any) -> str:
+        """Hash the parts of a cache key (e.g. the feed items and configuration data).
+
+        Args:
+            *key_parts (Any): JSON-serializable values.  Dict key order does not matter.
+
+        Returns:
+            str: The cache key.
+        """
+        canonical = json.dumps(key_parts, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+    def _describe_baked_images(self, cache_key: str = None) -> List[dict]:
+        """Describe the available baked images (with a given key), newest first."""
+        filters = [{'Name': 'tag:Category', 'Values': [BAKED_IMAGE_CATEGORY]}]
+        if cache_key:
+            filters.append({'Name': f'tag:{BAKED_IMAGE_KEY_TAG}', 'Values': [cache_key]})
+        images = self.aws_image.describe_images(
+            filters=filters, owners=['self'], state=['available'], newest_only=False) or []
+        return sorted(images, key=lambda _: _['CreationDate'], reverse=True)
+
+    def lookup(self, cache_key: str) -> Optional[str]:
+        """Find the newest baked image with a cache key.
+
+        Args:
+            cache_key (str): The cache key (see compute_cache_key).
+
+        Returns:
+            Optional[str]: The image Id, or None on a cache miss (or if the image is due for
+            eviction).
+        """
+        validate_args_for_value(cache_key=cache_key)
+        for image in self._describe_baked_images(cache_key):
+            # pylint: disable=protected-access
+            if AWSImage._get_image_days_age(image) <= self.max_age_days:
+                LOGGER.write(f'Baked image cache hit for {cache_key}: {image["ImageId"]}')
+                return image['ImageId']
+        LOGGER.write(f'Baked image cache miss for {cache_key}.')
+        return None
+
+    def bake(self, instance_id: str, cache_key: str, description: str = '') -> str:
+        """Create a baked image of an instance, then evict old baked images.
+
+        Note that CreateImage reboots the instance.
+
+        Args:
+            instance_id (str): The Id of the provisioned instance.
+            cache_key (str): The cache key of the software on the instance.
+            description (str): The image description.
+
+        Returns:
+            str: The Id of the baked image (once it is available).
+        """
+        validate_args_for_value(instance_id=instance_id, cache_key=cache_key)
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        image_id = self.aws_image.create_images(
+            instance_ids=[instance_id],
+            image_data=[{
+                'InstanceId': instance_id,
+                'Name': f'baked-{cache_key[:16]}-{timestamp}',
+                'Description': description[:255],
+                'Tags': [
+                    {'Key': 'Category', 'Value': BAKED_IMAGE_CATEGORY},
+                    {'Key': BAKED_IMAGE_KEY_TAG, 'Value': cache_key}
+                ]
+            }])[0]
+        LOGGER.write(f'Baked image {image_id} for {cache_key}.')
+        self.evict(keep_image_ids=[image_id])
+        return image_id
+
+    def evict(self, keep_image_ids: List[str] = None) -> List[str]:
+        """Deregister the baked images beyond max_images or older than max_age_days.
+
+        The snapshots of the evicted images are deleted as well.
+
+        Args:
+            keep_image_ids (List[str]): (OPTIONAL) Images never to evict (e.g. one just baked).
+            They still count towards max_images.
+
+        Returns:
+            List[str]: The Ids of the evicted images.
+        """
+        keep_image_ids = keep_image_ids or []
+        images = self._describe_baked_images()
+        images.sort(key=lambda _: _['ImageId'] not in keep_image_ids)
+        evicted = [
+            image for index, image in enumerate(images)
+            # pylint: disable=protected-access
+            if image['ImageId'] not in keep_image_ids and (
+                index >= self.max_images
+                or AWSImage._get_image_days_age(image) > self.max_age_days)
+        ]
+        if not evicted:
+            return []
+
+        ec2_client = self.aws_image.ec2_client
+        for image in evicted:
+            LOGGER.write(f'Evicting baked image {image["ImageId"]} ({image["CreationDate"]}).')
+            ec2_client.deregister_image(ImageId=image['ImageId'])
+            for mapping in image.get('BlockDeviceMappings', []):
+                snapshot_id = mapping.get('Ebs', {}).get('SnapshotId')
+                if not snapshot_id:
+                    continue
+                try:
+                    ec2_client.delete_snapshot(SnapshotId=snapshot_id)
+                except ClientError as ex:
+                    LOGGER.write(f'Unable to delete snapshot {snapshot_id}: {ex}', 'warning')
+
+        evicted_ids = [_['ImageId'] for _ in evicted]
+        self.aws_image.invalidate_describe_results(kinds=[IMAGES, TAGS], resource_ids=evicted_ids)
+        return evicted_ids
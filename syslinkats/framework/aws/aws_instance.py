@@ -3,13 +3,14 @@ aws_instance.py
 """
 __author__ = 'sedwards'
 
-import socket
 import sys
-import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
@@ -19,14 +20,34 @@ from botocore.exceptions import ClientError
 from dateutil.tz import tzutc
 
 from syslinkats.data.common.aws_default_parameters import DEFAULT_QUERY_INSTANCE_STATES
-from syslinkats.framework.aws import AWSBase
+from syslinkats.framework.aws import AWSBase, AWSHTTPStatusError
+from syslinkats.framework.aws.aws_command_output import S3CommandOutputStream
+from syslinkats.framework.aws.aws_describe_cache import ALL_KINDS, IMAGES, INSTANCES, TAGS
+from syslinkats.framework.aws.aws_rate_limiter import is_throttling_error
+from syslinkats.framework.errors.custom_errors import BulkOperationError
 from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.logging.span_recorder import traced
+from syslinkats.framework.network_utils.readiness_probe import check_ports, wait_for_hosts_ready
 
 # Set up AutoIndent for logging.
 from syslinkats.framework.validators.validate_args import validate_args_for_value
 
 LOGGER = AutoIndent(stream=sys.stdout)
 
+# SSM command invocation statuses after which an invocation will not change again.
+TERMINAL_COMMAND_STATUSES = ('Success', 'Cancelled', 'TimedOut', 'Failed')
+# list_command_invocations truncates plugin output at this many characters.
+LIST_INVOCATIONS_OUTPUT_LIMIT = 2500
+# The separator SSM places between standard output and standard error in plugin output.
+PLUGIN_OUTPUT_ERROR_SEPARATOR = '----------ERROR-------'
+# The number of instances per TerminateInstances / StopInstances call.  EC2 rejects a whole call
+# if any of its instances is invalid, so smaller chunks limit the impact of one bad Id.
+INSTANCE_ACTION_CHUNK_SIZE = 100
+# DescribeInstanceStatus accepts at most this many explicit instance Ids per call.
+DESCRIBE_INSTANCE_STATUS_MAX_IDS = 100
+# describe_tags accepts at most this many values per filter.
+DESCRIBE_TAGS_MAX_FILTER_VALUES = 200
+
 
 class AWSInstance(AWSBase):
     """A class for AWS Instance operations."""
@@ -109,6 +130,33 @@ class AWSInstance(AWSBase):
             public_dns_names.append(private_dns_name.replace('ec2.internal', public_dns_suffix))
         return public_dns_names
 
+    @staticmethod
+    def _build_instance_filters(filters: List[Dict[str, Union[str, List[str]]]] = None,
+                                state: List[str] = None,
+                                tags: Dict[str, Union[str, List[str]]] = None) \
+            -> List[Dict[str, Union[str, List[str]]]]:
+        """Builds the server-side filter list for an instance query.
+
+        Args:
+            filters (List[Dict[str, Union[str, List[str]]]]): Any caller-provided filters.
+            state (List[str]): A list of possible instance states.
+            tags (Dict[str, Union[str, List[str]]]): Tag keys mapped to the value (or values)
+            the instances must have.
+
+        Returns:
+            List[Dict[str, Union[str, List[str]]]]: The filters to send with the query.
+        """
+        query_filters = list(filters or [])
+        if state:
+            query_filters.append(
+                {'Name': 'instance-state-name', 'Values': [_.lower() for _ in state]})
+        for tag_key, tag_values in (tags or {}).items():
+            query_filters.append({
+                'Name': f'tag:{tag_key}',
+                'Values': [tag_values] if isinstance(tag_values, str) else list(tag_values)
+            })
+        return query_filters
+
     @staticmethod
     def _get_instances_value(reservation: dict = None) -> List[dict]:
         """
@@ -229,13 +277,14 @@ class AWSInstance(AWSBase):
 
     @staticmethod
     def wait_for_socket_on_instance(dns_name: str = None, port: int = 3389,
-                                    retries: int = 10) -> None:
+                                    retries: int = 10, probe_timeout: float = 5) -> None:
         """Wait for a socket to become available on a system at the specified DNS address.
 
         Args:
-            dns_name:
-            port:
-            retries:
+            dns_name: The DNS name of the system.
+            port: The port which must accept connections.
+            retries: The number of 5 second intervals to wait for.
+            probe_timeout: The time (seconds) allowed for each connection attempt.
 
         Returns:
             None
@@ -243,29 +292,16 @@ class AWSInstance(AWSBase):
         Raises:
             ConnectionError
         """
-        for retry_count in range(retries):
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex((dns_name, 3389))
-            sock.close()
-            if result == 0:
-                print("Port is open, continuing...")
-                break
-
-            print("Port is not open, retrying...")
-            time.sleep(5)
+        wait_for_hosts_ready([dns_name], port=port, probe_timeout=probe_timeout,
+                             timeout=retries * 5, initial_interval=5, max_interval=5)
 
-            if retry_count >= retries - 1:
-                raise ConnectionError(
-                    'Retries exceeded.  Unable to connect to the specified port: {}.'.format(
-                        port
-                    ))
-
-    # pylint: disable=too-many-arguments
     def cleanup_instances(self, instance_ids: List[str] = None,
                           filters: List[Dict[str, Union[str, List[str]]]] = None,
                           date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
                           state: List[str] = None, do_terminate: bool = False,
-                          do_wait: bool = True) -> List[str]:
+                          do_wait: bool = True,
+                          chunk_size: int = INSTANCE_ACTION_CHUNK_SIZE,
+                          max_workers: int = 4) -> List[str]:
         """
 
         Args:
@@ -275,43 +311,86 @@ class AWSInstance(AWSBase):
             state:
             do_terminate:
             do_wait:
+            chunk_size: The number of instances per TerminateInstances / StopInstances call.
+            max_workers: The number of chunks submitted concurrently.
 
         Returns:
 
+        Raises:
+            BulkOperationError: If any chunk failed.  The instances in the other chunks are still
+            terminated (or stopped) and waited on first.
         """
         instance_objects = self.get_instance_objects(
             instance_ids=instance_ids, filters=filters, date_range=date_range, state=state,
-            newest_only=False)
+            newest_only=False, hydrate=False)
 
         if len(instance_objects) == 0:
             LOGGER.write('No matching instance objects were found for cleanup.')
             return []
 
-        _instance_ids = []
-        for instance_object in instance_objects:
-            LOGGER.write(
-                f'Instance {instance_object.instance_id} will be '
-                f'{"terminated" if do_terminate else "stopped"}.'
-            )
-            _instance_ids.append(instance_object.instance_id)
-            if do_terminate:
-                instance_object.terminate()
-            else:
-                instance_object.stop()
+        _instance_ids = [_.instance_id for _ in instance_objects]
+        LOGGER.write(
+            f'Instances {_instance_ids} will be {"terminated" if do_terminate else "stopped"}.')
+        _instance_ids, failures = self.run_instance_action_in_chunks(
+            action='terminate_instances' if do_terminate else 'stop_instances',
+            instance_ids=_instance_ids, chunk_size=chunk_size, max_workers=max_workers)
+        self.invalidate_describe_results(kinds=[INSTANCES], resource_ids=_instance_ids)
 
-        if do_wait:
+        if do_wait and _instance_ids:
             LOGGER.write(
                 'Waiting for instances to {}.'.format('terminate' if do_terminate else 'stop'))
-            if do_terminate:
-                waiter = self.ec2_client.get_waiter('instance_terminated')
-            else:
-                waiter = self.ec2_client.get_waiter('instance_stopped')
-
-            waiter.wait(InstanceIds=_instance_ids, WaiterConfig={'Delay': 30, 'MaxAttempts': 999})
+            self.wait_for_instance_state(
+                instance_ids=_instance_ids, state=['terminated' if do_terminate else 'stopped'])
+            self.invalidate_describe_results(kinds=[INSTANCES], resource_ids=_instance_ids)
             LOGGER.write('Instance operations completed.')
 
+        if failures:
+            raise BulkOperationError(
+                f'{len(failures)} chunk(s) failed while trying to '
+                f'{"terminate" if do_terminate else "stop"} instances: {failures}', failures)
+
         return _instance_ids
 
+    def run_instance_action_in_chunks(self, action: str, instance_ids: List[str],
+                                      chunk_size: int = INSTANCE_ACTION_CHUNK_SIZE,
+                                      max_workers: int = 4) \
+            -> Tuple[List[str], List[Dict[str, Any]]]:
+        """Run a bulk EC2 instance action (e.g. terminate_instances) on chunks of instances.
+
+        The chunks are submitted concurrently.  A failing call fails only its own chunk, as EC2
+        rejects a whole call if any one of its instances is invalid.
+
+        Args:
+            action (str): The name of the EC2 client method, which must accept InstanceIds.
+            instance_ids (List[str]): The Ids of the instances.
+            chunk_size (int): The number of instances per call.
+            max_workers (int): The number of chunks submitted concurrently.
+
+        Returns:
+            Tuple[List[str], List[Dict[str, Any]]]: The Ids of the instances in the successful
+            chunks, and the failed chunks as {'ResourceIds': [...], 'Error': '<error>'} dicts.
+        """
+        chunks = [instance_ids[_:_ + chunk_size] for _ in range(0, len(instance_ids), chunk_size)]
+        client_method = getattr(self.ec2_client, action)
+
+        def _run_chunk(chunk: List[str]) -> Optional[Dict[str, Any]]:
+            try:
+                self._validate_response_status(client_method(InstanceIds=chunk))
+            except (ClientError, AWSHTTPStatusError) as ex:
+                LOGGER.write(f'{action} failed for {chunk}: {ex}', 'error')
+                return {'ResourceIds': chunk, 'Error': str(ex)}
+            return None
+
+        succeeded_ids = []
+        failures = []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            for chunk, failure in zip(chunks, executor.map(_run_chunk, chunks)):
+                if failure is None:
+                    succeeded_ids.extend(chunk)
+                else:
+                    failures.append(failure)
+        return succeeded_ids, failures
+
     # pylint: disable=too-many-arguments
     # pylint: disable=too-many-locals
     # pylint: disable=too-many-branches
@@ -353,8 +432,7 @@ class AWSInstance(AWSBase):
             _instance_objects = self.get_instance_objects(
                 filters=filters, date_range=date_range, state=state, newest_only=False)
 
-        created_images = []
-        created_image_ids = []
+        image_requests = []
         for i, instance_object in enumerate(_instance_objects):
             if image_name_desc is not None and len(image_name_desc) > i \
                     and 'Name' in image_name_desc[i]:
@@ -372,32 +450,42 @@ class AWSInstance(AWSBase):
                 name = 'auto-gen-' + str(uuid.uuid4())
                 description = ''
 
-            created_image = instance_object.create_image(
-                Name=name, Description=description, **kwargs)
-            created_images.append(created_image)
-            created_image_ids.append(created_image.image_id)
-
+            # The copied and new tags are applied by CreateImage itself (new tags win).
+            image_tags = []
             if tags_to_copy is not None and len(tags_to_copy) > 0:
-                tag_objects = [_ for _ in instance_object.tags if _['Key'] in tags_to_copy]
-                if tag_objects is not None and len(tag_objects) > 0:
-                    created_image.create_tags(Tags=tag_objects)
-
+                image_tags.extend(
+                    [_ for _ in instance_object.tags or [] if _['Key'] in tags_to_copy])
             if tags_to_create is not None and len(tags_to_create) > 0:
-                created_image.create_tags(Tags=tags_to_create)
+                image_tags.extend(tags_to_create)
+
+            image_request = dict(
+                InstanceId=instance_object.instance_id, Name=name, Description=description,
+                **kwargs)
+            tag_specifications = self.make_image_tag_specifications(image_tags)
+            if tag_specifications:
+                image_request['TagSpecifications'] = tag_specifications
+            image_requests.append(image_request)
 
-        if do_wait and len(_instance_objects) > 0:
+        created_image_ids, failures = self.create_images_concurrently(image_requests)
+        self.invalidate_describe_results(kinds=[IMAGES, TAGS], resource_ids=created_image_ids)
+
+        if do_wait and len(created_image_ids) > 0:
             LOGGER.write('AMIs being created: ' + ', '.join(created_image_ids))
-            LOGGER.write('Sleeping for a bit so the waiter sees the target instances.')
-            time.sleep(10)
             LOGGER.write('Waiting for images to become available.')
-            waiter = self.ec2_client.get_waiter('image_available')
-            waiter.wait(ImageIds=created_image_ids, WaiterConfig={'Delay': 30, 'MaxAttempts': 999})
+            self.wait_for_images_available(created_image_ids)
+            self.invalidate_describe_results(kinds=[IMAGES, TAGS], resource_ids=created_image_ids)
             LOGGER.write('Images available.')
 
+        if failures:
+            raise BulkOperationError(
+                f'CreateImage failed for {len(failures)} instance(s) (created images: '
+                f'{created_image_ids}): {failures}', failures)
+
         if return_only_ids:
             return created_image_ids
 
-        return created_images
+        # pylint: disable=no-member
+        return [self.ec2_resource.Image(_) for _ in created_image_ids]
 
     # pylint: disable=too-many-arguments
     # pylint: disable=too-many-locals
@@ -456,12 +544,12 @@ class AWSInstance(AWSBase):
         created_instance_ids = []
         for instance in instances:
             created_instance_ids.append(instance.id)
+        self.invalidate_describe_results(kinds=ALL_KINDS, resource_ids=created_instance_ids)
 
         if do_wait:
             LOGGER.write('Waiting for instances to load...')
-            waiter = self.ec2_client.get_waiter('instance_status_ok')
-            waiter.wait(
-                InstanceIds=created_instance_ids, WaiterConfig={'Delay': 30, 'MaxAttempts': 999})
+            self.wait_for_instance_status_ok(instance_ids=created_instance_ids)
+            self.invalidate_describe_results(kinds=[INSTANCES], resource_ids=created_instance_ids)
             LOGGER.write('Instances loaded.')
 
         if return_only_ids:
@@ -469,10 +557,13 @@ class AWSInstance(AWSBase):
 
         return instances
 
+    # pylint: disable=too-many-arguments
     def describe_instance_ids(self, filters: List[Dict[str, Union[str, List[str]]]] = None,
                               date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
                               state: List[str] = None,
-                              newest_only: bool = False) -> Union[List[str], str]:
+                              newest_only: bool = False,
+                              tags: Dict[str, Union[str, List[str]]] = None) \
+            -> Union[List[str], str]:
         """
 
         Args:
@@ -480,13 +571,15 @@ class AWSInstance(AWSBase):
             date_range:
             state:
             newest_only:
+            tags:
 
         Returns:
 
         """
         # NOTE: Querying with empty Filters and / or InstanceIds returns all instances.
         filtered_instances = self.describe_instances(
-            filters=filters, date_range=date_range, state=state, newest_only=newest_only)
+            filters=filters, date_range=date_range, state=state, newest_only=newest_only,
+            tags=tags)
 
         if isinstance(filtered_instances, list):
             if len(filtered_instances) > 0:
@@ -541,70 +634,150 @@ class AWSInstance(AWSBase):
         return [filtered_instances['PublicDnsName']]
 
     # pylint: disable=too-many-arguments
-    # pylint: disable=too-many-branches
     def describe_instances(self, instance_ids: List[str] = None,
                            filters: List[Dict[str, Union[str, List[str]]]] = None,
                            date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
                            state: List[str] = None,
-                           newest_only: bool = True) -> Union[List[Dict], Dict]:
-        """
+                           newest_only: bool = True,
+                           tags: Dict[str, Union[str, List[str]]] = None) \
+            -> Union[List[Dict], Dict]:
+        """Gets the instances matching a query as a list (or the newest one as a dict).
+
+        This is a list-returning wrapper around iter_instances, so every result page is
+        included.  Results are served from the local inventory (if this object has one) or from
+        the region's describe cache while they are fresh; use iter_instances directly to always
+        query EC2.
 
         Args:
-            filters:
-            instance_ids:
-            date_range:
-            state:
-            newest_only:
+            instance_ids (List[str]): A set of instance Ids to use for the query.
+            filters (List[Dict[str, Union[str, List[str]]]]): A set of filters to use for the
+            query.
+            date_range (Tuple[datetime.date, Optional[datetime.date]]): A launch date range to
+            use for the query.  If there's only one date, set the 2nd value to None.
+            state (List[str]): A list of possible instance states for the query.
+            newest_only (bool): Whether or not to only return the newest out of all returned
+            instances.
+            tags (Dict[str, Union[str, List[str]]]): Tag keys mapped to the value (or values)
+            the instances must have.
 
         Returns:
-
+            Union[List[Dict], Dict]: A list of instance dicts, or the newest instance dict.
         """
-        # NOTE: Querying with empty Filters and / or InstanceIds returns all instances.
-        response = self.ec2_client.describe_instances(
-            Filters=filters or [], InstanceIds=instance_ids or [])
-        self._validate_response_status(response)
-
-        if state is not None and len(state) > 0:
-            state = [_.lower() for _ in state]
-
-        filtered_instances = []
-        # pylint: disable=too-many-nested-blocks
-        for reservation in self._get_reservations_value(response):
-            for instance in self._get_instances_value(reservation):
-                if date_range is not None:
-                    start_date, end_date = self._parse_date_range(date_range)
-                    launch_date = self._get_launch_date_value(instance)
-                    if launch_date >= start_date and end_date is not None:
-                        if launch_date <= end_date:
-                            if state is not None and len(state) > 0:
-                                if self._get_state_name_value(instance).lower() in state:
-                                    filtered_instances.append(instance)
-                            else:
-                                filtered_instances.append(instance)
-                    elif launch_date >= start_date:
-                        if state is not None and len(state) > 0:
-                            if self._get_state_name_value(instance).lower() in state:
-                                filtered_instances.append(instance)
-                        else:
-                            filtered_instances.append(instance)
-                else:
-                    if state is not None and len(state) > 0:
-                        if self._get_state_name_value(instance).lower() in state:
-                            filtered_instances.append(instance)
-                    else:
-                        filtered_instances.append(instance)
+        if self.inventory is not None:
+            inventory_instances = self._describe_instances_from_inventory(
+                instance_ids=instance_ids, filters=filters, date_range=date_range, state=state,
+                tags=tags)
+            if inventory_instances is not None:
+                if newest_only and len(inventory_instances) > 0:
+                    return self._get_newest_instance(inventory_instances)
+                return inventory_instances
+
+        filtered_instances = list(self.describe_cache.get_or_load(
+            INSTANCES,
+            self.describe_cache.make_key(
+                instance_ids=instance_ids, filters=filters, date_range=date_range, state=state,
+                tags=tags),
+            loader=lambda: list(self.iter_instances(
+                instance_ids=instance_ids, filters=filters, date_range=date_range, state=state,
+                tags=tags)),
+            resource_ids_func=lambda instances: [_['InstanceId'] for _ in instances] + list(
+                instance_ids or []),
+            pinned=bool(instance_ids)
+        ))
 
         if newest_only and len(filtered_instances) > 0:
             return self._get_newest_instance(filtered_instances)
 
         return filtered_instances
 
+    # pylint: disable=too-many-arguments
+    def _describe_instances_from_inventory(
+            self, instance_ids: List[str] = None,
+            filters: List[Dict[str, Union[str, List[str]]]] = None,
+            date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
+            state: List[str] = None,
+            tags: Dict[str, Union[str, List[str]]] = None) -> Optional[List[Dict]]:
+        """Answer an instance query from the local inventory.
+
+        Returns:
+            Optional[List[Dict]]: The matching instance dicts, or None if the inventory cannot
+            answer the query.
+        """
+        instances = self.inventory.find(
+            self.ec2_client, INSTANCES, resource_ids=instance_ids,
+            filters=self._build_instance_filters(filters=filters, state=state, tags=tags))
+        if instances is None or date_range is None:
+            return instances
+
+        start_date, end_date = self._parse_date_range(date_range)
+        return [
+            _ for _ in instances
+            if start_date <= self._get_launch_date_value(_)
+            and (end_date is None or self._get_launch_date_value(_) <= end_date)
+        ]
+
+    # pylint: disable=too-many-arguments
+    def iter_instances(self, instance_ids: List[str] = None,
+                       filters: List[Dict[str, Union[str, List[str]]]] = None,
+                       date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
+                       state: List[str] = None,
+                       tags: Dict[str, Union[str, List[str]]] = None,
+                       page_size: int = None) -> Iterator[Dict]:
+        """Lazily yields the instances matching a query, following every result page.
+
+        The state and tag criteria are sent to EC2 as server-side filters, so only matching
+        instances are returned by the service.  The launch date range is the only criterion
+        which is checked locally, and it is parsed once per query.
+
+        NOTE: Querying with empty Filters and / or InstanceIds returns all instances.
+
+        Args:
+            instance_ids (List[str]): A set of instance Ids to use for the query.
+            filters (List[Dict[str, Union[str, List[str]]]]): A set of filters to use for the
+            query.
+            date_range (Tuple[datetime.date, Optional[datetime.date]]): A launch date range to
+            use for the query.  If there's only one date, set the 2nd value to None.
+            state (List[str]): A list of possible instance states for the query.
+            tags (Dict[str, Union[str, List[str]]]): Tag keys mapped to the value (or values)
+            the instances must have.
+            page_size (int): (OPTIONAL) The number of instances to request per page.  This is
+            ignored when instance_ids are provided as EC2 does not allow both.
+
+        Yields:
+            Dict: An instance dict.
+        """
+        start_date, end_date = None, None
+        if date_range is not None:
+            start_date, end_date = self._parse_date_range(date_range)
+
+        pagination_config = {}
+        if page_size and not instance_ids:
+            pagination_config['PageSize'] = page_size
+
+        paginator = self.ec2_client.get_paginator('describe_instances')
+        pages = paginator.paginate(
+            Filters=self._build_instance_filters(filters=filters, state=state, tags=tags),
+            InstanceIds=instance_ids or [],
+            PaginationConfig=pagination_config
+        )
+        for page in pages:
+            self._validate_response_status(page)
+            for reservation in self._get_reservations_value(page):
+                for instance in self._get_instances_value(reservation):
+                    if start_date is not None:
+                        launch_date = self._get_launch_date_value(instance)
+                        if launch_date < start_date \
+                                or (end_date is not None and launch_date > end_date):
+                            continue
+                    yield instance
+
     # pylint: disable=too-many-arguments
     def get_instance_objects(self, instance_ids: List[str] = None,
                              filters: List[Dict[str, Union[str, List[str]]]] = None,
                              date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
                              state: List[str] = None,
-                             newest_only: bool = True) -> Union[List[Any], dict]:
+                             newest_only: bool = True,
+                             hydrate: bool = True) -> Union[List[Any], Any]:
         """
 
         Args:
@@ -613,67 +786,71 @@ class AWSInstance(AWSBase):
             date_range:
             state:
             newest_only:
+            hydrate: Whether to load the data of all the instance objects up front from one
+            (paginated) describe query.  Otherwise, each object runs its own describe call the
+            first time one of its attributes is read.
 
         Returns:
 
         """
-        _instance_ids = []
         if instance_ids is not None and len(instance_ids) > 0:
-            _instance_ids = instance_ids
-        elif filters is not None and len(filters) > 0:
-            _instance_ids = self.describe_instance_ids(
-                filters=filters, date_range=date_range, state=state, newest_only=newest_only)
-        elif date_range is not None and isinstance(date_range, tuple):
-            _instance_ids = self.describe_instance_ids(
-                date_range=date_range, state=state, newest_only=newest_only)
-        elif state is not None and len(state) > 0:
-            _instance_ids = self.describe_instance_ids(state=state, newest_only=newest_only)
-        else:
+            if not hydrate:
+                # pylint: disable=no-member
+                return [self.ec2_resource.Instance(_) for _ in instance_ids]
+
+            try:
+                instances = self.describe_instances(instance_ids=instance_ids, newest_only=False)
+            except ClientError as ex:
+                if ex.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                    raise
+                instances = []
+            # pylint: disable=no-member
+            return self._hydrate_resource_objects(
+                self.ec2_resource.Instance, instances, 'InstanceId', resource_ids=instance_ids)
+
+        if not (filters is not None and len(filters) > 0) \
+                and not (date_range is not None and isinstance(date_range, tuple)) \
+                and not (state is not None and len(state) > 0):
             raise TypeError('You must provide a valid list of instance ids.')
 
-        # In the case where we only get a single instance Id back (instead of a list),
-        # just return a single instance object.
-        if isinstance(_instance_ids, str):
-            if len(_instance_ids) > 0:
-                # pylint: disable=no-member
-                return self.ec2_resource.Instance(_instance_ids)
+        instances = self.describe_instances(
+            filters=filters or None,
+            date_range=date_range if isinstance(date_range, tuple) else None,
+            state=state,
+            newest_only=newest_only
+        )
 
-            return []
+        # In the case where we only get the newest instance back (instead of a list),
+        # just return a single instance object.
+        is_newest_only = isinstance(instances, dict)
+        if is_newest_only:
+            instances = [instances]
 
-        instances = []
-        for instance_id in _instance_ids:
+        if hydrate:
+            # pylint: disable=no-member
+            instance_objects = self._hydrate_resource_objects(
+                self.ec2_resource.Instance, instances, 'InstanceId')
+        else:
             # pylint: disable=no-member
-            instances.append(self.ec2_resource.Instance(instance_id))
+            instance_objects = [self.ec2_resource.Instance(_['InstanceId']) for _ in instances]
 
-        return instances
+        return instance_objects[0] if is_newest_only else instance_objects
 
-    def get_instances_with_expired_termination_date(self) -> List[str]:
+    def get_instances_with_expired_termination_date(
+            self, cutoff_date: Optional[datetime.date] = None) -> List[str]:
         """Returns a list of instances whose TerminationDate tag value is <= today().
 
         If no matches are found, an empty list will be returned.
 
+        Args:
+            cutoff_date (Optional[datetime.date]): (OPTIONAL) The date to compare against.
+            Defaults to today().
+
         Returns:
             List[str]: A list of instance Ids (or an empty list).
         """
-        # Query for all instance having a TerminateDate value.
-        instances_with_termination_date = self.describe_instance_ids(
-            filters=[{'Name': 'tag-key', 'Values': ['TerminationDate']}],
-            state=DEFAULT_QUERY_INSTANCE_STATES
-        )
-
-        # Of the instances with a TerminationDate, query for the value of their TerminationDate.
-        tag_data = self.get_resource_tag_data(
-            resource_ids=instances_with_termination_date,
-            tag_keys=['TerminationDate']
-        )
-
-        # Of the instances with a TerminationDate, find those whose date is <= today's date.
-        instances_to_terminate: List[str] = []
-        for tag_value in tag_data['Tags']:
-            if tag_value['Value']:
-                termination_date = datetime.strptime(tag_value['Value'], '%Y-%m-%d').date()
-                if termination_date <= datetime.today().date():
-                    instances_to_terminate.append(tag_value['ResourceId'])
+        instances_to_terminate = list(
+            self.iter_instances_with_expired_termination_date(cutoff_date=cutoff_date))
 
         if instances_to_terminate:
             LOGGER.write(f'Found {len(instances_to_terminate)} instances needing termination:'
@@ -682,6 +859,83 @@ class AWSInstance(AWSBase):
             LOGGER.write('No instances were found in need of stopping or terminating.')
         return instances_to_terminate
 
+    def iter_instances_with_expired_termination_date(
+            self, cutoff_date: Optional[datetime.date] = None,
+            chunk_size: int = DESCRIBE_TAGS_MAX_FILTER_VALUES) -> Iterator[str]:
+        """Lazily yields the instances whose TerminationDate tag value is <= the cutoff date.
+
+        The instances having a TerminationDate tag are streamed page by page, and their tag
+        values are queried in chunks of chunk_size instances as the pages arrive, so memory use
+        stays flat however many instances are tagged.
+
+        Args:
+            cutoff_date (Optional[datetime.date]): (OPTIONAL) The date to compare against.
+            Defaults to today().
+            chunk_size (int): The number of instances per describe_tags query.
+
+        Yields:
+            str: An instance Id.
+        """
+        # Compute the cutoff once; ISO dates compare correctly as strings.
+        cutoff = (cutoff_date or datetime.today().date()).isoformat()
+
+        def _iter_instance_id_chunks() -> Iterator[List[str]]:
+            chunk: List[str] = []
+            for instance in self.iter_instances(
+                    filters=[{'Name': 'tag-key', 'Values': ['TerminationDate']}],
+                    state=DEFAULT_QUERY_INSTANCE_STATES, page_size=1000):
+                chunk.append(instance['InstanceId'])
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        for instance_ids in _iter_instance_id_chunks():
+            for tag in self.iter_resource_tags(instance_ids, ['TerminationDate']):
+                termination_date = self._normalize_tag_date(tag['Value'])
+                if termination_date is not None and termination_date <= cutoff:
+                    yield tag['ResourceId']
+
+    @staticmethod
+    def _normalize_tag_date(value: str) -> Optional[str]:
+        """Convert a %Y-%m-%d tag value to an ISO date string (None if empty or invalid)."""
+        if not value:
+            return None
+        try:
+            # Zero-padded dates are parsed (and validated) much faster by fromisoformat.
+            if len(value) == 10 and value[4] == value[7] == '-':
+                return datetime.fromisoformat(value).date().isoformat()
+            return datetime.strptime(value, '%Y-%m-%d').date().isoformat()
+        except ValueError:
+            LOGGER.write(f'Ignoring an invalid TerminationDate tag value: {value}', 'error')
+            return None
+
+    def iter_resource_tags(self, resource_ids: List[str], tag_keys: List[str],
+                           chunk_size: int = DESCRIBE_TAGS_MAX_FILTER_VALUES) -> Iterator[Dict]:
+        """Lazily yields the tag records of many resources, following every result page.
+
+        The resource Ids are queried in chunks, as describe_tags allows at most
+        DESCRIBE_TAGS_MAX_FILTER_VALUES values per filter.
+
+        Args:
+            resource_ids (List[str]): A list of resource Ids to query.
+            tag_keys (List[str]): A list of tag key names.
+            chunk_size (int): The number of resource Ids per query.
+
+        Yields:
+            Dict: A tag record ({'Key', 'Value', 'ResourceId', 'ResourceType'}).
+        """
+        paginator = self.ec2_client.get_paginator('describe_tags')
+        for index in range(0, len(resource_ids), chunk_size):
+            for page in paginator.paginate(
+                    Filters=[
+                        {'Name': 'resource-id',
+                         'Values': resource_ids[index:index + chunk_size]},
+                        {'Name': 'tag-key', 'Values': tag_keys}
+                    ]):
+                yield from page['Tags']
+
     def get_resource_tag_data(self, resource_ids: List[str],
                               tag_keys: List[str]) -> Dict[str, Any]:
         """Gets the value of the specified tags for a specified list of instance Ids.
@@ -701,26 +955,22 @@ class AWSInstance(AWSBase):
                             'ResourceId': (str)'<resource id>',
                             'ResourceType': (str)'<type of resource>'
                         }
-                    ],
-                    'ResponseMetadata': {
-                        'RequestId': (str)'<request id>',
-                        'HTTPStatusCode': (int)<status_code>
-                        'HTTPHeaders': (dict: 4){<header dict>},
-                        'RetryAttempts': (int)<retry count>
-                    }
+                    ]
                 }
+            The tags of every result page (and of every chunk of resource Ids) are included.
         """
-        return self.ec2_client.describe_tags(
-            Filters=[
-                {'Name': 'resource-id', 'Values': resource_ids},
-                {'Name': 'tag-key', 'Values': tag_keys}
-            ]
+        return self.describe_cache.get_or_load(
+            TAGS,
+            self.describe_cache.make_key(resource_ids=resource_ids, tag_keys=tag_keys),
+            loader=lambda: {'Tags': list(self.iter_resource_tags(resource_ids, tag_keys))},
+            resource_ids_func=lambda _: resource_ids,
+            pinned=True
         )
 
     def reboot_instances(self, instance_ids: List[str] = None,
                          filters: List[Dict[str, Union[str, List[str]]]] = None,
                          date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
-                         do_wait: bool = True) -> None:
+                         do_wait: bool = True, reboot_timeout: float = 600) -> None:
         """
 
         Args:
@@ -728,6 +978,8 @@ class AWSInstance(AWSBase):
             instance_ids:
             date_range:
             do_wait:
+            reboot_timeout: The time (seconds) allowed for all instances to accept RDP
+            connections again.  All instances are probed concurrently.
 
         Returns:
 
@@ -741,28 +993,50 @@ class AWSInstance(AWSBase):
         else:
             raise TypeError('You must provide a valid list of instance ids.')
 
-        dns_names = self.private_dns_names_to_public(
-            self.describe_instance_dns_names(_instance_ids, newest_only=False)
-        )
+        dns_names = [
+            _['PublicDnsName'] for _ in self.map_instance_ids_to_dns_names(_instance_ids).values()
+        ]
         LOGGER.write(f'Rebooting the following instances: {dns_names}')
         self.ec2_client.reboot_instances(InstanceIds=_instance_ids)
+        self.invalidate_describe_results(kinds=[INSTANCES], resource_ids=_instance_ids)
 
         if do_wait:
             LOGGER.write('Waiting for instances to reboot...')
 
-            # Wait for a bit for the instance to start the reboot.  If you try to wait for the
-            # socket before the instance has started rebooting, then the socket will be found
-            # and the waiter will think the system's rebooted already.
-            time.sleep(30)
-            for dns_name in dns_names:
-                LOGGER.write(f'Waiting for instance {dns_name} to reboot.')
-                self.wait_for_socket_on_instance(dns_name=dns_name)
-                LOGGER.write(f'Instance {dns_name} rebooted.')
+            # Wait (up to 30 seconds) for the instances to start the reboot.  If you try to wait
+            # for the socket before the instance has started rebooting, then the socket will be
+            # found and the waiter will think the system's rebooted already.
+            self._wait_for_sockets_to_close(dns_names=dns_names, timeout=30)
+            wait_for_hosts_ready(dns_names, port=3389, timeout=reboot_timeout)
+            LOGGER.write(f'Instances rebooted: {dns_names}')
+
+    def _wait_for_sockets_to_close(self, dns_names: List[str], port: int = 3389,
+                                   timeout: float = 30) -> None:
+        """Wait until a port stops accepting connections on all hosts, or until the timeout.
+
+        This is used to detect that a reboot has started; reaching the timeout is not an error.
+
+        Args:
+            dns_names (List[str]): The hosts to check.
+            port (int): The port to check.
+            timeout (float): The most time (seconds) to wait.
+        """
+        def _open_hosts() -> List[str]:
+            return [host for host, is_open in check_ports(dns_names, port).items() if is_open]
+
+        waiter = self.make_waiter(initial_delay=2, max_delay=5, timeout=timeout,
+                                   description=f'port {port} to close on {dns_names}')
+        try:
+            waiter.wait(_open_hosts, is_done=lambda open_hosts: not open_hosts)
+        except TimeoutError:
+            LOGGER.write(f'Port {port} did not close on all of {dns_names} within {timeout} '
+                         'seconds; continuing.')
 
     # pylint: disable=too-many-arguments
     # pylint: disable=too-many-locals
     # pylint: disable=too-many-branches
     # pylint: disable=too-many-statements
+    @traced('ssm', name='ssm.send_commands', attribute_args=('instance_ids', 'document_name'))
     def send_commands(self, instance_ids: List[str] = None,
                       filters: List[Dict[str, Union[str, List[str]]]] = None,
                       date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
@@ -771,7 +1045,13 @@ class AWSInstance(AWSBase):
                       total_command_run_time: int = 600,
                       log_error_as_warning: bool = False,
                       return_standard_output: bool = False,
-                      platform_type: str = 'Windows') -> Optional[str]:
+                      platform_type: str = 'Windows',
+                      return_instance_results: bool = False,
+                      output_s3_bucket_name: str = None,
+                      output_s3_key_prefix: str = '',
+                      output_callback: Callable[[Dict[str, str]], None] = None,
+                      document_name: str = None) \
+            -> Optional[Union[str, Dict[str, Dict[str, Any]]]]:
         """
 
         Args:
@@ -786,6 +1066,16 @@ class AWSInstance(AWSBase):
             log_error_as_warning:
             return_standard_output:
             platform_type:
+            return_instance_results: If True, the invocations of all target instances are
+            polled together (see wait_for_command_invocations) and the per-instance result map
+            is returned instead of the first output seen.
+            output_s3_bucket_name: (OPTIONAL) An S3 bucket to upload the full command output
+            to.  The output is then streamed from S3 while the command runs (see
+            stream_command_output) rather than read, truncated, from SSM.
+            output_s3_key_prefix: The S3 key prefix of the output.
+            output_callback: (OPTIONAL) Called with each output chunk streamed from S3.
+            document_name: (OPTIONAL) A registered SSM document (without parameters) to run
+            instead of commands (see remote_batch.RemoteBatch.register_document).
 
         Returns:
 
@@ -804,39 +1094,54 @@ class AWSInstance(AWSBase):
             return None
 
         _document_name = ''
-        if platform_type == 'Windows':
+        _parameters = {'Parameters': {'commands': commands}}
+        if document_name:
+            _document_name = document_name
+            _parameters = {}
+        elif platform_type == 'Windows':
             _document_name = 'AWS-RunPowerShellScript'
         elif platform_type == 'Linux':
             _document_name = 'AWS-RunShellScript'
 
         # If there's a problem when trying to run a command (such as when the instance hasn't
         # properly been added to the AWS Session Manager, then try waiting and/or (on every 3rd
-        # try) rebooting the instance.
+        # failure) rebooting the instance.  Throttling only ever causes a wait: rebooting would
+        # not help, and would interrupt whatever the instances are running.
         response: Dict[str, Any] = {}
+        retry_waiter = self.make_waiter(initial_delay=10, max_delay=60)
+        failure_count = 0
+        output_location: Dict[str, str] = {}
+        if output_s3_bucket_name:
+            output_location = {'OutputS3BucketName': output_s3_bucket_name,
+                               'OutputS3KeyPrefix': output_s3_key_prefix or ''}
         for try_number in range(retry_count):
             try:
                 response = self.ssm_client.send_command(
                     InstanceIds=_instance_ids,
                     DocumentName=_document_name,
-                    Parameters={
-                        'commands': commands
-                    }
+                    **_parameters,
+                    **output_location
                 )
                 break
             except ClientError as ex:
-                LOGGER.write(ex, 'exception')
-                raise
+                if not is_throttling_error(ex) or try_number == retry_count - 1:
+                    LOGGER.write(ex, 'exception')
+                    raise
+                LOGGER.write('Sending the command was throttled.  Waiting for a bit before '
+                             'retry # {}...'.format(try_number + 1))
+                self.clock.sleep(retry_waiter.backoff_delay(try_number))
             except Exception as ex:  # pylint: disable=broad-except
                 if try_number < retry_count - 1:
                     LOGGER.write('An error occurred while sending a command.  Retry # '
                                  '{}'.format(try_number))
 
-                    if try_number % 3 == 0:
+                    failure_count += 1
+                    if failure_count % 3 == 0:
                         LOGGER.write('Rebooting instances before retrying.')
                         self.reboot_instances(instance_ids=instance_ids)
 
                     LOGGER.write('Waiting for a bit before the retry...')
-                    time.sleep(60)
+                    self.clock.sleep(retry_waiter.backoff_delay(try_number))
                 else:
                     LOGGER.write('The following exception was raised when running the command: '
                                  '{}'.format(str(ex)), 'exception')
@@ -846,8 +1151,43 @@ class AWSInstance(AWSBase):
             LOGGER.write('Not waiting for command invocation to complete.')
             return None
 
-        # Wait a little bit for the invocation to resolve.
-        time.sleep(3)
+        if return_instance_results or output_s3_bucket_name:
+            if output_s3_bucket_name:
+                instance_results = self.stream_command_output(
+                    command_id=response['Command']['CommandId'],
+                    instance_ids=_instance_ids,
+                    bucket_name=output_s3_bucket_name,
+                    key_prefix=output_s3_key_prefix,
+                    callback=output_callback,
+                    total_command_run_time=total_command_run_time
+                )
+            else:
+                instance_results = self.wait_for_command_invocations(
+                    command_id=response['Command']['CommandId'],
+                    instance_ids=_instance_ids,
+                    total_command_run_time=total_command_run_time
+                )
+            for instance_id, result in instance_results.items():
+                if result['StandardErrorContent']:
+                    LOGGER.write(
+                        f'Instance {instance_id} StandardErrorContent: '
+                        f'{result["StandardErrorContent"]}',
+                        'warning' if log_error_as_warning else 'error')
+                if result['Status'] != 'Success':
+                    LOGGER.write(
+                        f'One or more commands did not succeed on instance {instance_id} '
+                        f'({result["Status"]}).  Commands: {commands}', 'error')
+            if return_instance_results:
+                return instance_results
+
+            # Return what the polling loop below would have: the first standard output (if
+            # requested), else the first standard error.
+            for result in instance_results.values():
+                if return_standard_output and result['StandardOutputContent']:
+                    return result['StandardOutputContent']
+                if result['StandardErrorContent']:
+                    return result['StandardErrorContent']
+            return None
 
         # Poll the status of the commands until they're completed on all instances.
         # If there's a non-pass result on an instance, then update the step to reflect it.
@@ -857,24 +1197,30 @@ class AWSInstance(AWSBase):
         command_id = response['Command']['CommandId']
         all_done = False
         instance_command_statuses = [{'Id': _, 'Completed': False} for _ in _instance_ids]
-        wait_start_time = time.time()
+        waiter = self.make_waiter(
+            initial_delay=1, max_delay=5, multiplier=1.5, timeout=total_command_run_time,
+            description=f'command {command_id}').start()
         while not all_done:
-            if time.time() - wait_start_time > total_command_run_time:
-                LOGGER.write('Total command run time exceeded!', 'error')
-                raise TimeoutError('Total command run time exceeded!')
-
             all_done = True
+            statuses = []
             for instance_command_status in instance_command_statuses:
                 if instance_command_status['Completed']:
                     continue
 
-                output = self.ssm_client.get_command_invocation(
-                    CommandId=command_id,
-                    InstanceId=instance_command_status['Id']
-                )
+                try:
+                    output = self.ssm_client.get_command_invocation(
+                        CommandId=command_id,
+                        InstanceId=instance_command_status['Id']
+                    )
+                except self.ssm_client.exceptions.InvocationDoesNotExist:
+                    # The invocation has not been created on the instance yet.
+                    all_done = False
+                    statuses.append('Pending')
+                    continue
+                statuses.append(output['Status'])
                 LOGGER.write(
                     f'Instance {instance_command_status["Id"]} Status: {output["Status"]}  '
-                    f'Command Run Time: {timedelta(seconds=time.time() - wait_start_time)}'
+                    f'Command Run Time: {timedelta(seconds=waiter.elapsed)}'
                 )
 
                 if output['StandardOutputContent'] != '':
@@ -917,7 +1263,245 @@ class AWSInstance(AWSBase):
                     instance_command_status['Completed'] = True
 
             if not all_done:
-                time.sleep(5)
+                try:
+                    waiter.sleep(progress=statuses)
+                except TimeoutError:
+                    LOGGER.write('Total command run time exceeded!', 'error')
+                    raise TimeoutError('Total command run time exceeded!')
+
+    def list_command_invocation_results(self, command_id: str) -> Dict[str, Dict[str, Any]]:
+        """Gets the status and output of every target of a command with one paginated query.
+
+        Args:
+            command_id (str): The Id of the SSM command.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: A dict keyed by instance Id.  It has the following
+            structure:
+                {
+                    '<instance id>': {
+                        'Status': (str)'<Pending|InProgress|Delayed|Success|...>',
+                        'StatusDetails': (str)'<detailed status>',
+                        'ResponseCode': (int)<exit code, or -1 if not finished>,
+                        'StandardOutputContent': (str)'<stdout>',
+                        'StandardErrorContent': (str)'<stderr>',
+                        'OutputTruncated': (bool)<whether the output was truncated>
+                    }
+                }
+        """
+        results: Dict[str, Dict[str, Any]] = {}
+        paginator = self.ssm_client.get_paginator('list_command_invocations')
+        for page in paginator.paginate(CommandId=command_id, Details=True):
+            for invocation in page['CommandInvocations']:
+                results[invocation['InstanceId']] = self._parse_command_invocation(invocation)
+        return results
+
+    @staticmethod
+    def _parse_command_invocation(invocation: Dict[str, Any]) -> Dict[str, Any]:
+        """Flattens a list_command_invocations entry into a per-instance result dict.
+
+        Args:
+            invocation (Dict[str, Any]): A CommandInvocations item (queried with Details=True).
+
+        Returns:
+            Dict[str, Any]: See list_command_invocation_results.
+        """
+        standard_output: List[str] = []
+        standard_error: List[str] = []
+        response_code = -1
+        output_truncated = False
+        for plugin in invocation.get('CommandPlugins', []):
+            output = plugin.get('Output', '') or ''
+            output_truncated |= len(output) >= LIST_INVOCATIONS_OUTPUT_LIMIT
+            stdout, _, stderr = output.partition(PLUGIN_OUTPUT_ERROR_SEPARATOR)
+            if stdout.strip():
+                standard_output.append(stdout.strip())
+            if stderr.strip():
+                standard_error.append(stderr.strip())
+            if plugin.get('ResponseCode', -1) != -1:
+                response_code = plugin['ResponseCode']
+
+        return {
+            'Status': invocation['Status'],
+            'StatusDetails': invocation.get('StatusDetails', ''),
+            'ResponseCode': response_code,
+            'StandardOutputContent': '\n'.join(standard_output),
+            'StandardErrorContent': '\n'.join(standard_error),
+            'OutputTruncated': output_truncated
+        }
+
+    # pylint: disable=too-many-arguments
+    def wait_for_command_invocations(self, command_id: str, instance_ids: List[str],
+                                     total_command_run_time: int = 600,
+                                     initial_poll_interval: float = 1.0,
+                                     max_poll_interval: float = 15.0) \
+            -> Dict[str, Dict[str, Any]]:
+        """Polls every target of a command together until all of them are finished.
+
+        Each poll is one paginated list_command_invocations call, no matter how many instances
+        are targeted.  The poll interval starts at initial_poll_interval and grows by 50% each
+        time no invocation changes status (up to max_poll_interval); it resets on any change.
+        Invocations which are not listed yet are treated as pending.  Instances whose output
+        was truncated by the list query get a single get_command_invocation call once they
+        are finished.
+
+        Args:
+            command_id (str): The Id of the SSM command.
+            instance_ids (List[str]): The instances targeted by the command.
+            total_command_run_time (int): The total time (seconds) allowed for the command to
+            finish on all instances.
+            initial_poll_interval (float): The first delay (seconds) between polls.
+            max_poll_interval (float): The longest delay (seconds) between polls.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The results keyed by instance Id (in the order of
+            instance_ids).  See list_command_invocation_results for the structure.
+
+        Raises:
+            TimeoutError
+        """
+        waiter = self.make_waiter(
+            initial_delay=initial_poll_interval, max_delay=max_poll_interval, multiplier=1.5,
+            timeout=total_command_run_time, description=f'command {command_id}').start()
+        previous_statuses: Dict[str, str] = {}
+        while True:
+            results = self.list_command_invocation_results(command_id)
+            statuses = {_: results[_]['Status'] if _ in results else 'Pending'
+                        for _ in instance_ids}
+            if statuses != previous_statuses:
+                LOGGER.write(
+                    f'Command {command_id} statuses: {statuses}  Command Run Time: '
+                    f'{timedelta(seconds=waiter.elapsed)}')
+            previous_statuses = statuses
+
+            if all(_ in TERMINAL_COMMAND_STATUSES for _ in statuses.values()):
+                break
+
+            try:
+                waiter.sleep(progress=statuses)
+            except TimeoutError:
+                LOGGER.write('Total command run time exceeded!', 'error')
+                raise TimeoutError('Total command run time exceeded!')
+
+        for instance_id in instance_ids:
+            if results[instance_id]['OutputTruncated']:
+                output = self.ssm_client.get_command_invocation(
+                    CommandId=command_id, InstanceId=instance_id)
+                results[instance_id]['StandardOutputContent'] = \
+                    output['StandardOutputContent'].strip()
+                results[instance_id]['StandardErrorContent'] = \
+                    output['StandardErrorContent'].strip()
+
+        return {_: results[_] for _ in instance_ids}
+
+    # pylint: disable=too-many-arguments
+    def iter_command_output(self, command_id: str, instance_ids: List[str],
+                            output_stream: S3CommandOutputStream,
+                            total_command_run_time: int = 600,
+                            initial_poll_interval: float = 1.0,
+                            max_poll_interval: float = 15.0) -> Iterator[Dict[str, str]]:
+        """Yields the S3 output of a command as it is uploaded, until the command is finished.
+
+        The command's statuses are polled as in wait_for_command_invocations, and after each
+        status poll the S3 output of the unfinished instances is read.  Once every invocation
+        is finished, the output of all instances is read one last time.
+
+        Args:
+            command_id (str): The Id of the SSM command (sent with an S3 output location).
+            instance_ids (List[str]): The instances targeted by the command.
+            output_stream (S3CommandOutputStream): The stream of the command's S3 output.
+            total_command_run_time (int): The total time (seconds) allowed for the command to
+            finish on all instances.
+            initial_poll_interval (float): The first delay (seconds) between polls.
+            max_poll_interval (float): The longest delay (seconds) between polls.
+
+        Yields:
+            Dict[str, str]: The output chunks (see S3CommandOutputStream.poll).
+
+        Raises:
+            TimeoutError
+        """
+        waiter = self.make_waiter(
+            initial_delay=initial_poll_interval, max_delay=max_poll_interval, multiplier=1.5,
+            timeout=total_command_run_time, description=f'command {command_id}').start()
+        chunk_count = 0
+        while True:
+            results = self.list_command_invocation_results(command_id)
+            statuses = {_: results[_]['Status'] if _ in results else 'Pending'
+                        for _ in instance_ids}
+            all_done = all(_ in TERMINAL_COMMAND_STATUSES for _ in statuses.values())
+
+            for instance_id in instance_ids:
+                if statuses[instance_id] == 'Pending':
+                    continue
+                for chunk in output_stream.poll(instance_id):
+                    chunk_count += 1
+                    yield chunk
+
+            if all_done:
+                return
+
+            try:
+                # New output counts as progress, so the poll interval stays short while the
+                # command is writing.
+                waiter.sleep(progress=(statuses, chunk_count))
+            except TimeoutError:
+                LOGGER.write('Total command run time exceeded!', 'error')
+                raise TimeoutError('Total command run time exceeded!')
+
+    # pylint: disable=too-many-arguments
+    def stream_command_output(self, command_id: str, instance_ids: List[str],
+                              bucket_name: str, key_prefix: str = '',
+                              callback: Callable[[Dict[str, str]], None] = None,
+                              total_command_run_time: int = 600) -> Dict[str, Dict[str, Any]]:
+        """Streams the S3 output of a command while it runs, then returns its full results.
+
+        Args:
+            command_id (str): The Id of the SSM command (sent with an S3 output location).
+            instance_ids (List[str]): The instances targeted by the command.
+            bucket_name (str): The S3 bucket of the command's output.
+            key_prefix (str): The S3 key prefix of the command's output.
+            callback (Callable[[Dict[str, str]], None]): (OPTIONAL) Called with each output
+            chunk (see S3CommandOutputStream.poll).  By default each chunk is logged.
+            total_command_run_time (int): The total time (seconds) allowed for the command to
+            finish on all instances.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: The results keyed by instance Id (see
+            list_command_invocation_results), with the full, untruncated output from S3.  If
+            nothing was read from S3 for an instance (e.g. its role cannot write to the
+            bucket), its (possibly truncated) SSM output is kept and a warning is logged.
+
+        Raises:
+            TimeoutError
+        """
+        output_stream = S3CommandOutputStream(
+            self.s3_client, bucket_name, key_prefix, command_id)
+        for chunk in self.iter_command_output(command_id, instance_ids, output_stream,
+                                              total_command_run_time=total_command_run_time):
+            if callback is not None:
+                callback(chunk)
+            else:
+                LOGGER.write(f'[{chunk["InstanceId"]} {chunk["Stream"]}] '
+                             f'{chunk["Content"].rstrip()}')
+
+        results = self.list_command_invocation_results(command_id)
+        for instance_id in instance_ids:
+            result = results[instance_id]
+            if not output_stream.has_output(instance_id):
+                if result['StandardOutputContent'] or result['StandardErrorContent']:
+                    LOGGER.write(
+                        f'No output of command {command_id} was found under '
+                        f's3://{bucket_name}/{output_stream.instance_prefix(instance_id)}, so '
+                        f'the SSM output of {instance_id} (which may be truncated) is kept.  '
+                        f'Check that the instance can write to the bucket.', 'warning')
+                continue
+            result['StandardOutputContent'] = \
+                output_stream.get_output(instance_id, 'stdout').strip()
+            result['StandardErrorContent'] = \
+                output_stream.get_output(instance_id, 'stderr').strip()
+            result['OutputTruncated'] = False
+        return {_: results[_] for _ in instance_ids}
 
     def create_or_update_tag_value(self, resource_ids: List[str],
                                    tags: List[Dict[str, str]]) -> None:
@@ -936,22 +1520,31 @@ class AWSInstance(AWSBase):
             Resources=resource_ids,
             Tags=tags
         )
+        self.invalidate_describe_results(kinds=ALL_KINDS, resource_ids=resource_ids)
         self._validate_response_status(response)
 
+    # pylint: disable=too-many-arguments
     def wait_for_instance_state(self, instance_ids: List[str] = None,
                                 filters: List[Dict[str, Union[str, List[str]]]] = None,
                                 date_range: Tuple[datetime.date, Optional[datetime.date]] = None,
-                                state: List[str] = None) -> None:
-        """
+                                state: List[str] = None, timeout: float = 3600) -> None:
+        """Wait for all the instances to reach one of the given states.
+
+        The wait ends early with a WaiterFailedError if an instance is terminated while waiting
+        for any other state.
 
         Args:
             filters:
             date_range:
             instance_ids:
-            state:
+            state: The acceptable states (defaults to ['running']).
+            timeout: The total time (seconds) allowed.
 
         Returns:
 
+        Raises:
+            TimeoutError
+            WaiterFailedError
         """
         _instance_ids = []
         if instance_ids is not None and len(instance_ids) > 0:
@@ -961,19 +1554,75 @@ class AWSInstance(AWSBase):
         else:
             raise TypeError('You must provide a valid list of instance ids.')
 
-        waiting = True
-        while waiting:
-            waiting = False
-            status_object = self.ec2_client.describe_instance_status(
-                InstanceIds=_instance_ids or []
-            )
-            for instance in status_object['InstanceStatuses']:
-                if instance['InstanceState']['Name'] not in (state or ['running']):
-                    waiting = True
-                    break
+        target_states = state or ['running']
+        waiter = self.make_waiter(initial_delay=5, max_delay=30, timeout=timeout,
+                                   description=f'instances to be {target_states}')
+        waiter.wait(
+            lambda: self._describe_instance_statuses(_instance_ids),
+            is_done=lambda statuses: all(
+                statuses.get(_, {}).get('InstanceState', {}).get('Name') in target_states
+                for _ in _instance_ids),
+            is_failed=lambda statuses: 'terminated' not in target_states and any(
+                _['InstanceState']['Name'] == 'terminated' for _ in statuses.values()),
+            progress=lambda statuses: {
+                _: status['InstanceState']['Name'] for _, status in statuses.items()}
+        )
+
+    def wait_for_instance_status_ok(self, instance_ids: List[str],
+                                    timeout: float = 3600) -> None:
+        """Wait for all the instances to pass their instance and system status checks.
+
+        The wait ends early with a WaiterFailedError if an instance is shutting down or
+        terminated.
+
+        Args:
+            instance_ids (List[str]): The instances to wait for.
+            timeout (float): The total time (seconds) allowed.
+
+        Raises:
+            TimeoutError
+            WaiterFailedError
+        """
+        def _is_ok(status: Dict[str, Any]) -> bool:
+            return status.get('InstanceStatus', {}).get('Status') == 'ok' \
+                and status.get('SystemStatus', {}).get('Status') == 'ok'
+
+        waiter = self.make_waiter(initial_delay=10, max_delay=30, timeout=timeout,
+                                   description=f'status checks to pass on {instance_ids}')
+        waiter.wait(
+            lambda: self._describe_instance_statuses(instance_ids),
+            is_done=lambda statuses: all(_is_ok(statuses.get(_, {})) for _ in instance_ids),
+            is_failed=lambda statuses: any(
+                _['InstanceState']['Name'] in ('shutting-down', 'terminated')
+                for _ in statuses.values()),
+            progress=lambda statuses: {_: _is_ok(status) for _, status in statuses.items()}
+        )
+
+    def _describe_instance_statuses(self, instance_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Gets the status of every instance (in any state), keyed by instance Id.
+
+        Instances which EC2 does not know about yet (shortly after launch) are omitted.  The
+        Ids are queried in chunks of DESCRIBE_INSTANCE_STATUS_MAX_IDS.
+
+        Args:
+            instance_ids (List[str]): The instances to query.
 
-            if waiting:
-                time.sleep(10)
+        Returns:
+            Dict[str, Dict[str, Any]]: The InstanceStatuses items keyed by instance Id.
+        """
+        statuses: Dict[str, Dict[str, Any]] = {}
+        paginator = self.ec2_client.get_paginator('describe_instance_status')
+        for index in range(0, len(instance_ids), DESCRIBE_INSTANCE_STATUS_MAX_IDS):
+            try:
+                for page in paginator.paginate(
+                        InstanceIds=instance_ids[index:index + DESCRIBE_INSTANCE_STATUS_MAX_IDS],
+                        IncludeAllInstances=True):
+                    for status in page['InstanceStatuses']:
+                        statuses[status['InstanceId']] = status
+            except ClientError as ex:
+                if ex.response.get('Error', {}).get('Code') != 'InvalidInstanceID.NotFound':
+                    raise
+        return statuses
 
     def public_dns_names_to_ids(self, instance_dns_names: List[str]) -> List[str]:
         """Takes in a list of instance public DNS names and returns a list of instance Id strings.
@@ -982,13 +1631,77 @@ class AWSInstance(AWSBase):
             instance_dns_names (List[str]): A list of public DNS names to query.
 
         Returns:
-            List[str]: A list of instance Id strings.
+            List[str]: A list of instance Id strings, in the order of the provided DNS names.
+            Names which did not resolve to an instance are omitted.
         """
-        return self.describe_instance_ids(
-            filters=[
+        return [_ for _ in self.map_public_dns_names_to_ids(instance_dns_names).values() if _]
+
+    def map_instance_ids_to_dns_names(self, instance_ids: List[str],
+                                      public_dns_suffix: str = 'aws.natinst.com') \
+            -> Dict[str, Dict[str, str]]:
+        """Resolves the DNS names of many instances with a single describe call.
+
+        Args:
+            instance_ids (List[str]): The instance Ids to resolve.
+            public_dns_suffix (str): The suffix for the public DNS name (defaults to
+            aws.natinst.com).
+
+        Returns:
+            Dict[str, Dict[str, str]]: A dict keyed by instance Id, in the order of the provided
+            instance Ids.  It has the following structure:
                 {
-                    'Name': 'private-dns-name',
-                    'Values': self.public_dns_names_to_private(instance_dns_names)
+                    '<instance id>': {
+                        'PrivateDnsName': (str)'<name>.ec2.internal',
+                        'PublicDnsName': (str)'<name>.<public_dns_suffix>'
+                    }
                 }
-            ]
-        )
+        """
+        validate_args_for_value(instance_ids=instance_ids)
+        instances_by_id = {
+            _['InstanceId']: _ for _ in self.describe_instances(
+                instance_ids=instance_ids, newest_only=False)
+        }
+
+        dns_names: Dict[str, Dict[str, str]] = {}
+        for instance_id in instance_ids:
+            private_dns_name = instances_by_id[instance_id]['PrivateDnsName']
+            dns_names[instance_id] = {
+                'PrivateDnsName': private_dns_name,
+                'PublicDnsName': self.private_dns_names_to_public(
+                    [private_dns_name], public_dns_suffix=public_dns_suffix)[0]
+            }
+        return dns_names
+
+    def map_public_dns_names_to_ids(self, public_dns_names: List[str],
+                                    public_dns_suffix: str = 'aws.natinst.com') \
+            -> Dict[str, Optional[str]]:
+        """Resolves the instance Ids of many public DNS names with a single describe call.
+
+        If more than one instance has had the same private DNS name (i.e., a terminated instance
+        and its replacement), then non-terminated instances win, followed by the newest launch.
+
+        Args:
+            public_dns_names (List[str]): The public DNS names to resolve.
+            public_dns_suffix (str): The suffix for the public DNS name (defaults to
+            aws.natinst.com).
+
+        Returns:
+            Dict[str, Optional[str]]: A dict mapping each public DNS name (in the order provided)
+            to its instance Id, or to None if no instance was found.
+        """
+        validate_args_for_value(public_dns_names=public_dns_names)
+        private_dns_names = self.public_dns_names_to_private(
+            public_dns_names, public_dns_suffix=public_dns_suffix)
+        instances = self.describe_instances(
+            filters=[{'Name': 'private-dns-name', 'Values': private_dns_names}],
+            newest_only=False)
+
+        # Sort so that the preferred instance for each private DNS name is seen last.
+        instances = sorted(instances, key=lambda _: (
+            self._get_state_name_value(_) != 'terminated', self._get_launch_time_value(_)))
+        ids_by_private_name = {_['PrivateDnsName']: _['InstanceId'] for _ in instances}
+
+        return {
+            public_dns_name: ids_by_private_name.get(private_dns_name)
+            for public_dns_name, private_dns_name in zip(public_dns_names, private_dns_names)
+        }
@@ -0,0 +1,306 @@
+"""
+aws_inventory.py
+
+This module holds an opt-in local inventory of EC2 instances, images and tags, stored in SQLite.
+
+The inventory answers the questions the ATS asks over and over (the newest base AMI, the
+instances with a given tag, DNS name to Id mappings, etc.) without calling EC2.  Each kind of
+resource is re-synced whenever it is older than the freshness bound (max_age).  EC2 has no
+"changed since" query, so a sync lists the resources again (following every page) but only
+writes the rows whose content changed and removes the rows of resources which are gone.
+
+Typical use:
+
+    inventory = AWSInventory('~/.syslinkats/inventory.sqlite', region_name='us-east-1')
+    aws_instance = AWSInstance(region_name='us-east-1', inventory=inventory)
+"""
+__author__ = 'sedwards'
+
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from syslinkats.data.common.aws_default_parameters import DEFAULT_INVENTORY_MAX_AGE
+from syslinkats.framework.aws.aws_describe_cache import IMAGES, INSTANCES, TAGS
+from syslinkats.framework.logging.auto_indent import AutoIndent
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS resources (
+    resource_id TEXT PRIMARY KEY,
+    region TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    state TEXT,
+    sort_time TEXT,
+    name TEXT,
+    private_dns_name TEXT,
+    public_dns_name TEXT,
+    digest TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resources_state ON resources (region, kind, state);
+CREATE INDEX IF NOT EXISTS resources_sort_time ON resources (region, kind, sort_time);
+CREATE INDEX IF NOT EXISTS resources_private_dns ON resources (private_dns_name);
+CREATE INDEX IF NOT EXISTS resources_public_dns ON resources (public_dns_name);
+CREATE TABLE IF NOT EXISTS tags (
+    resource_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (resource_id, key)
+);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+CREATE TABLE IF NOT EXISTS sync_state (
+    region TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (region, kind)
+);
+'''
+
+# The columns which EC2 filter names map to (per kind of resource).
+_FILTER_COLUMNS = {
+    INSTANCES: {
+        'instance-id': 'resource_id',
+        'instance-state-name': 'state',
+        'private-dns-name': 'private_dns_name',
+        'network-interface.private-dns-name': 'private_dns_name',
+        'dns-name': 'public_dns_name',
+    },
+    IMAGES: {
+        'image-id': 'resource_id',
+        'state': 'state',
+        'name': 'name',
+    }
+}
+
+
+def _encode_value(value: Any) -> Any:
+    """JSON-encode the datetimes in describe results so they can be restored on load."""
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    return str(value)
+
+
+def _decode_object(obj: Dict[str, Any]) -> Any:
+    """Restore the datetimes encoded by _encode_value."""
+    if len(obj) == 1 and '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+def _glob_pattern(value: str) -> str:
+    """Convert an EC2 filter value (with * and ? wildcards) to an SQLite GLOB pattern."""
+    return value.replace('[', '[[]')
+
+
+class AWSInventory:
+    """A thread-safe SQLite inventory of the instances and images of one region."""
+
+    def __init__(self, db_path: str = ':memory:', region_name: str = None,
+                 max_age: float = DEFAULT_INVENTORY_MAX_AGE):
+        """Initialize the inventory.
+
+        Args:
+            db_path (str): The SQLite database file.  One file can hold many regions.
+            region_name (str): The AWS region of this inventory.
+            max_age (float): The freshness bound: the number of seconds after which a kind of
+            resource is re-synced before answering a query.
+        """
+        if db_path != ':memory:':
+            db_path = os.path.expanduser(db_path)
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.region_name = region_name
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
+
+    def synced_at(self, kind: str) -> Optional[float]:
+        """Get the time (time.time()) of the last sync of a kind, or None if never synced."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT synced_at FROM sync_state WHERE region = ? AND kind = ?',
+                (self.region_name, kind)).fetchone()
+        return row[0] if row else None
+
+    def is_fresh(self, kind: str) -> bool:
+        """Whether a kind of resource was synced within the freshness bound."""
+        synced_at = self.synced_at(kind)
+        return synced_at is not None and time.time() - synced_at < self.max_age
+
+    def mark_stale(self, kinds: Iterable[str]) -> None:
+        """Force the next query of the given kinds to re-sync first.
+
+        Args:
+            kinds (Iterable[str]): INSTANCES, IMAGES and / or TAGS (which marks both).
+        """
+        kinds = set(kinds)
+        if TAGS in kinds:
+            kinds.update((INSTANCES, IMAGES))
+        kinds.discard(TAGS)
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'DELETE FROM sync_state WHERE region = ? AND kind = ?',
+                [(self.region_name, _) for _ in kinds])
+
+    def ensure_fresh(self, ec2_client: Any, kind: str) -> None:
+        """Sync a kind of resource if it is older than the freshness bound."""
+        if not self.is_fresh(kind):
+            self.sync(ec2_client, kind)
+
+    def sync(self, ec2_client: Any, kind: str) -> Dict[str, int]:
+        """List every resource of a kind and apply the changes to the inventory.
+
+        Args:
+            ec2_client (Any): The EC2 client of the inventory's region.
+            kind (str): INSTANCES or IMAGES.
+
+        Returns:
+            Dict[str, int]: The number of resources added, updated, removed and unchanged.
+        """
+        start_time = time.time()
+        records = {
+            self._resource_id(kind, _): _ for _ in self._list_resources(ec2_client, kind)}
+
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        with self._lock, self._connection:
+            existing = dict(self._connection.execute(
+                'SELECT resource_id, digest FROM resources WHERE region = ? AND kind = ?',
+                (self.region_name, kind)))
+
+            removed_ids = [(_,) for _ in existing if _ not in records]
+            self._connection.executemany('DELETE FROM resources WHERE resource_id = ?', removed_ids)
+            self._connection.executemany('DELETE FROM tags WHERE resource_id = ?', removed_ids)
+            counts['removed'] = len(removed_ids)
+
+            for resource_id, record in records.items():
+                data = json.dumps(record, sort_keys=True, default=_encode_value)
+                digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+                if existing.get(resource_id) == digest:
+                    counts['unchanged'] += 1
+                    continue
+                counts['updated' if resource_id in existing else 'added'] += 1
+                self._write_resource(kind, resource_id, record, data, digest)
+
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sync_state (region, kind, synced_at) VALUES (?, ?, ?)',
+                (self.region_name, kind, start_time))
+
+        LOGGER.write(f'Synced the {self.region_name} {kind} inventory: {counts}')
+        return counts
+
+    def find(self, ec2_client: Any, kind: str, resource_ids: List[str] = None,
+             filters: List[Dict[str, Union[str, List[str]]]] = None) -> Optional[List[Dict]]:
+        """Answer a describe query from the inventory (syncing first if it is stale).
+
+        Args:
+            ec2_client (Any): The EC2 client used if a sync is needed.
+            kind (str): INSTANCES or IMAGES.
+            resource_ids (List[str]): (OPTIONAL) The Ids of the resources.
+            filters (List[Dict[str, Union[str, List[str]]]]): (OPTIONAL) EC2 filters.  Ids, states,
+            names, DNS names, tag:<key> and tag-key filters are supported.
+
+        Returns:
+            Optional[List[Dict]]: The describe records of the matching resources, or None if the
+            query cannot be answered locally (an unsupported filter, or an Id which is not in the
+            inventory) and EC2 must be asked instead.
+        """
+        where = self._build_where(kind, filters)
+        if where is None:
+            return None
+
+        self.ensure_fresh(ec2_client, kind)
+        clauses, params = where
+        if resource_ids:
+            clauses.append(f'resource_id IN ({", ".join("?" * len(resource_ids))})')
+            params.extend(resource_ids)
+
+        with self._lock:
+            rows = self._connection.execute(
+                f'SELECT resource_id, data FROM resources WHERE {" AND ".join(clauses)} '
+                'ORDER BY sort_time', params).fetchall()
+
+        if resource_ids and len(rows) < len(set(resource_ids)):
+            return None
+        return [json.loads(data, object_hook=_decode_object) for _, data in rows]
+
+    def _build_where(self, kind: str, filters: Optional[List[Dict[str, Union[str, List[str]]]]]) \
+            -> Optional[Tuple[List[str], List[Any]]]:
+        """Translate EC2 filters into SQL clauses (None if a filter is not supported)."""
+        clauses = ['region = ?', 'kind = ?']
+        params: List[Any] = [self.region_name, kind]
+        for query_filter in filters or []:
+            name = query_filter['Name']
+            values = query_filter['Values']
+            values = [values] if isinstance(values, str) else list(values)
+            if not values:
+                continue
+            value_clause = ' OR '.join(['{0} GLOB ?'] * len(values))
+
+            if name.startswith('tag:'):
+                clauses.append(
+                    'resource_id IN (SELECT resource_id FROM tags WHERE key = ? AND ('
+                    + value_clause.format('value') + '))')
+                params.append(name[len('tag:'):])
+            elif name == 'tag-key':
+                clauses.append('resource_id IN (SELECT resource_id FROM tags WHERE ('
+                               + value_clause.format('key') + '))')
+            elif name in _FILTER_COLUMNS[kind]:
+                clauses.append('(' + value_clause.format(_FILTER_COLUMNS[kind][name]) + ')')
+            else:
+                return None
+            params.extend(_glob_pattern(str(_)) for _ in values)
+        return clauses, params
+
+    @staticmethod
+    def _resource_id(kind: str, record: Dict[str, Any]) -> str:
+        """Get the Id of a describe record."""
+        return record['InstanceId'] if kind == INSTANCES else record['ImageId']
+
+    @staticmethod
+    def _list_resources(ec2_client: Any, kind: str) -> Iterator[Dict[str, Any]]:
+        """List every instance (or every image owned by the account) of the region."""
+        if kind == INSTANCES:
+            for page in ec2_client.get_paginator('describe_instances').paginate():
+                for reservation in page['Reservations']:
+                    yield from reservation['Instances']
+        elif kind == IMAGES:
+            yield from ec2_client.describe_images(Owners=['self'])['Images']
+        else:
+            raise ValueError(f'Unsupported inventory kind: {kind}')
+
+    def _write_resource(self, kind: str, resource_id: str, record: Dict[str, Any],
+                        data: str, digest: str) -> None:
+        """Insert or replace one resource and its tags (the caller holds the transaction)."""
+        if kind == INSTANCES:
+            state = record.get('State', {}).get('Name')
+            sort_time = record.get('LaunchTime')
+            sort_time = sort_time.isoformat() if isinstance(sort_time, datetime.datetime) \
+                else sort_time
+        else:
+            state = record.get('State')
+            sort_time = record.get('CreationDate')
+
+        self._connection.execute(
+            'INSERT OR REPLACE INTO resources (resource_id, region, kind, state, sort_time, '
+            'name, private_dns_name, public_dns_name, digest, data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (resource_id, self.region_name, kind, state, sort_time, record.get('Name'),
+             record.get('PrivateDnsName'), record.get('PublicDnsName'), digest, data))
+        self._connection.execute('DELETE FROM tags WHERE resource_id = ?', (resource_id,))
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO tags (resource_id, key, value) VALUES (?, ?, ?)',
+            [(resource_id, _['Key'], _['Value']) for _ in record.get('Tags', [])])
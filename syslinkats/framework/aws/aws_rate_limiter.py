@@ -0,0 +1,306 @@
+"""
+aws_rate_limiter.py
+
+This module holds a client-side rate limiter for AWS API calls.  Each API operation (for example
+ec2.DescribeInstances or ssm.SendCommand) draws from a token bucket before its request is sent,
+so bursts from many threads are smoothed out before AWS starts throttling them.
+
+By default the buckets are per process.  When a lock directory is given, the buckets are stored
+in files in that directory and shared (under a file lock) by every local process which uses the
+same directory, such as pytest-xdist workers or parallel Jenkins jobs on one agent.
+
+The limiter records the number of calls, throttled calls and the time spent waiting for tokens
+for each bucket.
+"""
+__author__ = 'sedwards'
+
+import fnmatch
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from syslinkats.data.common.aws_default_parameters import DEFAULT_API_RATE_LIMITS
+from syslinkats.framework.common.adaptive_waiter import get_default_clock
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt  # pylint: disable=import-error
+
+# The error codes with which AWS services report throttling.
+THROTTLING_ERROR_CODES = (
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+    'SlowDown'
+)
+
+
+def is_throttling_error(ex: BaseException) -> bool:
+    """Whether an exception is an AWS throttling error."""
+    return isinstance(ex, ClientError) \
+        and ex.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class TokenBucket:
+    """A thread-safe, in-process token bucket."""
+
+    def __init__(self, rate: float, capacity: float, clock: Any = None):
+        """Initialize the bucket (full).
+
+        Args:
+            rate (float): The number of tokens added per second.
+            capacity (float): The most tokens the bucket holds (the allowed burst).
+            clock (Any): An object with now() and sleep(seconds) methods.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock or get_default_clock()
+        self._tokens = capacity
+        self._updated = self.clock.now()
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Take a token if one is available; otherwise return the seconds until one is."""
+        with self._lock:
+            now = self.clock.now()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> float:
+        """Take a token, waiting for one if the bucket is empty.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        waited = 0.0
+        delay = self._take()
+        while delay > 0:
+            self.clock.sleep(delay)
+            waited += delay
+            delay = self._take()
+        return waited
+
+    def drain(self) -> None:
+        """Empty the bucket (after a throttling error) so that callers back off."""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = self.clock.now()
+
+
+class FileTokenBucket:
+    """A token bucket stored in a file, shared by every local process which uses the file.
+
+    The file is locked while the bucket is updated.  Wall-clock time is used, as monotonic
+    clocks are not comparable across processes, so this bucket always sleeps for real.
+    """
+
+    def __init__(self, path: str, rate: float, capacity: float):
+        """Initialize the bucket.
+
+        Args:
+            path (str): The bucket file.  It is created (full) if it does not exist.
+            rate (float): The number of tokens added per second.
+            capacity (float): The most tokens the bucket holds (the allowed burst).
+        """
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _update(self, take: bool) -> float:
+        """Refill the bucket and take a token (or drain it), holding the file lock.
+
+        Returns:
+            float: 0 if a token was taken; otherwise the seconds until one is available.
+        """
+        with open(self.path, 'a+') as bucket_file:
+            if fcntl is not None:
+                fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            else:
+                bucket_file.seek(0)
+                msvcrt.locking(bucket_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                bucket_file.seek(0)
+                try:
+                    state = json.loads(bucket_file.read())
+                except ValueError:
+                    state = {'tokens': self.capacity, 'updated': time.time()}
+
+                now = time.time()
+                tokens = min(self.capacity,
+                             state['tokens'] + max(0.0, now - state['updated']) * self.rate)
+                delay = 0.0
+                if not take:
+                    tokens = 0.0
+                elif tokens >= 1:
+                    tokens -= 1
+                else:
+                    delay = (1 - tokens) / self.rate
+
+                bucket_file.seek(0)
+                bucket_file.truncate()
+                bucket_file.write(json.dumps({'tokens': tokens, 'updated': now}))
+                bucket_file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(bucket_file, fcntl.LOCK_UN)
+                else:
+                    bucket_file.seek(0)
+                    msvcrt.locking(bucket_file.fileno(), msvcrt.LK_UNLCK, 1)
+        return delay
+
+    def acquire(self) -> float:
+        """Take a token, waiting for one if the bucket is empty.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        waited = 0.0
+        delay = self._update(take=True)
+        while delay > 0:
+            time.sleep(delay)
+            waited += delay
+            delay = self._update(take=True)
+        return waited
+
+    def drain(self) -> None:
+        """Empty the bucket (after a throttling error) so that every process backs off."""
+        self._update(take=False)
+
+
+class AWSRateLimiter:
+    """Per-operation token-bucket rate limiting for botocore clients.
+
+    Operations are matched against the rate limit patterns in order (for example
+    'ec2.Describe*' before 'ec2.*'), and all operations which match the same pattern share one
+    bucket.  A throttling error drains the bucket of the throttled operation, and the retry which
+    botocore makes of it waits for a token of its own (and is counted as a call).
+    """
+
+    def __init__(self, rate_limits: Dict[str, Tuple[float, float]] = None,
+                 lock_dir: Optional[str] = None, clock: Any = None):
+        """Initialize the limiter.
+
+        Args:
+            rate_limits (Dict[str, Tuple[float, float]]): Operation patterns
+            ('<service>.<Operation>', with * wildcards) mapped to (tokens per second, burst).
+            Operations which match no pattern are not limited.  Defaults to
+            DEFAULT_API_RATE_LIMITS.
+            lock_dir (Optional[str]): (OPTIONAL) A directory in which to share the buckets with
+            other local processes.
+            clock (Any): The clock of the in-process buckets (see adaptive_waiter).
+        """
+        self.rate_limits = dict(DEFAULT_API_RATE_LIMITS if rate_limits is None else rate_limits)
+        self.lock_dir = lock_dir
+        self.clock = clock
+        self._buckets: Dict[str, Any] = {}
+        self._patterns: Dict[str, Optional[str]] = {}
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def attach(self, client: Any) -> None:
+        """Rate limit every call made through a botocore client."""
+        client.meta.events.register('before-call', self._before_call)
+        client.meta.events.register('needs-retry', self._needs_retry)
+
+    def detach(self, client: Any) -> None:
+        """Stop rate limiting the calls of a botocore client."""
+        client.meta.events.unregister('before-call', self._before_call)
+        client.meta.events.unregister('needs-retry', self._needs_retry)
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """The calls, throttles, total wait time and longest wait (seconds) of each bucket."""
+        with self._lock:
+            return {key: dict(value) for key, value in self._stats.items()}
+
+    def acquire(self, operation: str) -> float:
+        """Take a token for an operation, waiting if its bucket is empty.
+
+        Args:
+            operation (str): The operation ('<service>.<Operation>').
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        pattern = self._match(operation)
+        if pattern is None:
+            return 0.0
+
+        waited = self._get_bucket(pattern).acquire()
+        with self._lock:
+            stats = self._get_stats(pattern)
+            stats['calls'] += 1
+            stats['wait_time'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+        return waited
+
+    def record_throttle(self, operation: str) -> None:
+        """Count a throttling error and drain the operation's bucket."""
+        pattern = self._match(operation)
+        if pattern is None:
+            return
+
+        self._get_bucket(pattern).drain()
+        with self._lock:
+            self._get_stats(pattern)['throttles'] += 1
+
+    def _match(self, operation: str) -> Optional[str]:
+        """Get (and remember) the first rate limit pattern which matches an operation."""
+        if operation not in self._patterns:
+            self._patterns[operation] = next(
+                (_ for _ in self.rate_limits if fnmatch.fnmatchcase(operation, _)), None)
+        return self._patterns[operation]
+
+    def _get_bucket(self, pattern: str) -> Any:
+        """Get (or create) the bucket of a rate limit pattern."""
+        with self._lock:
+            bucket = self._buckets.get(pattern)
+            if bucket is None:
+                rate, capacity = self.rate_limits[pattern]
+                if self.lock_dir:
+                    file_name = pattern.replace('*', '_all_').replace('?', '_any_') + '.bucket'
+                    bucket = FileTokenBucket(
+                        os.path.join(self.lock_dir, file_name), rate=rate, capacity=capacity)
+                else:
+                    bucket = TokenBucket(rate=rate, capacity=capacity, clock=self.clock)
+                self._buckets[pattern] = bucket
+            return bucket
+
+    def _get_stats(self, pattern: str) -> Dict[str, float]:
+        """Get (or create) the stats of a bucket (the caller holds the lock)."""
+        return self._stats.setdefault(
+            pattern, {'calls': 0, 'throttles': 0, 'wait_time': 0.0, 'max_wait': 0.0})
+
+    @staticmethod
+    def _operation_name(model: Any) -> str:
+        """Build the '<service>.<Operation>' name of an operation model."""
+        return f'{model.service_model.endpoint_prefix}.{model.name}'
+
+    def _before_call(self, model: Any, **_: Any) -> None:
+        """botocore before-call handler: wait for a token."""
+        self.acquire(self._operation_name(model))
+
+    def _needs_retry(self, operation: Any, response: Any = None, **_: Any) -> None:
+        """botocore needs-retry handler: count a throttled attempt and wait for a token.
+
+        botocore retries throttled calls itself, without firing before-call again, so the token
+        for the retry is taken here (after the throttle drained the bucket).  If botocore has no
+        retries left, the token is simply spent.
+        """
+        if response is None or not isinstance(response, tuple):
+            return
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code in THROTTLING_ERROR_CODES:
+            operation_name = self._operation_name(operation)
+            self.record_throttle(operation_name)
+            self.acquire(operation_name)
@@ -0,0 +1,320 @@
+"""
+aws_session_registry.py
+
+This module holds a process-wide registry of boto3 sessions and clients, keyed by region and
+profile.  Creating a boto3 client loads the botocore service model and resolves the credential
+chain (which can take seconds on EC2 hosts while the instance metadata service times out), so
+every AWSInstance and AWSImage object for the same region and profile shares one session and
+one client per service.  Clients are created on first use.
+
+botocore clients are thread-safe and are shared across threads.  boto3 resources are not, so
+resources are cached per thread.
+
+Every client (including the clients of resources) is rate limited by the registry's
+AWSRateLimiter, which can be replaced (for example with one shared across local processes)
+through set_rate_limiter.
+
+A record / replay cassette (see set_cassette) can record every call, or answer every call
+offline.
+
+Every API call is also recorded as an 'aws' span (see span_recorder), with the instance Ids it
+targets and its error code, if any, and is counted by the registry's AWSCallMetrics (call
+counts, latency histograms, retries and throttles per operation).
+"""
+__author__ = 'sedwards'
+
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+
+from syslinkats.data.common.aws_default_parameters import DEFAULT_MAX_POOL_CONNECTIONS
+from syslinkats.framework.aws.aws_call_metrics import AWSCallMetrics
+from syslinkats.framework.aws.aws_rate_limiter import AWSRateLimiter
+from syslinkats.framework.logging.span_recorder import SPAN_RECORDER
+
+# The request context key which holds the span of an API call.
+_SPAN_CONTEXT_KEY = 'syslinkats_span'
+# The arguments which configure a boto3 session.  Every other argument (endpoint_url, verify,
+# use_ssl, api_version, etc.) configures the clients and resources created from it.
+SESSION_ARGS = ('aws_access_key_id', 'aws_secret_access_key', 'aws_session_token',
+                'region_name', 'profile_name', 'botocore_session')
+
+
+class AWSSessionRegistry:
+    """A thread-safe registry of shared boto3 sessions, clients and resources."""
+
+    _lock = threading.RLock()
+    _sessions: Dict[Tuple, boto3.session.Session] = {}
+    _clients: Dict[Tuple, Any] = {}
+    _thread_resources = threading.local()
+    max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+    rate_limiter: Optional[AWSRateLimiter] = AWSRateLimiter()
+    call_metrics = AWSCallMetrics()
+    # The installed record / replay cassette (see network_utils.cassette), if any.
+    cassette: Optional[Any] = None
+
+    @classmethod
+    def set_rate_limiter(cls, rate_limiter: Optional[AWSRateLimiter]) -> None:
+        """Replace the rate limiter of every client, including the clients already created.
+
+        Args:
+            rate_limiter (Optional[AWSRateLimiter]): The new rate limiter.  None disables rate
+            limiting.
+        """
+        cls.rate_limiter = rate_limiter
+
+    @classmethod
+    def set_cassette(cls, cassette: Optional[Any]) -> None:
+        """Record or replay the calls of every client (including those already created).
+
+        Args:
+            cassette (Optional[Any]): The cassette (see network_utils.cassette).  None stops
+            recording or replaying.
+        """
+        cls.cassette = cassette
+
+    @classmethod
+    def _cassette_keep_key(cls, **kwargs: Any) -> None:
+        """botocore before-parameter-build handler which defers to the cassette."""
+        cassette = cls.cassette
+        if cassette is not None:
+            cassette._keep_key(**kwargs)  # pylint: disable=protected-access
+
+    @classmethod
+    def _cassette_before_call(cls, **kwargs: Any) -> Any:
+        """botocore before-call handler which answers replayed calls from the cassette."""
+        cassette = cls.cassette
+        if cassette is not None:
+            return cassette._before_call(**kwargs)  # pylint: disable=protected-access
+        return None
+
+    @classmethod
+    def _cassette_after_call(cls, **kwargs: Any) -> None:
+        """botocore after-call handler which records calls to the cassette."""
+        cassette = cls.cassette
+        if cassette is not None:
+            cassette._after_call(**kwargs)  # pylint: disable=protected-access
+
+    @classmethod
+    def _before_call(cls, **kwargs: Any) -> None:
+        """botocore before-call handler which defers to the current rate limiter."""
+        rate_limiter = cls.rate_limiter
+        if rate_limiter is not None:
+            rate_limiter._before_call(**kwargs)  # pylint: disable=protected-access
+
+    @classmethod
+    def _needs_retry(cls, **kwargs: Any) -> None:
+        """botocore needs-retry handler which defers to the current rate limiter."""
+        rate_limiter = cls.rate_limiter
+        if rate_limiter is not None:
+            rate_limiter._needs_retry(**kwargs)  # pylint: disable=protected-access
+
+    @classmethod
+    def _start_call_metrics(cls, **kwargs: Any) -> None:
+        """botocore before-call handler which defers to the call metrics."""
+        cls.call_metrics._before_call(**kwargs)  # pylint: disable=protected-access
+
+    @classmethod
+    def _end_call_metrics(cls, **kwargs: Any) -> None:
+        """botocore after-call handler which defers to the call metrics."""
+        cls.call_metrics._after_call(**kwargs)  # pylint: disable=protected-access
+
+    @classmethod
+    def _end_failed_call_metrics(cls, **kwargs: Any) -> None:
+        """botocore after-call-error handler which defers to the call metrics."""
+        cls.call_metrics._after_call_error(**kwargs)  # pylint: disable=protected-access
+
+    @classmethod
+    def _count_throttles(cls, **kwargs: Any) -> None:
+        """botocore needs-retry handler which defers to the call metrics."""
+        cls.call_metrics._needs_retry(**kwargs)  # pylint: disable=protected-access
+
+    @staticmethod
+    def _start_call_span(params: Dict[str, Any] = None, model: Any = None,
+                         context: Dict[str, Any] = None, **_: Any) -> None:
+        """botocore before-parameter-build handler which starts the span of an API call."""
+        if context is None or model is None:
+            return
+        params = params or {}
+        instance_ids = params.get('InstanceIds') or params.get('InstanceId')
+        attributes = {'InstanceIds': instance_ids} if instance_ids else {}
+        context[_SPAN_CONTEXT_KEY] = SPAN_RECORDER.start_span(
+            f'{model.service_model.service_name}.{model.name}', 'aws', **attributes)
+
+    @staticmethod
+    def _end_call_span(http_response: Any = None, parsed: Dict[str, Any] = None,
+                       context: Dict[str, Any] = None, **_: Any) -> None:
+        """botocore after-call handler which ends the span of an API call."""
+        span = (context or {}).pop(_SPAN_CONTEXT_KEY, None)
+        error = None
+        if http_response is not None and http_response.status_code >= 300:
+            error = (parsed or {}).get('Error', {}).get('Code') or http_response.status_code
+        SPAN_RECORDER.end_span(span, error=error)
+
+    @staticmethod
+    def _end_failed_call_span(exception: Exception = None, context: Dict[str, Any] = None,
+                              **_: Any) -> None:
+        """botocore after-call-error handler which ends the span of a failed API call."""
+        span = (context or {}).pop(_SPAN_CONTEXT_KEY, None)
+        SPAN_RECORDER.end_span(span, error=exception or 'error')
+
+    @classmethod
+    def _register_event_handlers(cls, client: Any) -> None:
+        """Route a new client's calls through the rate limiter, span recorder and call metrics.
+
+        The call metrics' before-call handler runs after the rate limiter's, so that the
+        latency does not include the time spent waiting for a token.  A replaying cassette
+        answers calls before either of them.
+        """
+        client.meta.events.register('before-parameter-build', cls._start_call_span)
+        client.meta.events.register('before-parameter-build', cls._cassette_keep_key)
+        client.meta.events.register('before-call', cls._cassette_before_call)
+        client.meta.events.register('before-call', cls._before_call)
+        client.meta.events.register('before-call', cls._start_call_metrics)
+        client.meta.events.register('needs-retry', cls._needs_retry)
+        client.meta.events.register('needs-retry', cls._count_throttles)
+        client.meta.events.register('after-call', cls._end_call_span)
+        client.meta.events.register('after-call', cls._end_call_metrics)
+        client.meta.events.register('after-call', cls._cassette_after_call)
+        client.meta.events.register('after-call-error', cls._end_failed_call_span)
+        client.meta.events.register('after-call-error', cls._end_failed_call_metrics)
+
+    @staticmethod
+    def split_kwargs(kwargs: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Split constructor kwargs into boto3 session arguments and client arguments.
+
+        Args:
+            kwargs (Dict[str, Any]): The kwargs (see SESSION_ARGS).
+
+        Returns:
+            Tuple[Dict[str, Any], Dict[str, Any]]: The session arguments and the client
+            arguments.
+        """
+        session_kwargs = {key: value for key, value in kwargs.items() if key in SESSION_ARGS}
+        client_kwargs = {key: value for key, value in kwargs.items() if key not in SESSION_ARGS}
+        return session_kwargs, client_kwargs
+
+    @staticmethod
+    def _session_key(region_name: Optional[str], profile_name: Optional[str],
+                     session_kwargs: Dict[str, Any]) -> Tuple:
+        """Build the registry key of a session."""
+        return region_name, profile_name, tuple(sorted(session_kwargs.items()))
+
+    @classmethod
+    def get_session(cls, region_name: Optional[str] = None, profile_name: Optional[str] = None,
+                    **session_kwargs: Any) -> boto3.session.Session:
+        """Get (or create) the shared session for a region and profile.
+
+        Args:
+            region_name (Optional[str]): The AWS region.  None uses the configured default.
+            profile_name (Optional[str]): The AWS credentials profile.  None uses the default.
+            **session_kwargs (Any): Other boto3.session.Session arguments (explicit keys, etc.;
+            see SESSION_ARGS).
+
+        Returns:
+            boto3.session.Session: The shared session.
+        """
+        key = cls._session_key(region_name, profile_name, session_kwargs)
+        with cls._lock:
+            session = cls._sessions.get(key)
+            if session is None:
+                session = boto3.session.Session(
+                    region_name=region_name, profile_name=profile_name, **session_kwargs)
+                cls._sessions[key] = session
+        return session
+
+    @classmethod
+    def _client_config(cls, config: Optional[Config],
+                       max_pool_connections: Optional[int]) -> Config:
+        """Merge the connection-pool size into a botocore Config."""
+        pool_config = Config(max_pool_connections=max_pool_connections or
+                             cls.max_pool_connections)
+        return pool_config if config is None else pool_config.merge(config)
+
+    # pylint: disable=too-many-arguments
+    @classmethod
+    def get_client(cls, service_name: str, region_name: Optional[str] = None,
+                   profile_name: Optional[str] = None, config: Optional[Config] = None,
+                   max_pool_connections: Optional[int] = None, **kwargs: Any) -> Any:
+        """Get (or create) the shared client of a service.
+
+        Args:
+            service_name (str): The AWS service (e.g. 'ec2' or 'ssm').
+            region_name (Optional[str]): The AWS region.  None uses the configured default.
+            profile_name (Optional[str]): The AWS credentials profile.  None uses the default.
+            config (Optional[Config]): (OPTIONAL) Additional botocore client configuration.
+            Clients with a custom configuration are not shared.
+            max_pool_connections (Optional[int]): The size of the client's HTTP connection pool.
+            Defaults to AWSSessionRegistry.max_pool_connections.
+            **kwargs (Any): Other boto3.session.Session arguments (see SESSION_ARGS) and
+            session.client arguments (e.g. endpoint_url or verify).
+
+        Returns:
+            Any: The botocore client.
+        """
+        session_kwargs, client_kwargs = cls.split_kwargs(kwargs)
+        session = cls.get_session(region_name, profile_name, **session_kwargs)
+        key = (service_name, max_pool_connections,
+               cls._session_key(region_name, profile_name, session_kwargs),
+               tuple(sorted(client_kwargs.items())))
+        with cls._lock:
+            client = None if config is not None else cls._clients.get(key)
+            if client is None:
+                # Sessions are not thread-safe, so creation is serialized.
+                client = session.client(
+                    service_name, config=cls._client_config(config, max_pool_connections),
+                    **client_kwargs)
+                cls._register_event_handlers(client)
+                if config is None:
+                    cls._clients[key] = client
+        return client
+
+    # pylint: disable=too-many-arguments
+    @classmethod
+    def get_resource(cls, service_name: str, region_name: Optional[str] = None,
+                     profile_name: Optional[str] = None, config: Optional[Config] = None,
+                     max_pool_connections: Optional[int] = None, **kwargs: Any) -> Any:
+        """Get (or create) the calling thread's resource of a service.
+
+        Args:
+            service_name (str): The AWS service (e.g. 'ec2').
+            region_name (Optional[str]): The AWS region.  None uses the configured default.
+            profile_name (Optional[str]): The AWS credentials profile.  None uses the default.
+            config (Optional[Config]): (OPTIONAL) Additional botocore client configuration.
+            Resources with a custom configuration are not cached.
+            max_pool_connections (Optional[int]): The size of the HTTP connection pool.
+            **kwargs (Any): Other boto3.session.Session arguments (see SESSION_ARGS) and
+            session.resource arguments (e.g. endpoint_url or verify).
+
+        Returns:
+            Any: The boto3 service resource.
+        """
+        session_kwargs, client_kwargs = cls.split_kwargs(kwargs)
+        session = cls.get_session(region_name, profile_name, **session_kwargs)
+        key = (service_name, max_pool_connections,
+               cls._session_key(region_name, profile_name, session_kwargs),
+               tuple(sorted(client_kwargs.items())))
+        if getattr(cls._thread_resources, 'resources', None) is None:
+            cls._thread_resources.resources = {}
+        resources = cls._thread_resources.resources
+        resource = None if config is not None else resources.get(key)
+        if resource is None:
+            # Sessions are not thread-safe, so creation is serialized.
+            with cls._lock:
+                resource = session.resource(
+                    service_name, config=cls._client_config(config, max_pool_connections),
+                    **client_kwargs)
+                cls._register_event_handlers(resource.meta.client)
+            if config is None:
+                resources[key] = resource
+        return resource
+
+    @classmethod
+    def clear(cls) -> None:
+        """Drop every shared session and client (and the calling thread's resources)."""
+        with cls._lock:
+            cls._sessions.clear()
+            cls._clients.clear()
+        cls._thread_resources.resources = None
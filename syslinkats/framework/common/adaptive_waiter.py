@@ -0,0 +1,234 @@
+"""
+adaptive_waiter.py
+
+This module provides the polling engine used in place of fixed sleeps.  Polls are spaced by an
+exponential backoff with jitter, bounded by a deadline, and stop early when the polled resource
+reaches a terminal failure state.
+
+The clock is injectable.  Passing a ManualClock (or calling set_default_clock) makes every
+sleep return immediately while still advancing time, so polling loops can be exercised in
+milliseconds.
+"""
+__author__ = 'sedwards'
+
+import random
+import time
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+from syslinkats.framework.errors.custom_errors import WaiterFailedError
+
+T = TypeVar('T')
+
+
+class SystemClock:
+    """The real (monotonic) clock."""
+
+    @staticmethod
+    def now() -> float:
+        """Get the current time in seconds."""
+        return time.monotonic()
+
+    @staticmethod
+    def sleep(seconds: float) -> None:
+        """Block for the given number of seconds."""
+        time.sleep(seconds)
+
+
+class ManualClock:
+    """A clock whose sleep() advances its time instantly instead of blocking."""
+
+    def __init__(self, start: float = 0.0):
+        """Initialize the clock.
+
+        Args:
+            start (float): The initial value of now().
+        """
+        self._now = start
+        self.total_slept = 0.0
+
+    def now(self) -> float:
+        """Get the current (simulated) time in seconds."""
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        """Advance the clock by the given number of seconds."""
+        seconds = max(0.0, seconds)
+        self._now += seconds
+        self.total_slept += seconds
+
+
+_DEFAULT_CLOCK: Any = SystemClock()
+
+
+def get_default_clock() -> Any:
+    """Get the clock used by waiters which were not given one."""
+    return _DEFAULT_CLOCK
+
+
+def set_default_clock(clock: Any = None) -> None:
+    """Set the clock used by waiters which were not given one.
+
+    Args:
+        clock (Any): An object with now() and sleep(seconds) methods.  None restores the
+        SystemClock.
+    """
+    global _DEFAULT_CLOCK  # pylint: disable=global-statement
+    _DEFAULT_CLOCK = clock or SystemClock()
+
+
+# pylint: disable=too-many-instance-attributes
+class AdaptiveWaiter:
+    """Polls for a condition with exponential backoff, jitter and a deadline.
+
+    The waiter can be used either through wait(), which runs the whole polling loop, or
+    step-by-step for loops with more involved bodies:
+
+        waiter.start()
+        while not done:
+            ...
+            waiter.sleep(progress=<anything that changes when progress is made>)
+
+    When the progress value passed to sleep() changes, the backoff resets to initial_delay.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, initial_delay: float = 1.0, max_delay: float = 30.0,
+                 multiplier: float = 2.0, jitter: float = 0.1,
+                 timeout: Optional[float] = None, max_attempts: Optional[int] = None,
+                 clock: Any = None, random_func: Callable[[], float] = random.random,
+                 description: str = 'condition'):
+        """Initialize the waiter.
+
+        Args:
+            initial_delay (float): The first delay (seconds) between polls.
+            max_delay (float): The longest delay (seconds) between polls.
+            multiplier (float): The factor applied to the delay after each poll.
+            jitter (float): The fraction (0-1) of each delay which is randomized.
+            timeout (Optional[float]): The total time (seconds) allowed.  None means no deadline.
+            max_attempts (Optional[int]): The maximum number of polls.  None means no limit.
+            clock (Any): An object with now() and sleep(seconds) methods.  Defaults to the
+            default clock (see set_default_clock).
+            random_func (Callable[[], float]): Returns a float in [0, 1) for the jitter.
+            description (str): What is being waited for (used in error messages).
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.clock = clock or get_default_clock()
+        self.description = description
+        self._random_func = random_func
+        self._deadline: Optional[float] = None
+        self._start_time = 0.0
+        self._next_delay = initial_delay
+        self._last_progress: Any = None
+        self.attempts = 0
+
+    @property
+    def elapsed(self) -> float:
+        """The number of seconds since start()."""
+        return self.clock.now() - self._start_time
+
+    @property
+    def remaining(self) -> Optional[float]:
+        """The number of seconds left before the deadline, or None if there is no deadline."""
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - self.clock.now())
+
+    def start(self) -> 'AdaptiveWaiter':
+        """Start (or restart) the deadline and reset the backoff."""
+        self._start_time = self.clock.now()
+        self._deadline = None if self.timeout is None else self._start_time + self.timeout
+        self._next_delay = self.initial_delay
+        self._last_progress = None
+        self.attempts = 0
+        return self
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Get the (jittered) delay before the given retry attempt, counting from 0.
+
+        Args:
+            attempt (int): The zero-based attempt number.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        delay = min(self.initial_delay * (self.multiplier ** attempt), self.max_delay)
+        return self._apply_jitter(delay)
+
+    def delays(self) -> Iterator[float]:
+        """Yield the (jittered) delays of an uninterrupted backoff sequence."""
+        attempt = 0
+        while True:
+            yield self.backoff_delay(attempt)
+            attempt += 1
+
+    def sleep(self, progress: Any = None) -> None:
+        """Sleep for the next backoff delay, never sleeping past the deadline.
+
+        Args:
+            progress (Any): A value describing the current state of what is being polled.  If
+            it differs from the value passed on the previous call, the backoff resets.
+
+        Raises:
+            TimeoutError: If the deadline or the maximum number of attempts has been reached.
+        """
+        self.attempts += 1
+        if self.max_attempts is not None and self.attempts >= self.max_attempts:
+            raise TimeoutError(
+                f'Gave up waiting for {self.description} after {self.attempts} attempts.')
+
+        if progress is not None and progress != self._last_progress:
+            self._next_delay = self.initial_delay
+        self._last_progress = progress
+
+        delay = self._apply_jitter(self._next_delay)
+        self._next_delay = min(self._next_delay * self.multiplier, self.max_delay)
+
+        remaining = self.remaining
+        if remaining is not None:
+            if remaining <= 0:
+                raise TimeoutError(
+                    f'Timed out after {self.timeout} seconds waiting for {self.description}.')
+            delay = min(delay, remaining)
+        self.clock.sleep(delay)
+
+    def wait(self, poll: Callable[[], T], is_done: Callable[[T], bool] = bool,
+             is_failed: Callable[[T], bool] = None,
+             progress: Callable[[T], Any] = None) -> T:
+        """Poll until is_done(result) is True.
+
+        Args:
+            poll (Callable[[], T]): Queries the current state.
+            is_done (Callable[[T], bool]): Returns True when the wait is over.
+            is_failed (Callable[[T], bool]): (OPTIONAL) Returns True when the polled state is a
+            terminal failure, which ends the wait early.
+            progress (Callable[[T], Any]): (OPTIONAL) Extracts a progress value from the polled
+            state; the backoff resets whenever it changes.
+
+        Returns:
+            T: The last polled result.
+
+        Raises:
+            TimeoutError: If the deadline or the maximum number of attempts has been reached.
+            WaiterFailedError: If is_failed returned True.
+        """
+        self.start()
+        while True:
+            result = poll()
+            if is_failed is not None and is_failed(result):
+                raise WaiterFailedError(
+                    f'A terminal failure state was reached while waiting for '
+                    f'{self.description}: {result}')
+            if is_done(result):
+                return result
+            self.sleep(progress=progress(result) if progress else None)
+
+    def _apply_jitter(self, delay: float) -> float:
+        """Randomize the given fraction of a delay."""
+        if self.jitter <= 0:
+            return delay
+        return delay * (1 - self.jitter + 2 * self.jitter * self._random_func())
@@ -0,0 +1,104 @@
+"""
+checkpoint_journal.py
+
+This module holds a JSON checkpoint journal of long, multi-phase operations (such as instance
+provisioning).  It records which phases have completed for each instance, plus any values a
+resumed run needs (such as the feeds that were chosen), so that a failed run can be resumed
+without repeating the phases which already completed.
+
+The journal is saved after every change, by writing a temporary file and renaming it over the
+journal, so a crash never leaves a partially written journal behind.
+"""
+__author__ = 'sedwards'
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+
+class CheckpointJournal:
+    """A thread-safe journal of the completed phases of each instance."""
+
+    def __init__(self, path: str, resume: bool = False):
+        """Initialize the journal.
+
+        Args:
+            path (str): The path of the journal file.
+            resume (bool): Whether to load the existing journal.  Otherwise the journal starts
+            empty (and replaces any existing journal on the first save).
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, Any] = {'instances': {}, 'values': {}}
+        if resume:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f'There is no checkpoint journal to resume from: {path}')
+            with open(path, 'r') as journal_file:
+                self._data = json.load(journal_file)
+
+    @property
+    def instance_ids(self) -> List[str]:
+        """The journaled instance Ids, in the order they were added."""
+        with self._lock:
+            return list(self._data['instances'])
+
+    def add_instance(self, instance_id: str, **details: Any) -> None:
+        """Add an instance (or update its details, e.g. its public DNS name).
+
+        Args:
+            instance_id (str): The instance Id.
+            **details (Any): JSON-serializable details of the instance.
+        """
+        with self._lock:
+            instance = self._data['instances'].setdefault(
+                instance_id, {'completed_phases': []})
+            instance.update(details)
+            self._save()
+
+    def get_instance_details(self, instance_id: str) -> Dict[str, Any]:
+        """Get the details of a journaled instance."""
+        with self._lock:
+            return dict(self._data['instances'][instance_id])
+
+    def is_completed(self, phase: str, instance_id: Optional[str]) -> bool:
+        """Whether a phase has completed for an instance."""
+        with self._lock:
+            instance = self._data['instances'].get(instance_id)
+            return instance is not None and phase in instance['completed_phases']
+
+    def mark_completed(self, phase: str, instance_ids: List[str]) -> None:
+        """Record that a phase has completed for one or more instances.
+
+        Args:
+            phase (str): The name of the phase.
+            instance_ids (List[str]): The Ids of the instances (which are added if needed).
+            Empty Ids (e.g. of instances which are not deployed yet) are skipped.
+        """
+        with self._lock:
+            for instance_id in filter(None, instance_ids):
+                instance = self._data['instances'].setdefault(
+                    instance_id, {'completed_phases': []})
+                if phase not in instance['completed_phases']:
+                    instance['completed_phases'].append(phase)
+            self._save()
+
+    def get_value(self, key: str, default: Any = None) -> Any:
+        """Get a journaled value."""
+        with self._lock:
+            return self._data['values'].get(key, default)
+
+    def set_value(self, key: str, value: Any) -> None:
+        """Journal a (JSON-serializable) value."""
+        with self._lock:
+            self._data['values'][key] = value
+            self._save()
+
+    def _save(self) -> None:
+        """Write the journal atomically (the caller holds the lock)."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as journal_file:
+            json.dump(self._data, journal_file, indent=4)
+        os.replace(temp_path, self.path)
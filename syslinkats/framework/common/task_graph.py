@@ -0,0 +1,243 @@
+"""
+task_graph.py
+
+This module holds a small executor for graphs of dependent tasks.  A task is either global (it
+runs once) or per-context (it runs once for each context object, e.g. once per instance being
+provisioned).  A task starts as soon as everything it depends on has finished:
+
+* a per-context task waits for its dependencies for the same context, and for every context
+  of a global dependency's (i.e. a global dependency as a whole);
+* a global task waits for its dependencies for every context.
+
+Ready tasks run on a bounded thread pool, so independent tasks, and the same task for
+independent contexts, run concurrently.  When a task fails, only the tasks which depend on it
+(for the same context) are skipped; everything else carries on, and the failures are raised
+together once the graph is done.
+
+Completed work can be skipped (for example when resuming from a checkpoint journal) through
+the is_completed and on_completed hooks of run.
+
+Every task run is recorded as a 'phase' span (see span_recorder), and critical_path finds the
+chain of dependent tasks which determined how long the graph took.
+"""
+__author__ = 'sedwards'
+
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from syslinkats.framework.errors.custom_errors import BulkOperationError
+from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.logging.span_recorder import SPAN_RECORDER
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+# The statuses of a task node.
+PENDING = 'Pending'
+SUCCEEDED = 'Succeeded'
+FAILED = 'Failed'
+SKIPPED = 'Skipped'
+
+# A node is a task name and a context index (None for global tasks).
+Node = Tuple[str, Optional[int]]
+
+
+class TaskGraph:
+    """A graph of global and per-context tasks, run concurrently in dependency order."""
+
+    def __init__(self, max_workers: int = 4):
+        """Initialize the graph.
+
+        Args:
+            max_workers (int): The most tasks run at the same time.
+        """
+        self.max_workers = max_workers
+        self.tasks: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add_task(self, name: str, func: Callable[..., Any], depends_on: Iterable[str] = (),
+                 per_context: bool = False) -> 'TaskGraph':
+        """Add a task to the graph.
+
+        Args:
+            name (str): The unique name of the task.
+            func (Callable[..., Any]): The task.  Global tasks are called without arguments;
+            per-context tasks are called with their context.
+            depends_on (Iterable[str]): The names of the tasks this task depends on.  They must
+            already have been added.
+            per_context (bool): Whether the task runs once per context.
+
+        Returns:
+            TaskGraph: The graph, so that calls can be chained.
+        """
+        if name in self.tasks:
+            raise ValueError(f'The task {name} was already added.')
+        depends_on = list(depends_on)
+        unknown = [_ for _ in depends_on if _ not in self.tasks]
+        if unknown:
+            raise ValueError(f'The task {name} depends on unknown task(s): {unknown}')
+        self.tasks[name] = {'Func': func, 'DependsOn': depends_on, 'PerContext': per_context}
+        return self
+
+    def _dependencies(self, node: Node, context_count: int) -> List[Node]:
+        """Get the nodes a node depends on."""
+        name, index = node
+        dependencies = []
+        for dependency in self.tasks[name]['DependsOn']:
+            if not self.tasks[dependency]['PerContext']:
+                dependencies.append((dependency, None))
+            elif index is not None:
+                dependencies.append((dependency, index))
+            else:
+                dependencies.extend((dependency, _) for _ in range(context_count))
+        return dependencies
+
+    def run(self, contexts: List[Any] = None,
+            is_completed: Callable[[str, Optional[Any]], bool] = None,
+            on_completed: Callable[[str, Optional[Any]], None] = None) \
+            -> Dict[Node, Dict[str, Any]]:
+        """Run every task.
+
+        Args:
+            contexts (List[Any]): The contexts of the per-context tasks.  str(context) names the
+            context in log messages and failures.
+            is_completed (Callable[[str, Optional[Any]], bool]): (OPTIONAL) Called with a task
+            name and context (None for global tasks) before the task runs.  If it returns True,
+            the task is treated as succeeded without running.
+            on_completed (Callable[[str, Optional[Any]], None]): (OPTIONAL) Called with a task
+            name and context (None for global tasks) each time a task succeeds.
+
+        Returns:
+            Dict[Node, Dict[str, Any]]: The status and duration of each (task name, context
+            index) node, with the following structure:
+                {'Status': 'Succeeded' | 'Failed' | 'Skipped', 'Duration': <seconds>,
+                 'Error': '<error>' (failed nodes only),
+                 'Resumed': True (nodes which were already completed only)}
+
+        Raises:
+            BulkOperationError: If any task failed.  Its failures are
+            {'Task': '<name>', 'Context': '<context>', 'Error': '<error>'} dicts.
+        """
+        contexts = list(contexts or [])
+        nodes: List[Node] = []
+        for name, task in self.tasks.items():
+            if task['PerContext']:
+                nodes.extend((name, _) for _ in range(len(contexts)))
+            else:
+                nodes.append((name, None))
+        dependencies = {_: self._dependencies(_, len(contexts)) for _ in nodes}
+        results: Dict[Node, Dict[str, Any]] = {_: {'Status': PENDING} for _ in nodes}
+
+        def _label(node: Node) -> str:
+            return node[0] if node[1] is None else f'{node[0]} [{contexts[node[1]]}]'
+
+        def _run_node(node: Node) -> None:
+            name, index = node
+            context = None if index is None else contexts[index]
+            if is_completed is not None and is_completed(name, context):
+                LOGGER.write(f'Skipping {_label(node)}, as it was already completed.')
+                with self._lock:
+                    results[node] = {'Status': SUCCEEDED, 'Duration': 0.0, 'Resumed': True}
+                return
+
+            LOGGER.write(f'Starting {_label(node)}.')
+            span = SPAN_RECORDER.start_span(
+                name, 'phase', **({} if context is None else {'context': str(context)}))
+            start_time = time.perf_counter()
+            try:
+                if index is None:
+                    self.tasks[name]['Func']()
+                else:
+                    self.tasks[name]['Func'](context)
+                if on_completed is not None:
+                    on_completed(name, context)
+                status, error = SUCCEEDED, None
+            except Exception as ex:  # pylint: disable=broad-except
+                LOGGER.write(f'{_label(node)} failed: {ex}', 'exception')
+                status, error = FAILED, str(ex)
+            duration = time.perf_counter() - start_time
+            SPAN_RECORDER.end_span(span, error=error)
+            with self._lock:
+                results[node] = {'Status': status, 'Duration': duration}
+                if error is not None:
+                    results[node]['Error'] = error
+            if status == SUCCEEDED:
+                LOGGER.write(f'Finished {_label(node)} in {duration:.1f} seconds.')
+
+        running: Dict[Future, Node] = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            while True:
+                with self._lock:
+                    # Skip the nodes whose dependencies failed, then start the ready ones.
+                    progress = True
+                    while progress:
+                        progress = False
+                        for node in nodes:
+                            if results[node]['Status'] == PENDING and any(
+                                    results[_]['Status'] in (FAILED, SKIPPED)
+                                    for _ in dependencies[node]):
+                                results[node] = {'Status': SKIPPED, 'Duration': 0.0}
+                                LOGGER.write(f'Skipping {_label(node)}, as a dependency '
+                                             f'did not succeed.', 'warning')
+                                progress = True
+                    ready = [
+                        node for node in nodes
+                        if results[node]['Status'] == PENDING
+                        and node not in running.values()
+                        and all(results[_]['Status'] == SUCCEEDED for _ in dependencies[node])
+                    ]
+                for node in ready:
+                    running[executor.submit(_run_node, node)] = node
+
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    del running[future]
+
+        failures = [
+            {'Task': node[0], 'Context': '' if node[1] is None else str(contexts[node[1]]),
+             'Error': result['Error']}
+            for node, result in results.items() if result['Status'] == FAILED
+        ]
+        if failures:
+            raise BulkOperationError(
+                f'{len(failures)} task(s) failed: {failures}', failures)
+        return results
+
+    def critical_path(self, results: Dict[Node, Dict[str, Any]]) -> Tuple[List[Node], float]:
+        """Find the critical path of a run.
+
+        The critical path is the chain of dependent nodes with the longest total duration, which
+        bounds how fast the graph can run however many workers it has.
+
+        Args:
+            results (Dict[Node, Dict[str, Any]]): The results of run.
+
+        Returns:
+            Tuple[List[Node], float]: The nodes of the critical path (in order), and its total
+            duration (seconds).
+        """
+        context_count = max([_[1] + 1 for _ in results if _[1] is not None] + [0])
+        finish: Dict[Node, float] = {}
+        previous: Dict[Node, Optional[Node]] = {}
+        # Tasks can only depend on tasks added before them, so the results are in dependency
+        # order.
+        for node, result in results.items():
+            dependencies = [_ for _ in self._dependencies(node, context_count) if _ in finish]
+            before = max(dependencies, key=lambda _: finish[_], default=None)
+            finish[node] = (finish[before] if before else 0.0) + result.get('Duration', 0.0)
+            previous[node] = before
+        if not finish:
+            return [], 0.0
+
+        node = max(finish, key=lambda _: finish[_])
+        total = finish[node]
+        path = []
+        while node is not None:
+            path.append(node)
+            node = previous[node]
+        return list(reversed(path)), total
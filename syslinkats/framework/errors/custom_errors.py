@@ -7,6 +7,20 @@ class APIVersionNotFound(Exception):
     """An error related to a requested API version not being found."""
 
 
+class BulkOperationError(Exception):
+    """One or more chunks of a bulk AWS operation failed."""
+
+    def __init__(self, message, failures=None):
+        super().__init__(message)
+        self.message = message
+        # The failed chunks: a list of {'ResourceIds': [...], 'Error': '<error>'} dicts.
+        self.failures = failures or []
+
+
+class CassetteMissError(Exception):
+    """A replayed call had no recorded interaction in the cassette."""
+
+
 class ErrorObjectInRequest(Exception):
     """The response from the SystemLink service contained an error object."""
 
@@ -33,3 +47,7 @@ class RemoteCommandOutputNotEmpty(Exception):
 
 class SuiteNotFound(Exception):
     """No suite was found within the provided date range or with the specified build version."""
+
+
+class WaiterFailedError(Exception):
+    """A polled resource reached a terminal failure state while being waited on."""
@@ -6,6 +6,7 @@ import xml.etree.ElementTree
 from botocore.exceptions import ClientError
 
 from syslinkats.data.common.aws_default_parameters import DEFAULT_AWS_SYSLINK_ACCESS_DATA
+from syslinkats.framework.network_utils.cassette import add_cassette_arguments, install_cassette
 from syslinkats.tests.buckets.file.utils.file_web_api import FileWebApi
 from syslinkats.tests.buckets.testmon.utils import testmon_constants
 from syslinkats.tests.buckets.testmon.utils.testmon_util import TestMonitorUtil
@@ -166,6 +167,7 @@ def parse_args():
         }"
         '''
     )
+    add_cassette_arguments(parser)
 
     args = parser.parse_args()
     return args
@@ -173,6 +175,8 @@ def parse_args():
 
 if __name__ == '__main__':
     args = parse_args()
+    if args.cassette_path:
+        install_cassette(args.cassette_path, args.cassette_mode)
 
     # If the user omitted the test_monitor_server_data arg or passed in an empty string
     # (Jenkins does this), then use the default dict.  Otherwise, eval the string to a dict.
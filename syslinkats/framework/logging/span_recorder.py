@@ -0,0 +1,246 @@
+"""
+span_recorder.py
+
+This module holds a lightweight, thread-safe recorder of timing spans: named, timed regions of
+work (a provisioning phase, an AWS API call, an SSM command, an HTTP request) with their thread,
+attributes (such as the instance they concern) and outcome.
+
+The spans can be exported as a Chrome trace (open it in chrome://tracing or Perfetto to see the
+phases of every thread on a timeline), and summarized as a table of the count, total, mean and
+longest duration of each span name.
+
+A process-wide recorder (SPAN_RECORDER) is used by the framework's instrumentation.  It is
+disabled by default, as the spans are kept in memory until they are cleared: set its enabled
+attribute to True (e.g. for one provisioning run) to record spans.  Recording costs two clock
+reads and a list append per span.
+"""
+__author__ = 'sedwards'
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+# The outcomes of a span.
+SPAN_OK = 'ok'
+SPAN_ERROR = 'error'
+
+
+class Span:
+    """A timed region of work."""
+
+    def __init__(self, name: str, category: str, start: float, thread_id: int,
+                 attributes: Dict[str, Any]):
+        """Initialize the span.
+
+        Args:
+            name (str): The name of the span (e.g. a phase or an API operation).
+            category (str): The kind of span (e.g. 'phase', 'aws', 'ssm' or 'http').
+            start (float): The start time (seconds, from time.perf_counter).
+            thread_id (int): The Id of the thread which started the span.
+            attributes (Dict[str, Any]): Details of the span (e.g. its instance).
+        """
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end: Optional[float] = None
+        self.thread_id = thread_id
+        self.attributes = attributes
+        self.outcome = SPAN_OK
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """The duration (seconds) of the span (so far, if it has not ended)."""
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class SpanRecorder:
+    """Records spans and exports them as a Chrome trace or a summary table."""
+
+    def __init__(self, enabled: bool = True):
+        """Initialize the recorder.
+
+        Args:
+            enabled (bool): Whether spans are recorded.
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._spans: List[Span] = []
+        self._origin = time.perf_counter()
+
+    def start_span(self, name: str, category: str = '', **attributes: Any) -> Optional[Span]:
+        """Start a span, which is recorded once end_span is called.
+
+        Args:
+            name (str): The name of the span.
+            category (str): The kind of span.
+            **attributes (Any): Details of the span.
+
+        Returns:
+            Optional[Span]: The span, or None if the recorder is disabled.
+        """
+        if not self.enabled:
+            return None
+        return Span(name, category, time.perf_counter(), threading.get_ident(), attributes)
+
+    def end_span(self, span: Optional[Span], error: Any = None) -> None:
+        """End and record a span.
+
+        Args:
+            span (Optional[Span]): The span (None is ignored).
+            error (Any): (OPTIONAL) The error (e.g. an exception or an error code) the work
+            ended with.
+        """
+        if span is None:
+            return
+        span.end = time.perf_counter()
+        if error is not None:
+            span.outcome = SPAN_ERROR
+            span.error = str(error) or type(error).__name__
+        with self._lock:
+            self._spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = '', **attributes: Any) -> Iterator[Optional[Span]]:
+        """Record the work done in a with block as a span.
+
+        An exception raised in the block marks the span as an error (and is re-raised).
+
+        Args:
+            name (str): The name of the span.
+            category (str): The kind of span.
+            **attributes (Any): Details of the span.  More can be added to the yielded span's
+            attributes.
+
+        Yields:
+            Optional[Span]: The span, or None if the recorder is disabled.
+        """
+        span = self.start_span(name, category, **attributes)
+        try:
+            yield span
+        except BaseException as ex:
+            self.end_span(span, error=ex)
+            raise
+        self.end_span(span)
+
+    @property
+    def spans(self) -> List[Span]:
+        """The recorded spans, in the order they ended."""
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self) -> None:
+        """Discard the recorded spans."""
+        with self._lock:
+            self._spans = []
+            self._origin = time.perf_counter()
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """Build a Chrome trace (Trace Event Format) of the recorded spans.
+
+        Returns:
+            Dict[str, Any]: The trace, with one complete ('X') event per span.
+        """
+        pid = os.getpid()
+        events = []
+        for span in sorted(self.spans, key=lambda _: _.start):
+            args = {key: value if isinstance(value, (str, int, float, bool)) else str(value)
+                    for key, value in span.attributes.items()}
+            args['outcome'] = span.outcome
+            if span.error is not None:
+                args['error'] = span.error
+            events.append({
+                'name': span.name,
+                'cat': span.category or 'default',
+                'ph': 'X',
+                'ts': round((span.start - self._origin) * 1e6, 1),
+                'dur': round(span.duration * 1e6, 1),
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': args
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path: str) -> None:
+        """Write a Chrome trace of the recorded spans (see to_chrome_trace) to a file."""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file)
+
+    def summarize(self, category: str = None) -> List[Dict[str, Any]]:
+        """Summarize the recorded spans by category and name, longest total duration first.
+
+        Args:
+            category (str): (OPTIONAL) Only summarize the spans of this category.
+
+        Returns:
+            List[Dict[str, Any]]: The summary rows, with the structure:
+                [{'Category': '<category>', 'Name': '<name>', 'Count': <int>,
+                  'Errors': <int>, 'Total': <seconds>, 'Mean': <seconds>, 'Max': <seconds>}]
+        """
+        rows: Dict[tuple, Dict[str, Any]] = {}
+        for span in self.spans:
+            if category is not None and span.category != category:
+                continue
+            row = rows.setdefault((span.category, span.name), {
+                'Category': span.category, 'Name': span.name, 'Count': 0, 'Errors': 0,
+                'Total': 0.0, 'Max': 0.0
+            })
+            row['Count'] += 1
+            row['Errors'] += span.outcome == SPAN_ERROR
+            row['Total'] += span.duration
+            row['Max'] = max(row['Max'], span.duration)
+        for row in rows.values():
+            row['Mean'] = row['Total'] / row['Count']
+        return sorted(rows.values(), key=lambda _: _['Total'], reverse=True)
+
+    def format_summary_table(self, category: str = None) -> str:
+        """Format the summary (see summarize) as a text table."""
+        rows = self.summarize(category)
+        name_width = max([len(f'{_["Category"]}:{_["Name"]}') for _ in rows] + [4])
+        lines = [f'{"Span":<{name_width}}  {"Count":>6}  {"Errors":>6}  {"Total(s)":>10}  '
+                 f'{"Mean(s)":>9}  {"Max(s)":>9}']
+        lines.extend(
+            f'{_["Category"] + ":" + _["Name"]:<{name_width}}  {_["Count"]:>6}  '
+            f'{_["Errors"]:>6}  {_["Total"]:>10.3f}  {_["Mean"]:>9.3f}  {_["Max"]:>9.3f}'
+            for _ in rows)
+        return '\n'.join(lines)
+
+
+# The process-wide recorder used by the framework's instrumentation (disabled until enabled).
+SPAN_RECORDER = SpanRecorder(enabled=False)
+
+
+def traced(category: str, name: str = None, attribute_args: Iterable[str] = ()) -> Callable:
+    """Decorate a function so that each call is recorded as a span by SPAN_RECORDER.
+
+    Args:
+        category (str): The kind of span.
+        name (str): (OPTIONAL) The name of the span.  Defaults to the function's qualified name.
+        attribute_args (Iterable[str]): The names of keyword arguments recorded as attributes
+        of the span (when they are passed).
+
+    Returns:
+        Callable: The decorator.
+    """
+    attribute_args = tuple(attribute_args)
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SPAN_RECORDER.enabled:
+                return func(*args, **kwargs)
+            attributes = {_: kwargs[_] for _ in attribute_args if kwargs.get(_) is not None}
+            with SPAN_RECORDER.span(span_name, category, **attributes):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,348 @@
+"""
+cassette.py
+
+This module records AWS API calls (made through AWSSessionRegistry clients), HttpVerbOps
+requests and host readiness probes to a JSON cassette file, and replays them offline.
+
+While replaying, no request leaves the process: every AWS call is answered from the cassette
+through botocore's before-call event, every HTTP request is answered by HttpVerbOps' session,
+and the default clock (see adaptive_waiter) is a ManualClock, so every poll and back-off returns
+immediately.  A replayed run is deterministic, which makes it a repeatable benchmark of the
+client-side overhead of a script (filtering, logging and polling logic) on any machine.
+
+Replayed calls are matched to recorded ones by operation and parameters, in recorded order.  A
+call whose recorded answers are used up gets the last of them again (so a poll which runs once
+more than it did while recording still ends), and a call whose parameters changed (for example
+because they contain a generated token or the current time) gets the next unused answer of the
+same operation.  Anything else raises CassetteMissError.
+"""
+__author__ = 'sedwards'
+
+import atexit
+import base64
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from syslinkats.framework.aws.aws_session_registry import AWSSessionRegistry
+from syslinkats.framework.common.adaptive_waiter import (
+    ManualClock,
+    get_default_clock,
+    set_default_clock
+)
+from syslinkats.framework.errors.custom_errors import CassetteMissError
+from syslinkats.framework.logging.auto_indent import AutoIndent
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+# The modes of a cassette.
+RECORD = 'record'
+REPLAY = 'replay'
+# The kinds of recorded interactions.
+AWS_INTERACTION = 'aws'
+HTTP_INTERACTION = 'http'
+# The request context key which holds the match key of an AWS call.
+_KEY_CONTEXT_KEY = 'syslinkats_cassette_key'
+
+_ACTIVE_CASSETTE: Optional['Cassette'] = None
+
+
+def _encode(value: Any) -> Any:
+    """Convert a botocore value to JSON-serializable data (see _decode)."""
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(_) for _ in value]
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def _decode(value: Any) -> Any:
+    """Convert data encoded by _encode back to botocore values."""
+    if isinstance(value, list):
+        return [_decode(_) for _ in value]
+    if not isinstance(value, dict):
+        return value
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    if '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    if '__streaming_body__' in value:
+        content = base64.b64decode(value['__streaming_body__'])
+        return StreamingBody(io.BytesIO(content), len(content))
+    return {key: _decode(item) for key, item in value.items()}
+
+
+def get_active_cassette() -> Optional['Cassette']:
+    """Get the installed cassette, if any."""
+    return _ACTIVE_CASSETTE
+
+
+class Cassette:
+    """Records AWS, HTTP and readiness-probe traffic to a file, or replays it from one."""
+
+    def __init__(self, path: str, mode: str = REPLAY):
+        """Initialize the cassette.
+
+        Args:
+            path (str): The path of the cassette file.
+            mode (str): Either 'record' (the file is written when the cassette is uninstalled)
+            or 'replay' (the file must exist).
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f'Unsupported cassette mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.interactions: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._used: set = set()
+        self._last_by_key: Dict[tuple, int] = {}
+        self._saved_clock: Any = None
+        if mode == REPLAY:
+            with open(path, 'r') as cassette_file:
+                self.interactions = json.load(cassette_file)['interactions']
+
+    # region Installation
+    def install(self) -> 'Cassette':
+        """Route all AWS, HttpVerbOps and readiness-probe traffic through this cassette.
+
+        Returns:
+            Cassette: The cassette.
+        """
+        global _ACTIVE_CASSETTE  # pylint: disable=global-statement
+        _ACTIVE_CASSETTE = self
+        AWSSessionRegistry.set_cassette(self)
+        if self.mode == REPLAY:
+            self._saved_clock = get_default_clock()
+            set_default_clock(ManualClock())
+        LOGGER.write(f'Using the cassette {self.path} ({self.mode}).')
+        return self
+
+    def uninstall(self) -> None:
+        """Stop routing traffic through this cassette (saving it, if recording)."""
+        global _ACTIVE_CASSETTE  # pylint: disable=global-statement
+        if _ACTIVE_CASSETTE is not self:
+            return
+        _ACTIVE_CASSETTE = None
+        AWSSessionRegistry.set_cassette(None)
+        if self.mode == REPLAY:
+            set_default_clock(self._saved_clock)
+        else:
+            self.save()
+
+    def __enter__(self) -> 'Cassette':
+        return self.install()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.uninstall()
+
+    def save(self) -> None:
+        """Write the recorded interactions to the cassette file (atomically)."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            content = {'version': 1, 'interactions': list(self.interactions)}
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as cassette_file:
+            json.dump(content, cassette_file, indent=1)
+        os.replace(temp_path, self.path)
+        LOGGER.write(f'Recorded {len(content["interactions"])} interactions to {self.path}.')
+    # endregion
+
+    # region Matching
+    def _add(self, interaction: Dict[str, Any]) -> None:
+        """Record an interaction."""
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def _find(self, kind: str, operation: str, key: str) -> Dict[str, Any]:
+        """Find the recorded answer of a call (see the module docstring for the rules)."""
+        with self._lock:
+            same_operation = None
+            for index, interaction in enumerate(self.interactions):
+                if index in self._used or interaction['Kind'] != kind \
+                        or interaction['Operation'] != operation:
+                    continue
+                if interaction['Key'] == key:
+                    break
+                if same_operation is None:
+                    same_operation = index
+            else:
+                index = self._last_by_key.get((kind, operation, key), same_operation)
+                if index is None:
+                    raise CassetteMissError(
+                        f'The cassette {self.path} has no {kind} interaction for {operation} '
+                        f'{key}')
+            self._used.add(index)
+            self._last_by_key[(kind, operation, key)] = index
+            return self.interactions[index]
+    # endregion
+
+    # region AWS (botocore event handlers)
+    @staticmethod
+    def _keep_key(params: Dict[str, Any] = None, context: Dict[str, Any] = None,
+                  **_: Any) -> None:
+        """botocore before-parameter-build handler: keep the match key of the parameters.
+
+        before-call only receives the serialized request, so the key is made here.
+        """
+        if context is not None:
+            context[_KEY_CONTEXT_KEY] = json.dumps(_encode(params or {}), sort_keys=True)
+
+    @staticmethod
+    def _operation(model: Any, context: Dict[str, Any]) -> str:
+        """Build the '<region>:<service>.<Operation>' name of a call."""
+        return f'{context.get("client_region")}:{model.service_model.endpoint_prefix}.' \
+               f'{model.name}'
+
+    def _before_call(self, model: Any, context: Dict[str, Any] = None, **_: Any) -> Any:
+        """botocore before-call handler: answer the call from the cassette, when replaying."""
+        if self.mode != REPLAY or context is None:
+            return None
+        interaction = self._find(
+            AWS_INTERACTION, self._operation(model, context), context.get(_KEY_CONTEXT_KEY, ''))
+        http_response = AWSResponse(
+            url='', status_code=interaction['StatusCode'], headers={}, raw=None)
+        return http_response, _decode(interaction['Response'])
+
+    def _after_call(self, model: Any, http_response: Any = None,
+                    parsed: Dict[str, Any] = None, context: Dict[str, Any] = None,
+                    **_: Any) -> None:
+        """botocore after-call handler: record the answer of the call, when recording."""
+        if self.mode != RECORD or context is None or parsed is None:
+            return
+        response = {}
+        for key, value in parsed.items():
+            if isinstance(value, StreamingBody):
+                # Read the streamed body so it can be recorded, then hand the caller a fresh
+                # stream of the same content.
+                content = value.read()
+                parsed[key] = StreamingBody(io.BytesIO(content), len(content))
+                response[key] = {
+                    '__streaming_body__': base64.b64encode(content).decode('ascii')}
+            else:
+                response[key] = _encode(value)
+        self._add({
+            'Kind': AWS_INTERACTION,
+            'Operation': self._operation(model, context),
+            'Key': context.get(_KEY_CONTEXT_KEY, ''),
+            'StatusCode': getattr(http_response, 'status_code', 200),
+            'Response': response
+        })
+    # endregion
+
+    # region HTTP
+    def replay_http(self, method: str, url: str) -> Optional[Response]:
+        """Answer an HTTP request from the cassette.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL.
+
+        Returns:
+            Optional[Response]: The recorded response, or None if the cassette is recording
+            (or the URL is a local file).
+        """
+        if self.mode != REPLAY or url.startswith('file:'):
+            return None
+        interaction = self._find(HTTP_INTERACTION, method.upper(), url)['Response']
+        response = Response()
+        response.status_code = interaction['StatusCode']
+        response.reason = interaction['Reason']
+        response.headers = CaseInsensitiveDict(interaction['Headers'])
+        response.url = interaction['Url']
+        response.encoding = interaction['Encoding']
+        # pylint: disable=protected-access
+        response._content = base64.b64decode(interaction['Content'])
+        return response
+
+    def record_http(self, method: str, url: str, response: Response) -> None:
+        """Record the response of an HTTP request, when recording."""
+        if self.mode != RECORD or url.startswith('file:'):
+            return
+        self._add({
+            'Kind': HTTP_INTERACTION,
+            'Operation': method.upper(),
+            'Key': url,
+            'Response': {
+                'StatusCode': response.status_code,
+                'Reason': response.reason,
+                'Headers': dict(response.headers),
+                'Url': response.url,
+                'Encoding': response.encoding,
+                'Content': base64.b64encode(response.content or b'').decode('ascii')
+            }
+        })
+    # endregion
+
+    def replay_or_record(self, kind: str, key: Dict[str, Any], func: Callable[[], Any]) -> Any:
+        """Replay the recorded result of a function call, or call it and record its result.
+
+        Args:
+            kind (str): The kind of call (e.g. 'readiness').
+            key (Dict[str, Any]): The JSON-serializable arguments of the call.
+            func (Callable[[], Any]): The call.  Its result must be JSON-serializable.
+
+        Returns:
+            Any: The (recorded) result.
+        """
+        key_text = json.dumps(_encode(key), sort_keys=True)
+        if self.mode == REPLAY:
+            return self._find(kind, kind, key_text)['Response']
+        result = func()
+        self._add({'Kind': kind, 'Operation': kind, 'Key': key_text, 'Response': result})
+        return result
+
+
+def replay_or_record(kind: str, key: Dict[str, Any], func: Callable[[], Any]) -> Any:
+    """Call a function through the installed cassette (see Cassette.replay_or_record).
+
+    If no cassette is installed, the function is just called.
+    """
+    if _ACTIVE_CASSETTE is None:
+        return func()
+    return _ACTIVE_CASSETTE.replay_or_record(kind, key, func)
+
+
+def install_cassette(path: str, mode: str = REPLAY) -> Cassette:
+    """Install a cassette for the rest of the process (a recorded cassette is saved at exit).
+
+    Args:
+        path (str): The path of the cassette file.
+        mode (str): Either 'record' or 'replay'.
+
+    Returns:
+        Cassette: The installed cassette.
+    """
+    cassette = Cassette(path, mode).install()
+    atexit.register(cassette.uninstall)
+    return cassette
+
+
+def add_cassette_arguments(parser: Any) -> None:
+    """Add the --cassette-path and --cassette-mode options to an argparse parser."""
+    parser.add_argument(
+        '--cassette-path', action='store', default=None, type=str,
+        dest='cassette_path',
+        help='''(OPTIONAL) The path of a cassette to record the AWS, HTTP and readiness-probe
+            traffic to, or to replay it from (offline, without waits).'''
+    )
+    parser.add_argument(
+        '--cassette-mode', action='store', default=REPLAY, choices=[RECORD, REPLAY],
+        dest='cassette_mode',
+        help='Whether to record the traffic to the cassette or replay it from the cassette.'
+    )
@@ -44,21 +44,24 @@ __author__ = 'sedwards'
 import functools
 import json
 import sys
-import time
 from json import JSONDecodeError
 from typing import Any, Dict, List, Optional, Tuple, Union
 from urllib.error import HTTPError
+from urllib.parse import urlsplit
 
 import requests
 from requests import Response
 from requests.auth import HTTPBasicAuth
 from requests_file import FileAdapter
 
+from syslinkats.framework.common.adaptive_waiter import get_default_clock
 from syslinkats.framework.errors.custom_errors import (
     ErrorObjectInRequest,
     ExpectedResponseError
 )
 from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.logging.span_recorder import SPAN_ERROR, SPAN_RECORDER
+from syslinkats.framework.network_utils.cassette import get_active_cassette
 from syslinkats.framework.validators.validate_args import validate_args_for_value
 
 LOGGER = AutoIndent(sys.stdout)
@@ -86,7 +89,7 @@ def _multi_try(func):
                     LOGGER.write(f'{http_error}: {retry_count} retries remaining.')
                     if retry_count == 0:
                         raise
-                    time.sleep(10)
+                    get_default_clock().sleep(10)
                 else:
                     raise
 
@@ -184,6 +187,30 @@ def _process_request_response(func):
     return wrapper
 
 
+class _TracedSession(requests.Session):
+    """A requests session which traces requests and supports record / replay cassettes.
+
+    Every request is recorded as an 'http' span, and goes through the installed cassette (see
+    cassette), if any.
+    """
+
+    def request(self, method, url, *args, **kwargs):  # pylint: disable=arguments-differ
+        with SPAN_RECORDER.span(f'{method} {urlsplit(url).path}', 'http',
+                                host=urlsplit(url).netloc) as span:
+            cassette = get_active_cassette()
+            response = cassette.replay_http(method, url) if cassette else None
+            if response is None:
+                response = super().request(method, url, *args, **kwargs)
+                if cassette:
+                    cassette.record_http(method, url, response)
+            if span is not None:
+                span.attributes['status_code'] = response.status_code
+                if response.status_code >= 400:
+                    span.outcome = SPAN_ERROR
+                    span.error = str(response.status_code)
+            return response
+
+
 # pylint: disable=too-many-instance-attributes
 class HttpVerbOps:
     """The base class for all SystemLink service access classes."""
@@ -201,7 +228,8 @@ class HttpVerbOps:
         """
         requests.packages.urllib3.disable_warnings()  # pylint: disable=no-member
         # Set up a session with a file adapter so that we can GET local files through URLs.
-        self._session = requests.Session()
+        # Every request is recorded as a span (see span_recorder).
+        self._session = _TracedSession()
         self._session.mount('file://', FileAdapter())
 
         validate_args_for_value(username=username, password=password)
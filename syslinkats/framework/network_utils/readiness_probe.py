@@ -0,0 +1,199 @@
+"""
+readiness_probe.py
+
+This module checks whether many hosts are ready at the same time.  A host is ready when a TCP
+port accepts connections and, optionally, when a health URL answers with an expected status.
+
+Every probe has its own timeout, and all hosts are probed concurrently with asyncio, so waiting
+for N hosts takes about as long as waiting for the slowest one.
+"""
+__author__ = 'sedwards'
+
+import asyncio
+import functools
+import sys
+from typing import Any, Dict, Iterable, List, Optional
+
+import requests
+
+from syslinkats.framework.common.adaptive_waiter import AdaptiveWaiter
+from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.network_utils.cassette import replay_or_record
+from syslinkats.framework.validators.validate_args import validate_args_for_value
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+
+async def _probe_tcp(host: str, port: int, probe_timeout: float) -> Optional[str]:
+    """Try to open a TCP connection.
+
+    Returns:
+        Optional[str]: None if the port accepted the connection; otherwise the error.
+    """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), probe_timeout)
+    except (OSError, asyncio.TimeoutError) as ex:
+        return f'{type(ex).__name__}: {ex}'
+    writer.close()
+    return None
+
+
+async def _probe_http(url: str, probe_timeout: float,
+                      expected_statuses: Iterable[int]) -> Optional[str]:
+    """Request a health URL (in the default executor, as requests is blocking).
+
+    Returns:
+        Optional[str]: None if the URL answered with an expected status; otherwise the error.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        response = await loop.run_in_executor(None, functools.partial(
+            requests.get, url, timeout=probe_timeout, verify=False))
+    except requests.RequestException as ex:
+        return f'{type(ex).__name__}: {ex}'
+    if response.status_code not in expected_statuses:
+        return f'HTTP {response.status_code} from {url}'
+    return None
+
+
+# pylint: disable=too-many-arguments
+async def _wait_for_host(host: str, port: Optional[int], health_url: Optional[str],
+                         probe_timeout: float, deadline: float,
+                         expected_statuses: Iterable[int],
+                         waiter: AdaptiveWaiter) -> Dict[str, Any]:
+    """Probe one host until it is ready or the (loop time) deadline passes."""
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
+    attempt = 0
+    error: Optional[str] = None
+    while True:
+        attempt += 1
+        error = None
+        if port is not None:
+            error = await _probe_tcp(host, port, probe_timeout)
+        if error is None and health_url:
+            error = await _probe_http(health_url, probe_timeout, expected_statuses)
+        if error is None:
+            break
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(waiter.backoff_delay(attempt - 1), remaining))
+
+    return {
+        'ready': error is None,
+        'attempts': attempt,
+        'error': error,
+        'elapsed': loop.time() - start_time
+    }
+
+
+# pylint: disable=too-many-arguments
+async def probe_hosts(hosts: List[str], port: Optional[int] = 3389,
+                      health_url_template: Optional[str] = None,
+                      probe_timeout: float = 5, timeout: float = 600,
+                      initial_interval: float = 2, max_interval: float = 15,
+                      expected_statuses: Iterable[int] = (200,)) -> Dict[str, Dict[str, Any]]:
+    """Probe many hosts concurrently until all of them are ready or the timeout passes.
+
+    Args:
+        hosts (List[str]): The DNS names (or addresses) of the hosts.
+        port (Optional[int]): The TCP port which must accept connections.  None skips the TCP
+        check.
+        health_url_template (Optional[str]): (OPTIONAL) A URL which must answer with one of the
+        expected statuses.  '{host}' is replaced with each host name.
+        probe_timeout (float): The time (seconds) allowed for each individual probe.
+        timeout (float): The total time (seconds) allowed for all hosts.
+        initial_interval (float): The first delay (seconds) between probes of a host.
+        max_interval (float): The longest delay (seconds) between probes of a host.
+        expected_statuses (Iterable[int]): The HTTP statuses which mean a host is healthy.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The result for each host.  It has the following structure:
+            {
+                '<host>': {
+                    'ready': (bool)<whether the host became ready>,
+                    'attempts': (int)<number of probes>,
+                    'error': (str)'<last probe error, or None if ready>',
+                    'elapsed': (float)<seconds until ready or until giving up>
+                }
+            }
+    """
+    validate_args_for_value(hosts=hosts)
+    waiter = AdaptiveWaiter(initial_delay=initial_interval, max_delay=max_interval)
+    deadline = asyncio.get_event_loop().time() + timeout
+    results = await asyncio.gather(*[
+        _wait_for_host(
+            host=host,
+            port=port,
+            health_url=health_url_template.format(host=host) if health_url_template else None,
+            probe_timeout=probe_timeout,
+            deadline=deadline,
+            expected_statuses=tuple(expected_statuses),
+            waiter=waiter
+        ) for host in hosts
+    ])
+    return dict(zip(hosts, results))
+
+
+def check_ports(hosts: List[str], port: int, probe_timeout: float = 2) -> Dict[str, bool]:
+    """Check once (concurrently) whether a port accepts connections on each host.
+
+    Args:
+        hosts (List[str]): The DNS names (or addresses) of the hosts.
+        port (int): The TCP port to check.
+        probe_timeout (float): The time (seconds) allowed for each connection attempt.
+
+    Returns:
+        Dict[str, bool]: Whether the port is open on each host.
+    """
+    async def _check_all() -> List[Optional[str]]:
+        return await asyncio.gather(*[_probe_tcp(_, port, probe_timeout) for _ in hosts])
+
+    # The probes are recorded / replayed by the installed cassette, if any.
+    return replay_or_record(
+        'check_ports', {'hosts': hosts, 'port': port},
+        lambda: {host: error is None for host, error in zip(hosts, asyncio.run(_check_all()))})
+
+
+# pylint: disable=too-many-arguments
+def wait_for_hosts_ready(hosts: List[str], port: Optional[int] = 3389,
+                         health_url_template: Optional[str] = None,
+                         probe_timeout: float = 5, timeout: float = 600,
+                         raise_on_timeout: bool = True, **kwargs) -> Dict[str, Dict[str, Any]]:
+    """Wait (blocking) for many hosts to be ready.  See probe_hosts for the details.
+
+    Args:
+        hosts (List[str]): The DNS names (or addresses) of the hosts.
+        port (Optional[int]): The TCP port which must accept connections.
+        health_url_template (Optional[str]): (OPTIONAL) A health URL; '{host}' is replaced with
+        each host name.
+        probe_timeout (float): The time (seconds) allowed for each individual probe.
+        timeout (float): The total time (seconds) allowed for all hosts.
+        raise_on_timeout (bool): Whether to raise if any host was not ready in time.
+        **kwargs: Other arguments for probe_hosts.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The result for each host (see probe_hosts).
+
+    Raises:
+        ConnectionError: If raise_on_timeout is True and any host missed the deadline.  The
+        message names exactly those hosts and their last errors.
+    """
+    # The probes are recorded / replayed by the installed cassette, if any.
+    results = replay_or_record(
+        'wait_for_hosts_ready',
+        {'hosts': hosts, 'port': port, 'health_url_template': health_url_template},
+        lambda: asyncio.run(probe_hosts(
+            hosts, port=port, health_url_template=health_url_template,
+            probe_timeout=probe_timeout, timeout=timeout, **kwargs)))
+
+    not_ready = {host: result['error'] for host, result in results.items() if not result['ready']}
+    if not_ready:
+        LOGGER.write(f'Hosts not ready after {timeout} seconds: {not_ready}', 'error')
+        if raise_on_timeout:
+            raise ConnectionError(f'Hosts not ready after {timeout} seconds: {not_ready}')
+    else:
+        LOGGER.write(f'All hosts are ready: {hosts}')
+    return results
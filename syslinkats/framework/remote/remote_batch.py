@@ -0,0 +1,314 @@
+"""
+remote_batch.py
+
+This module contains a builder which packs many remote command steps into one PowerShell or
+shell script, so that they cost a single SSM round trip (dispatch and polling) instead of one
+each.  The script runs the steps in order and prints one machine-readable result line per step
+(exit code, standard output, standard error and duration), which parse_results turns back into
+per-step results.  A step fails if it exits non-zero or writes to standard error, unless its
+output contains one of the step's ignore strings.
+
+The rendered script can also be registered as an SSM document (named after its content hash),
+so that repeated batches only send the document name.
+"""
+__author__ = 'sedwards'
+
+import base64
+import hashlib
+import json
+import sys
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.validators.validate_args import validate_args_for_value
+
+LOGGER = AutoIndent(sys.stdout)
+
+# The prefix of the result line each step prints.  The rest of the line is a JSON object.
+BATCH_RESULT_MARKER = '##SYSLINKATS-BATCH-STEP##'
+# The most characters of each step's standard output / error kept in its result (the end of the
+# output is kept).  SSM truncates command output, so this keeps every step's result line intact.
+DEFAULT_MAX_STEP_OUTPUT = 2000
+# The name prefix of registered batch documents.
+DEFAULT_BATCH_DOCUMENT_PREFIX = 'SysLinkATS-Batch'
+
+_WINDOWS_HEADER = """$__BatchStopped = $false
+function ConvertTo-BatchResult($Index, $ExitCode, $Stdout, $Stderr, $Seconds, $IgnoreList) {
+    $Failed = ($ExitCode -ne 0) -or [bool]$Stderr
+    $Ignored = $false
+    if ($Failed) {
+        foreach ($Token in $IgnoreList) {
+            if (($Stdout + $Stderr).Contains($Token)) { $Ignored = $true }
+        }
+    }
+    $Result = [ordered]@{
+        Index = $Index; ExitCode = $ExitCode; Duration = [math]::Round($Seconds, 3)
+        Stdout = [Convert]::ToBase64String([Text.Encoding]::UTF8.GetBytes($Stdout))
+        Stderr = [Convert]::ToBase64String([Text.Encoding]::UTF8.GetBytes($Stderr))
+        Failed = ($Failed -and -not $Ignored); Ignored = $Ignored
+    }
+    '{marker}' + ($Result | ConvertTo-Json -Compress)
+}
+function Limit-BatchOutput($Text) {
+    if ($Text.Length -gt {max_output}) { $Text.Substring($Text.Length - {max_output}) } else { $Text }
+}
+"""
+
+_WINDOWS_STEP = """# Step {index}: {name}
+if (-not $__BatchStopped) {{
+    $__Stdout = New-Object System.Collections.Generic.List[string]
+    $__Stderr = New-Object System.Collections.Generic.List[string]
+    $__ExitCode = 0
+    $global:LASTEXITCODE = 0
+    $__Watch = [Diagnostics.Stopwatch]::StartNew()
+    try {{
+        & {{
+{command}
+        }} 2>&1 | ForEach-Object {{
+            if ($_ -is [System.Management.Automation.ErrorRecord]) {{ $__Stderr.Add($_.ToString()) }}
+            else {{ $__Stdout.Add(($_ | Out-String).TrimEnd()) }}
+        }}
+        if ($LASTEXITCODE) {{ $__ExitCode = $LASTEXITCODE }}
+    }} catch {{
+        $__Stderr.Add($_.ToString())
+        $__ExitCode = 1
+    }}
+    $__Watch.Stop()
+    $__Line = ConvertTo-BatchResult {index} $__ExitCode (Limit-BatchOutput ($__Stdout -join "`n")) `
+        (Limit-BatchOutput ($__Stderr -join "`n")) $__Watch.Elapsed.TotalSeconds @({ignore_list})
+    Write-Output $__Line
+    if ({stop_on_failure} -and $__Line.Contains('"Failed":true')) {{ $__BatchStopped = $true }}
+}}
+"""
+
+_LINUX_HEADER = """__batch_stopped=''
+__batch_out=$(mktemp)
+__batch_err=$(mktemp)
+trap 'rm -f "$__batch_out" "$__batch_err"' EXIT
+__batch_b64() {
+    tail -c {max_output} "$1" | base64 | tr -d '\\n'
+}
+__batch_result() {
+    __index=$1; __code=$2; __seconds=$(awk "BEGIN { printf \\"%.3f\\", $4 - $3 }"); shift 4
+    __failed=false; __ignored=false
+    if [ "$__code" -ne 0 ] || [ -s "$__batch_err" ]; then
+        __failed=true
+        for __token in "$@"; do
+            if grep -qF -- "$__token" "$__batch_out" "$__batch_err"; then __ignored=true; fi
+        done
+        if [ "$__ignored" = true ]; then __failed=false; fi
+    fi
+    __format='%s{"Index": %s, "ExitCode": %s, "Duration": %s, "Stdout": "%s", "Stderr": "%s", '
+    __format="$__format"'"Failed": %s, "Ignored": %s}\\n'
+    printf "$__format" '{marker}' "$__index" "$__code" "$__seconds" \\
+        "$(__batch_b64 "$__batch_out")" "$(__batch_b64 "$__batch_err")" "$__failed" "$__ignored"
+    [ "$__failed" = false ]
+}
+"""
+
+_LINUX_STEP = """# Step {index}: {name}
+if [ -z "$__batch_stopped" ]; then
+    __start=$(date +%s.%N)
+    (
+{command}
+    ) >"$__batch_out" 2>"$__batch_err"
+    __code=$?
+    __batch_result {index} "$__code" "$__start" "$(date +%s.%N)" {ignore_list} \\
+        || {stop_action}
+fi
+"""
+
+
+def _quote_powershell(text: str) -> str:
+    """Quote a string as a PowerShell literal."""
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _quote_shell(text: str) -> str:
+    """Quote a string as a POSIX shell literal."""
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+class RemoteBatch:
+    """Builds a script which runs many remote command steps and reports a result for each."""
+
+    def __init__(self, platform_type: str = 'Windows', stop_on_failure: bool = True,
+                 max_step_output: int = DEFAULT_MAX_STEP_OUTPUT):
+        """Initialize the batch.
+
+        Args:
+            platform_type (str): Target platform for the script. Either 'Windows' (PowerShell)
+            or 'Linux' (shell).
+            stop_on_failure (bool): Whether the steps after a failed step are skipped.  Steps
+            can override this with continue_on_failure.
+            max_step_output (int): The most characters of each step's standard output / error
+            kept in its result.
+        """
+        if platform_type not in ('Windows', 'Linux'):
+            raise ValueError(f'Unsupported platform type: {platform_type}')
+        self.platform_type = platform_type
+        self.stop_on_failure = stop_on_failure
+        self.max_step_output = max_step_output
+        self.steps: List[Dict[str, Any]] = []
+
+    def add_step(self, name: str, command: str, ignore_list: List[str] = None,
+                 continue_on_failure: bool = False) -> 'RemoteBatch':
+        """Add a step to the batch.
+
+        Args:
+            name (str): The name of the step (used in its result).
+            command (str): The PowerShell / shell command(s) of the step.
+            ignore_list (List[str]): (OPTIONAL) Strings which, if found in the step's output,
+            mean that its non-zero exit code or error output is expected (e.g. 'already been
+            shared').
+            continue_on_failure (bool): Whether the batch carries on if this step fails.
+
+        Returns:
+            RemoteBatch: The batch, so that calls can be chained.
+        """
+        validate_args_for_value(name=name, command=command)
+        self.steps.append({
+            'Name': name,
+            'Command': command,
+            'IgnoreList': list(ignore_list or []),
+            'ContinueOnFailure': continue_on_failure
+        })
+        return self
+
+    def render(self) -> str:
+        """Render the script which runs every step.
+
+        Returns:
+            str: The PowerShell or shell script.
+        """
+        validate_args_for_value(steps=self.steps, test_for_empty_false_zero=True)
+        if self.platform_type == 'Windows':
+            header = _WINDOWS_HEADER.replace('{marker}', BATCH_RESULT_MARKER) \
+                .replace('{max_output}', str(self.max_step_output))
+            steps = [
+                _WINDOWS_STEP.format(
+                    index=index,
+                    name=' '.join(step['Name'].split()),
+                    command=step['Command'],
+                    ignore_list=', '.join(_quote_powershell(_) for _ in step['IgnoreList']),
+                    stop_on_failure='$false' if step['ContinueOnFailure']
+                    or not self.stop_on_failure else '$true')
+                for index, step in enumerate(self.steps)
+            ]
+        else:
+            header = _LINUX_HEADER.replace('{marker}', BATCH_RESULT_MARKER) \
+                .replace('{max_output}', str(self.max_step_output))
+            steps = [
+                _LINUX_STEP.format(
+                    index=index,
+                    name=' '.join(step['Name'].split()),
+                    command=step['Command'],
+                    ignore_list=' '.join(_quote_shell(_) for _ in step['IgnoreList']),
+                    stop_action='true' if step['ContinueOnFailure']
+                    or not self.stop_on_failure else '__batch_stopped=1')
+                for index, step in enumerate(self.steps)
+            ]
+        return header + '\n'.join(steps)
+
+    def parse_results(self, output: Optional[str]) -> List[Dict[str, Any]]:
+        """Parse the result lines which the script printed.
+
+        Args:
+            output (Optional[str]): The standard output of the script.
+
+        Returns:
+            List[Dict[str, Any]]: The result of every step, in order, with the structure:
+                [{'Name': '<step name>', 'Status': 'Success' | 'Ignored' | 'Failed' | 'Skipped',
+                  'ExitCode': <int or None>, 'StandardOutputContent': '<stdout>',
+                  'StandardErrorContent': '<stderr>', 'Duration': <seconds>}]
+            Steps without a result line (skipped, or cut off by a crash or time out) are
+            'Skipped'.
+        """
+        reported: Dict[int, Dict[str, Any]] = {}
+        for line in (output or '').splitlines():
+            _, marker, payload = line.partition(BATCH_RESULT_MARKER)
+            if not marker:
+                continue
+            try:
+                record = json.loads(payload)
+            except ValueError:
+                LOGGER.write(f'Ignoring a malformed batch result line: {line}', 'warning')
+                continue
+            reported[int(record['Index'])] = record
+
+        results = []
+        for index, step in enumerate(self.steps):
+            record = reported.get(index)
+            if record is None:
+                results.append({'Name': step['Name'], 'Status': 'Skipped', 'ExitCode': None,
+                                'StandardOutputContent': '', 'StandardErrorContent': '',
+                                'Duration': 0.0})
+                continue
+
+            if record['Failed']:
+                status = 'Failed'
+            elif record['Ignored']:
+                status = 'Ignored'
+            else:
+                status = 'Success'
+            results.append({
+                'Name': step['Name'],
+                'Status': status,
+                'ExitCode': int(record['ExitCode']),
+                'StandardOutputContent':
+                    base64.b64decode(record['Stdout']).decode('utf-8', 'replace').strip(),
+                'StandardErrorContent':
+                    base64.b64decode(record['Stderr']).decode('utf-8', 'replace').strip(),
+                'Duration': float(record['Duration'])
+            })
+        return results
+
+    def document_content(self) -> Dict[str, Any]:
+        """Build the content of an SSM command document which runs the batch."""
+        action = 'aws:runPowerShellScript' if self.platform_type == 'Windows' \
+            else 'aws:runShellScript'
+        return {
+            'schemaVersion': '2.2',
+            'description': f'SystemLink ATS batch of {len(self.steps)} step(s).',
+            'mainSteps': [{
+                'action': action,
+                'name': 'runBatch',
+                'inputs': {'runCommand': self.render().splitlines()}
+            }]
+        }
+
+    def register_document(self, aws_instance: Any,
+                          name_prefix: str = DEFAULT_BATCH_DOCUMENT_PREFIX) -> str:
+        """Register the batch as an SSM command document, unless it is registered already.
+
+        The document is named after the hash of its content, so registering the same batch
+        again (from any process) reuses the existing document.
+
+        Args:
+            aws_instance (Any): An AWSInstance (or AWSBase) of the region to register in.
+            name_prefix (str): The document name prefix.
+
+        Returns:
+            str: The document name.
+        """
+        content = json.dumps(self.document_content(), sort_keys=True)
+        document_name = f'{name_prefix}-{hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]}'
+        ssm_client = aws_instance.ssm_client
+        try:
+            ssm_client.create_document(Content=content, Name=document_name,
+                                       DocumentType='Command', DocumentFormat='JSON')
+            LOGGER.write(f'Registered the batch document {document_name}.')
+        except ClientError as ex:
+            if ex.response.get('Error', {}).get('Code') != 'DocumentAlreadyExists':
+                raise
+
+        aws_instance.make_waiter(
+            initial_delay=1, max_delay=5, timeout=60,
+            description=f'document {document_name}').wait(
+                poll=lambda: ssm_client.describe_document(
+                    Name=document_name)['Document']['Status'],
+                is_done=lambda status: status == 'Active',
+                is_failed=lambda status: status == 'Failed')
+        return document_name
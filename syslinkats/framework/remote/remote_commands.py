@@ -6,16 +6,35 @@ This module contains functions for running remote commands, specifically on AWS
 __author__ = 'sedwards'
 
 import sys
-import time
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Sequence, Union
 
 from syslinkats.framework.aws.aws_instance import AWSInstance
 from syslinkats.framework.errors.custom_errors import RemoteCommandOutputNotEmpty
 from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.remote.remote_batch import RemoteBatch
 from syslinkats.framework.validators.validate_args import validate_args_for_value
 
 LOGGER = AutoIndent(sys.stdout)
 
+# SendCommand accepts at most this many instance Ids per call.
+MAX_SEND_COMMAND_TARGETS = 50
+
+# Used by fan-out scripts to look up which instance they are running on (IMDSv1 and IMDSv2).
+_WINDOWS_INSTANCE_ID_LOOKUP = (
+    "$Token = Invoke-RestMethod -Method PUT -Uri 'http://169.254.169.254/latest/api/token' "
+    "-Headers @{'X-aws-ec2-metadata-token-ttl-seconds' = '60'}\n"
+    "$InstanceId = Invoke-RestMethod -Uri "
+    "'http://169.254.169.254/latest/meta-data/instance-id' "
+    "-Headers @{'X-aws-ec2-metadata-token' = $Token}"
+)
+_LINUX_INSTANCE_ID_LOOKUP = (
+    "TOKEN=$(curl -s -X PUT http://169.254.169.254/latest/api/token "
+    "-H 'X-aws-ec2-metadata-token-ttl-seconds: 60')\n"
+    "INSTANCE_ID=$(curl -s -H \"X-aws-ec2-metadata-token: $TOKEN\" "
+    "http://169.254.169.254/latest/meta-data/instance-id)"
+)
+
 
 # pylint: disable=too-many-arguments
 def run_aws_remote_command(region_name: str = None,
@@ -73,6 +92,7 @@ def run_aws_remote_command(region_name: str = None,
     if not output_ignore_list:
         output_ignore_list = []
 
+    retry_waiter = aws_instance.make_waiter(initial_delay=5, max_delay=30)
     for retry_index in range(retry_count):
         # Run the remote command.
         LOGGER.write(f'Running remote command on {target_public_dns_names}: {remote_command}')
@@ -107,4 +127,245 @@ def run_aws_remote_command(region_name: str = None,
         elif not output:
             break
 
-        time.sleep(10)
+        aws_instance.clock.sleep(retry_waiter.backoff_delay(retry_index))
+
+
+def render_fan_out_command(instance_commands: Dict[str, str],
+                           platform_type: str = 'Windows') -> str:
+    """Build a single script which runs a different command on each target instance.
+
+    SSM sends the same parameters to every target of a SendCommand call, so the script looks
+    up the Id of the instance it is running on and dispatches to that instance's command.  If
+    every instance has the same command, then that command is returned as-is.
+
+    Args:
+        instance_commands (Dict[str, str]): The rendered command for each instance Id.
+        platform_type (str): Target platform for the command. Either 'Windows' or 'Linux'.
+
+    Returns:
+        str: The script to send to all the instances.
+    """
+    validate_args_for_value(instance_commands=instance_commands, test_for_empty_false_zero=True)
+    unique_commands = set(instance_commands.values())
+    if len(unique_commands) == 1:
+        return unique_commands.pop()
+
+    if platform_type == 'Windows':
+        cases = ''.join(f"    '{instance_id}' {{\n{command}\n    }}\n"
+                        for instance_id, command in instance_commands.items())
+        return (f'{_WINDOWS_INSTANCE_ID_LOOKUP}\n'
+                f'switch ($InstanceId) {{\n{cases}'
+                '    default { Write-Error "No command was rendered for instance $InstanceId." }\n'
+                '}')
+
+    cases = ''.join(f'    {instance_id})\n{command}\n    ;;\n'
+                    for instance_id, command in instance_commands.items())
+    return (f'{_LINUX_INSTANCE_ID_LOOKUP}\n'
+            f'case "$INSTANCE_ID" in\n{cases}'
+            '    *) echo "No command was rendered for instance $INSTANCE_ID." >&2 ;;\n'
+            'esac')
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+def run_aws_remote_command_fan_out(
+        region_name: str = None,
+        target_public_dns_names: List[str] = None,
+        instance_ids: List[str] = None,
+        remote_command_template: str = None,
+        instance_parameters: Optional[List[Union[Sequence[Any], Dict[str, Any]]]] = None,
+        output_ignore_list: List[str] = None,
+        total_command_run_time: int = 300,
+        retry_count: int = 3,
+        platform_type: str = 'Windows') -> Dict[str, Dict[str, Any]]:
+    """Run a templated command on many AWS instances with one SendCommand per 50 instances.
+
+    The template is rendered once per instance (using str.format) with that instance's
+    parameters, and all the instances are polled together, so running the command on many
+    instances takes about as long as running it on one.  Instances whose command timed out or
+    produced error output that is not in the ignore list are retried (only those instances).
+    As with run_aws_remote_command, error output in the ignore list is ignored whatever the
+    command's status.
+
+    Args:
+        region_name (str): The AWS region where your instances reside.
+        target_public_dns_names (List[str]): The public DNS names of the target systems.
+        instance_ids (List[str]): (OPTIONAL) The instance Ids of the target instances, in the
+        same order as target_public_dns_names.
+        remote_command_template (str): The command to run.  It may contain str.format fields.
+        instance_parameters (Optional[List[Union[Sequence[Any], Dict[str, Any]]]]): The format
+        arguments for each instance, in the order of the instances.  A sequence is used as
+        positional arguments and a dict as keyword arguments.  If omitted, the template is
+        sent as-is.
+        output_ignore_list (List[str]): A list of output error / warning codes to ignore
+        when processing the command output.
+        total_command_run_time (int): The total time (seconds) allowed for commands to run on
+        all target instances.
+        retry_count (int): The number of times to run the command on failing instances.
+        platform_type (str): Target platform for the command. Either 'Windows' or 'Linux'.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The result of the command for each instance Id (see
+        AWSInstance.list_command_invocation_results for the structure).
+
+    Raises:
+        RemoteCommandOutputNotEmpty: If any instance still had error output after all retries.
+    """
+    validate_args_for_value(
+        region_name=region_name,
+        remote_command_template=remote_command_template,
+        total_command_run_time=total_command_run_time
+    )
+
+    if not target_public_dns_names and not instance_ids:
+        raise ValueError('You must provide either public DNS names or instance Ids.')
+
+    aws_instance = AWSInstance(region_name=region_name)
+    if not instance_ids:
+        instance_ids = list(
+            aws_instance.map_public_dns_names_to_ids(target_public_dns_names).values())
+        if not all(instance_ids):
+            raise ValueError(f'Unable to resolve the instance Ids of: {target_public_dns_names}')
+
+    instance_commands: Dict[str, str] = {}
+    for index, instance_id in enumerate(instance_ids):
+        parameters = instance_parameters[index] if instance_parameters else None
+        if isinstance(parameters, dict):
+            instance_commands[instance_id] = remote_command_template.format(**parameters)
+        elif parameters is not None:
+            instance_commands[instance_id] = remote_command_template.format(*parameters)
+        else:
+            instance_commands[instance_id] = remote_command_template
+
+    if not output_ignore_list:
+        output_ignore_list = []
+
+    def _send(target_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        return aws_instance.send_commands(
+            instance_ids=target_ids,
+            commands=[render_fan_out_command(
+                {_: instance_commands[_] for _ in target_ids}, platform_type=platform_type)],
+            total_command_run_time=total_command_run_time,
+            platform_type=platform_type,
+            return_instance_results=True
+        )
+
+    results: Dict[str, Dict[str, Any]] = {}
+    pending_ids = list(instance_ids)
+    retry_waiter = aws_instance.make_waiter(initial_delay=5, max_delay=30)
+    for retry_index in range(retry_count):
+        LOGGER.write(f'Running remote command on {pending_ids}: {remote_command_template}')
+        chunks = [pending_ids[_:_ + MAX_SEND_COMMAND_TARGETS]
+                  for _ in range(0, len(pending_ids), MAX_SEND_COMMAND_TARGETS)]
+        timed_out_ids = set()
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = {executor.submit(_send, _): _ for _ in chunks}
+            for future in as_completed(futures):
+                try:
+                    results.update(future.result())
+                except TimeoutError:
+                    # Only the instances of the chunk which timed out run the command again.
+                    timed_out_ids.update(futures[future])
+                    for instance_id in futures[future]:
+                        results.pop(instance_id, None)
+
+        pending_ids = [
+            instance_id for instance_id in pending_ids
+            if instance_id in timed_out_ids
+            or (results[instance_id]['StandardErrorContent'] and not any(
+                _ in results[instance_id]['StandardErrorContent'] for _ in output_ignore_list))
+        ]
+        if not pending_ids:
+            break
+        if retry_index < retry_count - 1:
+            LOGGER.write(f'Retrying remote command on {pending_ids}: {remote_command_template}')
+            # Give transient failures (e.g. an instance not yet registered with SSM) time to
+            # clear.
+            aws_instance.clock.sleep(retry_waiter.backoff_delay(retry_index))
+
+    if pending_ids:
+        output = {
+            _: results[_]['StandardErrorContent'] if _ in results
+            else 'Total command run time exceeded.' for _ in pending_ids
+        }
+        LOGGER.write(output, 'exception')
+        raise RemoteCommandOutputNotEmpty(output)
+
+    return {_: results[_] for _ in instance_ids}
+
+
+# pylint: disable=too-many-arguments
+def run_aws_remote_batch(region_name: str = None,
+                         target_public_dns_names: List[str] = None,
+                         instance_ids: List[str] = None,
+                         batch: RemoteBatch = None,
+                         total_command_run_time: int = 300,
+                         register_document: bool = False,
+                         raise_on_failure: bool = True,
+                         **send_kwargs: Any) -> Dict[str, List[Dict[str, Any]]]:
+    """Run every step of a RemoteBatch on AWS instances with a single SendCommand.
+
+    Args:
+        region_name (str): The AWS region where your instances reside.
+        target_public_dns_names (List[str]): The public DNS names of the target systems.
+        instance_ids (List[str]): (OPTIONAL) The instance Ids of the target instances.
+        batch (RemoteBatch): The steps to run.
+        total_command_run_time (int): The total time (seconds) allowed for the batch to run on
+        all target instances.
+        register_document (bool): Whether to run the batch as a registered SSM document (see
+        RemoteBatch.register_document) rather than sending its script.
+        raise_on_failure (bool): Whether to raise if any step failed on any instance.
+        Otherwise the failed steps are logged.
+        **send_kwargs (Any): Other arguments for AWSInstance.send_commands (for example
+        output_s3_bucket_name).
+
+    Returns:
+        Dict[str, List[Dict[str, Any]]]: The step results of each instance Id (see
+        RemoteBatch.parse_results for the structure).
+
+    Raises:
+        RemoteCommandOutputNotEmpty: If raise_on_failure is True and any step failed.
+    """
+    validate_args_for_value(region_name=region_name, batch=batch)
+    if not target_public_dns_names and not instance_ids:
+        raise ValueError('You must provide either public DNS names or instance Ids.')
+
+    aws_instance = AWSInstance(region_name=region_name)
+    if not instance_ids:
+        instance_ids = list(
+            aws_instance.map_public_dns_names_to_ids(target_public_dns_names).values())
+        if not all(instance_ids):
+            raise ValueError(f'Unable to resolve the instance Ids of: {target_public_dns_names}')
+
+    step_names = [_['Name'] for _ in batch.steps]
+    LOGGER.write(f'Running a batch of {len(step_names)} step(s) on {instance_ids}: {step_names}')
+    if register_document:
+        send_kwargs['document_name'] = batch.register_document(aws_instance)
+    else:
+        send_kwargs['commands'] = [batch.render()]
+
+    instance_results = aws_instance.send_commands(
+        instance_ids=instance_ids,
+        total_command_run_time=total_command_run_time,
+        platform_type=batch.platform_type,
+        return_instance_results=True,
+        log_error_as_warning=True,
+        **send_kwargs
+    )
+
+    step_results = {
+        instance_id: batch.parse_results(result['StandardOutputContent'])
+        for instance_id, result in instance_results.items()
+    }
+    failures = {
+        instance_id: [f'{_["Name"]}: {_["StandardErrorContent"] or _["ExitCode"]}'
+                      for _ in results if _['Status'] == 'Failed']
+        for instance_id, results in step_results.items()
+    }
+    failures = {instance_id: steps for instance_id, steps in failures.items() if steps}
+    if failures:
+        LOGGER.write(f'Failed batch steps: {failures}',
+                     'exception' if raise_on_failure else 'warning')
+        if raise_on_failure:
+            raise RemoteCommandOutputNotEmpty(failures)
+    return step_results
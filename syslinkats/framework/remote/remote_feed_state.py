@@ -0,0 +1,189 @@
+"""
+remote_feed_state.py
+
+This module probes the NI Package Manager state of remote instances (their registered feeds and
+installed packages) in a single remote batch, and diffs it against the feeds which should be
+installed.  The result is a FeedStatePlan per instance, which names only the feed operations
+that are still needed, so that re-provisioning an instance which already has the requested
+feeds (e.g. a dev worker) does not remove, re-add and re-install all of them.
+
+The diff errs on the side of running operations: a feed whose state can not be determined (for
+example because the probe failed, or its output was truncated) is treated as missing.
+"""
+__author__ = 'sedwards'
+
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.remote.remote_batch import RemoteBatch
+from syslinkats.framework.remote.remote_commands import run_aws_remote_batch
+from syslinkats.framework.validators.validate_args import validate_args_for_value
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+# The default path of the NI Package Manager CLI on Windows instances.
+DEFAULT_NIPKG_PATH = r'C:\Program Files\National Instruments\NI Package Manager\nipkg.exe'
+# The most characters kept from each probe step's output.  The installed package list of a
+# SystemLink server is long, but SSM truncates command output at 24000 characters.
+DEFAULT_PROBE_MAX_STEP_OUTPUT = 10000
+# The names of the probe steps.
+FEED_LIST_STEP = 'nipkg feed-list'
+LIST_INSTALLED_STEP = 'nipkg list-installed'
+
+
+def parse_nipkg_listing(output: Optional[str]) -> Dict[str, str]:
+    """Parse nipkg feed-list or list-installed output.
+
+    Both print one item per line: its name, then its URI (feeds) or version (packages),
+    separated by tabs or spaces.
+
+    Args:
+        output (Optional[str]): The output of the nipkg command.
+
+    Returns:
+        Dict[str, str]: The URI or version of each feed or package name.
+    """
+    listing = {}
+    for line in (output or '').splitlines():
+        fields = line.split('\t') if '\t' in line else line.split()
+        fields = [_.strip() for _ in fields if _.strip()]
+        if len(fields) >= 2:
+            listing[fields[0]] = fields[1]
+    return listing
+
+
+class FeedStatePlan:
+    """The feed operations still needed to bring an instance to the requested feeds."""
+
+    def __init__(self, feed_items: List[Tuple[str, str]], current_feeds: Dict[str, str],
+                 installed_packages: Dict[str, str]):
+        """Diff the current state of an instance against the requested feeds.
+
+        A requested feed is:
+        * up to date if it is registered with the same URI and its package is installed;
+        * to be installed only, if it is registered with the same URI but its package is not
+          installed;
+        * to be re-added (and installed) if it is registered with a different URI;
+        * to be added (and installed) if it is not registered.
+
+        Args:
+            feed_items (List[Tuple[str, str]]): The requested (feed name, feed URI) items.
+            current_feeds (Dict[str, str]): The registered feeds (see parse_nipkg_listing).
+            installed_packages (Dict[str, str]): The installed packages and their versions.
+        """
+        self.feeds_to_remove: List[Tuple[str, str]] = []
+        self.feeds_to_add: List[Tuple[str, str]] = []
+        self.feeds_to_install: List[Tuple[str, str]] = []
+        self.up_to_date_feeds: List[Tuple[str, str]] = []
+        self.installed_versions: Dict[str, str] = {}
+
+        for feed_name, feed_uri in feed_items:
+            current_uri = current_feeds.get(feed_name)
+            if current_uri is not None and current_uri.rstrip('/') != feed_uri.rstrip('/'):
+                self.feeds_to_remove.append((feed_name, feed_uri))
+            if current_uri is None or current_uri.rstrip('/') != feed_uri.rstrip('/'):
+                self.feeds_to_add.append((feed_name, feed_uri))
+                self.feeds_to_install.append((feed_name, feed_uri))
+            elif feed_name not in installed_packages:
+                self.feeds_to_install.append((feed_name, feed_uri))
+            else:
+                self.installed_versions[feed_name] = installed_packages[feed_name]
+                self.up_to_date_feeds.append((feed_name, feed_uri))
+
+    @property
+    def update_feeds(self) -> bool:
+        """Whether Package Manager must refresh its feeds (as feeds were added)."""
+        return bool(self.feeds_to_add)
+
+    @property
+    def upgrade_package_manager(self) -> bool:
+        """Whether Package Manager itself must be upgraded (as its feed was added)."""
+        return any('package-manager' in _[0] for _ in self.feeds_to_add)
+
+    @property
+    def restart_instance(self) -> bool:
+        """Whether the instance must be restarted (as software was installed)."""
+        return bool(self.feeds_to_install) or self.upgrade_package_manager
+
+    @property
+    def is_empty(self) -> bool:
+        """Whether the instance already has every requested feed installed."""
+        return not self.feeds_to_add and not self.feeds_to_install
+
+    @property
+    def key(self) -> tuple:
+        """A hashable summary of the plan, so that instances with the same plan are grouped."""
+        return (tuple(self.feeds_to_remove), tuple(self.feeds_to_add),
+                tuple(self.feeds_to_install))
+
+    def describe(self) -> List[str]:
+        """Describe the plan, one line per operation."""
+        lines = [f'Remove feed {_[0]} (its URI changed to {_[1]})' for _ in self.feeds_to_remove]
+        lines.extend(f'Add feed {_[0]}: {_[1]}' for _ in self.feeds_to_add)
+        if self.update_feeds:
+            lines.append('Update all feeds')
+        if self.upgrade_package_manager:
+            lines.append('Upgrade Package Manager Updater and Package Manager')
+        lines.extend(f'Install {_[0]}' for _ in self.feeds_to_install)
+        if self.restart_instance:
+            lines.append('Restart the instance')
+        lines.extend(f'Skip {name} (installed: {version})'
+                     for name, version in self.installed_versions.items())
+        return lines
+
+
+def build_feed_state_probe(nipkg_path: str = DEFAULT_NIPKG_PATH) -> RemoteBatch:
+    """Build the batch which lists the registered feeds and installed packages of an instance.
+
+    Args:
+        nipkg_path (str): The path of the NI Package Manager CLI on the instance.
+
+    Returns:
+        RemoteBatch: The probe batch.  Its steps never stop the batch.
+    """
+    batch = RemoteBatch(stop_on_failure=False, max_step_output=DEFAULT_PROBE_MAX_STEP_OUTPUT)
+    batch.add_step(FEED_LIST_STEP, f'& "{nipkg_path}" feed-list')
+    batch.add_step(LIST_INSTALLED_STEP, f'& "{nipkg_path}" list-installed')
+    return batch
+
+
+def probe_feed_state(region_name: str = None,
+                     target_public_dns_names: List[str] = None,
+                     instance_ids: List[str] = None,
+                     feed_items: List[Tuple[str, str]] = None,
+                     nipkg_path: str = DEFAULT_NIPKG_PATH) -> Dict[str, FeedStatePlan]:
+    """Probe the feed state of instances and plan the feed operations each one still needs.
+
+    Args:
+        region_name (str): The AWS region where your instances reside.
+        target_public_dns_names (List[str]): The public DNS names of the target systems.
+        instance_ids (List[str]): (OPTIONAL) The instance Ids of the target instances.
+        feed_items (List[Tuple[str, str]]): The requested (feed name, feed URI) items.
+        nipkg_path (str): The path of the NI Package Manager CLI on the instances.
+
+    Returns:
+        Dict[str, FeedStatePlan]: The plan of each instance Id.
+    """
+    validate_args_for_value(region_name=region_name, feed_items=feed_items)
+    step_results = run_aws_remote_batch(
+        region_name=region_name,
+        target_public_dns_names=target_public_dns_names,
+        instance_ids=instance_ids,
+        batch=build_feed_state_probe(nipkg_path),
+        total_command_run_time=120,
+        raise_on_failure=False
+    )
+
+    plans = {}
+    for instance_id, results in step_results.items():
+        listings = {
+            _['Name']: parse_nipkg_listing(_['StandardOutputContent'])
+            if _['Status'] == 'Success' else {}
+            for _ in results
+        }
+        plans[instance_id] = FeedStatePlan(
+            feed_items=feed_items,
+            current_feeds=listings.get(FEED_LIST_STEP, {}),
+            installed_packages=listings.get(LIST_INSTALLED_STEP, {}))
+    return plans
@@ -19,7 +19,8 @@ import pytest
 from syslinkats.framework.errors.error_handlers.process_errors import handle_process_errors
 from syslinkats.framework.local.local_shell_commands import call_subprocess_popen
 from syslinkats.framework.logging.auto_indent import AutoIndent
-from syslinkats.framework.remote.remote_commands import run_aws_remote_command
+from syslinkats.framework.remote.remote_batch import RemoteBatch
+from syslinkats.framework.remote.remote_commands import run_aws_remote_batch, run_aws_remote_command
 from syslinkats.framework.validators.validate_args import validate_args_for_value
 
 LOGGER = AutoIndent(sys.stdout)
@@ -167,24 +168,27 @@ def set_parent_folder_sharing(ats_config_data: Dict[str, str], path_chain: str,
     """
     for parent_dir in Path(path_chain).parents:
         if Path(parent_dir).exists() and Path(parent_dir).name is parent_name:
-            remote_commands = [
+            # Both steps run in one remote batch.  As before, a failure of either step (such
+            # as the folder already being shared) is logged rather than raised.
+            batch = RemoteBatch(stop_on_failure=False)
+            batch.add_step(
+                'New-SmbShare',
                 f'New-SmbShare -Name {parent_name} -Description "{parent_name} folder" -Path '
                 f'"{parent_dir}"',
+                ignore_list=['already been shared'])
+            batch.add_step(
+                'Grant-SmbShareAccess',
                 f'Grant-SmbShareAccess -Name {parent_name} '
                 f'-AccountName {ats_config_data["syslink_worker_system_username"]} '
-                f'-AccessRight Full -Force'
-            ]
-            for remote_command in remote_commands:
-                try:
-                    run_aws_remote_command(
-                        region_name=ats_config_data['region_name'],
-                        target_public_dns_names=[ats_config_data['syslink_worker_name']],
-                        instance_ids=[ats_config_data['syslink_worker_instance_id']],
-                        remote_command=remote_command
-                    )
-                except Exception as ex:  # pylint: disable=broad-except
-                    if 'already been shared' in str(ex):
-                        pass
+                f'-AccessRight Full -Force')
+            run_aws_remote_batch(
+                region_name=ats_config_data['region_name'],
+                target_public_dns_names=[ats_config_data['syslink_worker_name']],
+                instance_ids=[ats_config_data['syslink_worker_instance_id']],
+                batch=batch,
+                total_command_run_time=60,
+                raise_on_failure=False
+            )
 
 
 def set_parent_folder_full_permissions(
@@ -0,0 +1,117 @@
+"""
+aws_client_instantiation.py
+
+This module benchmarks the cost of creating AWSInstance objects.  It compares the legacy
+behavior (every object eagerly builds an EC2 client, an EC2 resource and an SSM client) with
+the shared, lazily created clients of the AWSSessionRegistry.
+
+No AWS calls are made, but credentials are resolved just as they are in real use, so running
+this on an EC2 host without other credentials includes the instance metadata lookups.
+"""
+__author__ = 'sedwards'
+
+import argparse
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+import boto3
+
+from syslinkats.data.common.aws_default_parameters import DEFAULT_AWS_REGION
+from syslinkats.framework.aws.aws_instance import AWSInstance
+from syslinkats.framework.aws.aws_session_registry import AWSSessionRegistry
+from syslinkats.framework.logging.auto_indent import AutoIndent
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+
+def parse_args() -> argparse.Namespace:
+    """Returns options to the caller.
+
+        This function parses out and returns arguments and options from the
+        commandline arguments.
+
+    Returns:
+        argparse.Namespace: The parsed arguments for the script.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the cost of creating AWSInstance objects.'
+    )
+
+    parser.add_argument(
+        '--region-name', action='store', type=str, default=DEFAULT_AWS_REGION,
+        dest='region_name',
+        help='The AWS region to create clients for.'
+    )
+
+    parser.add_argument(
+        '--iterations', action='store', type=int, default=20,
+        dest='iterations',
+        help='The number of objects to create for each variant.'
+    )
+
+    return parser.parse_args()
+
+
+def _legacy_instantiation(region_name: str) -> None:
+    """Create the clients the way AWSBase did before the registry (eagerly, per object)."""
+    boto3.client('ec2', region_name=region_name)
+    boto3.resource('ec2', region_name=region_name)
+    boto3.client('ssm', region_name=region_name)
+
+
+def _registry_instantiation(region_name: str) -> None:
+    """Create an AWSInstance and touch every client, as a typical caller would."""
+    aws_instance = AWSInstance(region_name=region_name)
+    _ = aws_instance.ec2_client, aws_instance.ec2_resource, aws_instance.ssm_client
+
+
+def time_calls(func: Callable[[str], None], region_name: str,
+               iterations: int) -> Dict[str, float]:
+    """Time repeated calls of an instantiation function.
+
+    Args:
+        func (Callable[[str], None]): The function to time.
+        region_name (str): The AWS region passed to the function.
+        iterations (int): The number of calls.
+
+    Returns:
+        Dict[str, float]: The first, mean (after the first), max and total call times (seconds).
+    """
+    durations: List[float] = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        func(region_name)
+        durations.append(time.perf_counter() - start_time)
+
+    return {
+        'first': durations[0],
+        'mean': statistics.mean(durations[1:]) if len(durations) > 1 else durations[0],
+        'max': max(durations),
+        'total': sum(durations)
+    }
+
+
+def main():
+    """The main execution method for the script."""
+    args = parse_args()
+
+    AWSSessionRegistry.clear()
+    results = {
+        'legacy': time_calls(_legacy_instantiation, args.region_name, args.iterations),
+        'registry': time_calls(_registry_instantiation, args.region_name, args.iterations)
+    }
+
+    LOGGER.write(f'Instantiation cost over {args.iterations} objects (seconds):')
+    LOGGER.write(f'{"variant":<10}{"first":>12}{"mean":>12}{"max":>12}{"total":>12}')
+    for variant, timings in results.items():
+        LOGGER.write(f'{variant:<10}' + ''.join(
+            f'{timings[_]:>12.6f}' for _ in ('first', 'mean', 'max', 'total')))
+
+    speedup = results['legacy']['total'] / max(results['registry']['total'], 1e-9)
+    LOGGER.write(f'The registry is {speedup:.1f}x faster in total.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+"""
+aws_query_layer.py
+
+This module benchmarks the AWS query layer (the AWSInstance / AWSImage filtering, newest
+selection and tag scan paths) against synthetic fleets of 1,000 to 50,000 instances and images,
+and fails if any path regressed compared with a stored baseline.
+
+No AWS calls are made: every DescribeInstances, DescribeImages and DescribeTags request is
+answered locally (with EC2's server-side filters and pagination) through botocore's before-call
+event, and all waits use a ManualClock.
+
+Timings depend on the machine, so each one is also stored divided by the time of a fixed
+pure-Python calibration workload; the baseline comparison uses these normalized timings.  The
+number of API calls of each path is deterministic, and any increase is a regression too.
+
+Usage:
+    python -m syslinkats.stand_alone.benchmarks.aws_query_layer
+    python -m syslinkats.stand_alone.benchmarks.aws_query_layer --save-baseline
+"""
+__author__ = 'sedwards'
+
+import argparse
+import collections
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from typing import Any, Callable, Counter, Dict, List, Tuple
+
+from syslinkats.data.common.aws_default_parameters import DEFAULT_AWS_REGION
+from syslinkats.framework.aws.aws_image import AWSImage
+from syslinkats.framework.aws.aws_instance import AWSInstance
+from syslinkats.framework.common.adaptive_waiter import ManualClock
+from syslinkats.framework.logging.auto_indent import AutoIndent
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+# The default baseline, stored next to this module.
+DEFAULT_BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baselines', 'aws_query_layer.json')
+# The fleet sizes benchmarked by default.
+DEFAULT_FLEET_SIZES = [1000, 10000, 50000]
+# The largest slowdown (as a fraction of the baseline's normalized timing) which is tolerated.
+DEFAULT_REGRESSION_THRESHOLD = 0.5
+# Timings shorter than this (seconds) are too noisy to compare; only their API calls are.
+MINIMUM_COMPARED_SECONDS = 0.05
+# The page size EC2 uses when a describe call does not set MaxResults.
+SIMULATED_PAGE_SIZE = 1000
+# The instance states of the synthetic fleet, and how often each one occurs.
+INSTANCE_STATES = ['running'] * 6 + ['stopped'] * 3 + ['terminated']
+
+
+class _FakeHTTPResponse:
+    """The minimal HTTP response botocore needs from a short-circuited call."""
+
+    status_code = 200
+
+
+class SyntheticFleet:
+    """Answers EC2 describe calls from a generated fleet of instances and images."""
+
+    def __init__(self, size: int, seed: int = 0):
+        """Generate the fleet.
+
+        Args:
+            size (int): The number of instances (and of images).
+            seed (int): The random seed, so that every run sees the same fleet.
+        """
+        rng = random.Random(seed)
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.instances: List[Dict[str, Any]] = []
+        self.images: List[Dict[str, Any]] = []
+        self.tags_by_resource: Dict[str, List[Dict[str, str]]] = {}
+        for index in range(size):
+            instance_id = f'i-{index:017x}'
+            tags = [{'Key': 'Name', 'Value': f'ats-worker-{index}'},
+                    {'Key': 'Category', 'Value': rng.choice(['ATS', 'Daily', 'TestDay'])}]
+            # Most instances have a TerminationDate tag, some of them not zero-padded.
+            if rng.random() < 0.8:
+                termination_date = (now + datetime.timedelta(days=rng.randint(-30, 30))).date()
+                value = termination_date.isoformat() if rng.random() < 0.9 else \
+                    f'{termination_date.year}-{termination_date.month}-{termination_date.day}'
+                tags.append({'Key': 'TerminationDate', 'Value': value})
+            self.instances.append({
+                'InstanceId': instance_id,
+                'InstanceType': 'm5.xlarge',
+                'LaunchTime': now - datetime.timedelta(seconds=rng.randint(0, 90 * 86400)),
+                'State': {'Name': rng.choice(INSTANCE_STATES)},
+                'PrivateDnsName': f'ip-10-0-{index // 256 % 256}-{index % 256}.ec2.internal',
+                'PublicDnsName': f'ec2-{index}.compute-1.amazonaws.com',
+                'Tags': tags
+            })
+            self.tags_by_resource[instance_id] = [
+                dict(_, ResourceId=instance_id, ResourceType='instance') for _ in tags]
+            creation_time = now - datetime.timedelta(seconds=rng.randint(0, 365 * 86400))
+            self.images.append({
+                'ImageId': f'ami-{index:017x}',
+                'Name': f'syslink-{index}',
+                'CreationDate': creation_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'State': 'available' if rng.random() < 0.95 else 'pending',
+                'Tags': [{'Key': 'Category', 'Value': 'BakedImage'}]
+            })
+        self.call_counts: Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+        # The items matching each query (regardless of the page), so that paginating a large
+        # result costs the simulator one scan rather than one scan per page.
+        self._matches_by_query: Dict[str, List[Any]] = {}
+
+    def attach(self, client: Any) -> None:
+        """Answer every EC2 call made through a botocore client."""
+        client.meta.events.register('before-parameter-build.ec2.*', self._keep_params)
+        client.meta.events.register('before-call.ec2.*', self._handle_call)
+
+    def detach(self, client: Any) -> None:
+        """Stop answering the EC2 calls of a botocore client."""
+        client.meta.events.unregister('before-parameter-build.ec2.*', self._keep_params)
+        client.meta.events.unregister('before-call.ec2.*', self._handle_call)
+
+    @staticmethod
+    def _keep_params(params: Dict[str, Any], context: Dict[str, Any], **_: Any) -> None:
+        """Keep the API parameters, as before-call only receives the serialized request."""
+        context['simulated_api_params'] = dict(params)
+
+    @staticmethod
+    def _matches(item: Dict[str, Any], filters: List[Dict[str, Any]],
+                 id_key: str) -> bool:
+        """Apply EC2's server-side filters (the subset the query layer uses) to an item."""
+        tags = {_['Key']: _['Value'] for _ in item.get('Tags', [])}
+        for query_filter in filters:
+            name, values = query_filter['Name'], query_filter['Values']
+            if name == 'instance-state-name':
+                matched = item['State']['Name'] in values
+            elif name == 'state':
+                matched = item['State'] in values
+            elif name == 'tag-key':
+                matched = any(_ in tags for _ in values)
+            elif name.startswith('tag:'):
+                matched = tags.get(name[4:]) in values
+            elif name in ('instance-id', 'image-id', 'resource-id'):
+                matched = item[id_key] in values
+            else:
+                matched = True
+            if not matched:
+                return False
+        return True
+
+    @staticmethod
+    def _page(items: List[Any], params: Dict[str, Any]) -> Tuple[List[Any], Dict[str, Any]]:
+        """Cut a result page (and its NextToken) out of the matching items."""
+        start = int(params.get('NextToken') or 0)
+        end = start + int(params.get('MaxResults') or SIMULATED_PAGE_SIZE)
+        return items[start:end], {'NextToken': str(end)} if end < len(items) else {}
+
+    def _find_matches(self, operation: str, params: Dict[str, Any]) -> List[Any]:
+        """Get the items matching a describe call, from the previous pages if possible."""
+        query = json.dumps(
+            [operation, {key: value for key, value in params.items()
+                         if key not in ('NextToken', 'MaxResults')}],
+            sort_keys=True, default=str)
+        with self._lock:
+            matching = self._matches_by_query.get(query)
+        if matching is None:
+            matching = self._scan(operation, params)
+            with self._lock:
+                self._matches_by_query[query] = matching
+        return matching
+
+    def _scan(self, operation: str, params: Dict[str, Any]) -> List[Any]:
+        """Find the items matching a describe call."""
+        filters = params.get('Filters', [])
+        if operation == 'DescribeInstances':
+            instance_ids = set(params.get('InstanceIds') or [])
+            return [
+                _ for _ in self.instances
+                if (not instance_ids or _['InstanceId'] in instance_ids)
+                and self._matches(_, filters, 'InstanceId')
+            ]
+        if operation == 'DescribeImages':
+            image_ids = set(params.get('ImageIds') or [])
+            return [
+                _ for _ in self.images
+                if (not image_ids or _['ImageId'] in image_ids)
+                and self._matches(_, filters, 'ImageId')
+            ]
+        if operation == 'DescribeTags':
+            resource_ids, tag_keys = list(self.tags_by_resource), None
+            for query_filter in filters:
+                if query_filter['Name'] == 'resource-id':
+                    resource_ids = query_filter['Values']
+                elif query_filter['Name'] == 'tag-key':
+                    tag_keys = set(query_filter['Values'])
+            return [
+                tag for resource_id in dict.fromkeys(resource_ids)
+                for tag in self.tags_by_resource.get(resource_id, [])
+                if tag_keys is None or tag['Key'] in tag_keys
+            ]
+        return []
+
+    def _handle_call(self, model: Any, context: Dict[str, Any],
+                     **_: Any) -> Tuple[_FakeHTTPResponse, Dict[str, Any]]:
+        """Answer a describe call without sending the request."""
+        with self._lock:
+            self.call_counts[model.name] += 1
+        params = context['simulated_api_params']
+        matching = self._find_matches(model.name, params)
+        response: Dict[str, Any] = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if model.name == 'DescribeInstances':
+            page, next_token = self._page(matching, params)
+            # EC2 groups the instances launched together into reservations.
+            response['Reservations'] = [
+                {'ReservationId': f'r-{index:017x}', 'Instances': page[index:index + 5]}
+                for index in range(0, len(page), 5)
+            ]
+            response.update(next_token)
+        elif model.name == 'DescribeImages':
+            response['Images'] = matching
+        elif model.name == 'DescribeTags':
+            response['Tags'], next_token = self._page(matching, params)
+            response.update(next_token)
+        return _FakeHTTPResponse(), response
+
+
+def parse_args() -> argparse.Namespace:
+    """Returns options to the caller.
+
+        This function parses out and returns arguments and options from the
+        commandline arguments.
+
+    Returns:
+        argparse.Namespace: The parsed arguments for the script.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the AWS query layer against synthetic fleets.')
+
+    parser.add_argument(
+        '--fleet-sizes', action='store', type=int, nargs='+', default=DEFAULT_FLEET_SIZES,
+        dest='fleet_sizes',
+        help='The numbers of (simulated) instances and images to benchmark with.'
+    )
+
+    parser.add_argument(
+        '--rounds', action='store', type=int, default=5, dest='rounds',
+        help='The number of times each path is timed.  The fastest round is kept.'
+    )
+
+    parser.add_argument(
+        '--baseline-path', action='store', type=str, default=DEFAULT_BASELINE_PATH,
+        dest='baseline_path',
+        help='The path of the stored baseline.'
+    )
+
+    parser.add_argument(
+        '--save-baseline', action='store_true', default=False, dest='save_baseline',
+        help='Store the results as the new baseline instead of comparing with it.'
+    )
+
+    parser.add_argument(
+        '--threshold', action='store', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+        dest='threshold',
+        help='The largest tolerated slowdown, as a fraction of the baseline (0.5 = 50%%).'
+    )
+
+    return parser.parse_args()
+
+
+def calibrate(rounds: int = 3) -> float:
+    """Time a fixed pure-Python workload (sorting and dict building), to normalize timings.
+
+    Returns:
+        float: The fastest time (seconds) of the workload.
+    """
+    rng = random.Random(0)
+    values = [rng.random() for _ in range(200000)]
+    best = float('inf')
+    for _ in range(rounds):
+        gc.collect()
+        gc.disable()
+        try:
+            start_time = time.perf_counter()
+            ordered = sorted(values)
+            _ = {f'key-{index}': value for index, value in enumerate(ordered)}
+            best = min(best, time.perf_counter() - start_time)
+        finally:
+            gc.enable()
+    return best
+
+
+def _benchmark_cases(aws_instance: AWSInstance, aws_image: AWSImage,
+                     fleet: SyntheticFleet) -> Dict[str, Callable[[], Any]]:
+    """The query paths to benchmark."""
+    month_ago = (datetime.datetime.utcnow() - datetime.timedelta(days=30)).date()
+    instance_ids = [_['InstanceId'] for _ in fleet.instances]
+    return {
+        'filter_instances': lambda: aws_instance.describe_instances(
+            state=['running'], date_range=(month_ago, None), newest_only=False),
+        'newest_instance': lambda: aws_instance.describe_instances(
+            tags={'Category': 'ATS'}, newest_only=True),
+        'filter_images': lambda: aws_image.describe_images(
+            owners=['self'], state=['available'], date_range=(month_ago, None),
+            newest_only=False),
+        'newest_image': lambda: aws_image.describe_images(
+            owners=['self'], state=['available'], newest_only=True),
+        'expired_termination_scan': lambda: list(
+            aws_instance.iter_instances_with_expired_termination_date()),
+        'resource_tag_data': lambda: aws_instance.get_resource_tag_data(
+            instance_ids, ['TerminationDate'])
+    }
+
+
+def run_fleet(size: int, rounds: int) -> Dict[str, Dict[str, Any]]:
+    """Benchmark every query path against a synthetic fleet.
+
+    Args:
+        size (int): The number of instances (and of images).
+        rounds (int): The number of times each path is timed.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The fastest time (seconds) and the API calls (per round) of
+        each path, with the structure: {'<path>': {'Seconds': <float>, 'Calls': <int>}}
+    """
+    fleet = SyntheticFleet(size)
+    clock = ManualClock()
+    aws_instance = AWSInstance(region_name=DEFAULT_AWS_REGION, clock=clock)
+    aws_image = AWSImage(region_name=DEFAULT_AWS_REGION, clock=clock)
+    # The AWSInstance and AWSImage objects share the region's clients.
+    clients = {id(_): _ for _ in (aws_instance.ec2_client, aws_image.ec2_client)}
+    for client in clients.values():
+        fleet.attach(client)
+
+    results = {}
+    try:
+        for name, case in _benchmark_cases(aws_instance, aws_image, fleet).items():
+            best = float('inf')
+            for _ in range(rounds):
+                # Every round queries EC2 (the simulator) rather than the describe cache.
+                aws_instance.invalidate_describe_results()
+                fleet.call_counts.clear()
+                # Like timeit, keep the garbage collector from adding noise to the timings.
+                gc.collect()
+                gc.disable()
+                try:
+                    start_time = time.perf_counter()
+                    case()
+                    best = min(best, time.perf_counter() - start_time)
+                finally:
+                    gc.enable()
+            results[name] = {'Seconds': best, 'Calls': sum(fleet.call_counts.values())}
+    finally:
+        for client in clients.values():
+            fleet.detach(client)
+    return results
+
+
+def compare_with_baseline(results: Dict[str, Any], baseline: Dict[str, Any],
+                          threshold: float) -> List[str]:
+    """Find the regressions of a run compared with the baseline.
+
+    Args:
+        results (Dict[str, Any]): The results of this run (see main).
+        baseline (Dict[str, Any]): The stored baseline (with the same structure).
+        threshold (float): The largest tolerated slowdown, as a fraction of the baseline.
+
+    Returns:
+        List[str]: A description of each regression (empty if there are none).
+    """
+    regressions = []
+    for size, paths in results['Fleets'].items():
+        for name, result in paths.items():
+            reference = baseline['Fleets'].get(size, {}).get(name)
+            if reference is None:
+                continue
+            if result['Calls'] > reference['Calls']:
+                regressions.append(f'{name} ({size}): {result["Calls"]} API calls '
+                                   f'(baseline: {reference["Calls"]})')
+            limit = reference['Normalized'] * (1 + threshold)
+            if result['Seconds'] >= MINIMUM_COMPARED_SECONDS and result['Normalized'] > limit:
+                regressions.append(
+                    f'{name} ({size}): {result["Normalized"]:.2f}x the calibration workload '
+                    f'(baseline: {reference["Normalized"]:.2f}x, limit: {limit:.2f}x)')
+    return regressions
+
+
+def main():
+    """The main execution method for the script."""
+    args = parse_args()
+
+    calibration = calibrate()
+    LOGGER.write(f'Calibration workload: {calibration:.4f} seconds.')
+    results: Dict[str, Any] = {
+        'Calibration': calibration,
+        'Python': platform.python_version(),
+        'Fleets': {}
+    }
+    for size in args.fleet_sizes:
+        fleet_results = run_fleet(size, args.rounds)
+        for name, result in fleet_results.items():
+            result['Normalized'] = result['Seconds'] / calibration
+            LOGGER.write(f'{size:>7} {name:<26}{result["Seconds"]:>10.4f} s'
+                         f'{result["Normalized"]:>9.2f}x{result["Calls"]:>7} calls')
+        results['Fleets'][str(size)] = fleet_results
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline_path)), exist_ok=True)
+        with open(args.baseline_path, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        LOGGER.write(f'Saved the baseline to {args.baseline_path}')
+        return
+
+    if not os.path.isfile(args.baseline_path):
+        LOGGER.write(f'There is no baseline at {args.baseline_path}; run with --save-baseline '
+                     f'to store one.', 'warning')
+        return
+    with open(args.baseline_path, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    if regressions:
+        for regression in regressions:
+            LOGGER.write(f'Regression: {regression}', 'error')
+        sys.exit(1)
+    LOGGER.write('No regressions compared with the baseline.')
+
+
+if __name__ == '__main__':
+    main()
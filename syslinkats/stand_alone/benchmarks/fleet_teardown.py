@@ -0,0 +1,171 @@
+"""
+fleet_teardown.py
+
+This module benchmarks fleet teardown (AWSInstance.cleanup_instances) against a simulated EC2.
+It compares the legacy behavior (one TerminateInstances call per instance object) with the
+chunked, parallel bulk path, and reports the number of API calls and the elapsed time of each.
+
+No AWS calls are made: every EC2 request is answered locally through botocore's before-call
+event, optionally after a simulated per-call latency, and all waits use a ManualClock.
+"""
+__author__ = 'sedwards'
+
+import argparse
+import collections
+import sys
+import threading
+import time
+from typing import Any, Counter, Dict, List, Tuple
+
+from syslinkats.data.common.aws_default_parameters import DEFAULT_AWS_REGION
+from syslinkats.framework.aws.aws_instance import AWSInstance
+from syslinkats.framework.common.adaptive_waiter import ManualClock
+from syslinkats.framework.logging.auto_indent import AutoIndent
+
+LOGGER = AutoIndent(stream=sys.stdout)
+
+
+class _FakeHTTPResponse:
+    """The minimal HTTP response botocore needs from a short-circuited call."""
+
+    status_code = 200
+
+
+class SimulatedEC2:
+    """Answers the EC2 calls made during teardown and counts them by operation."""
+
+    def __init__(self, call_latency: float = 0.0):
+        """Initialize the simulator.
+
+        Args:
+            call_latency (float): The simulated round-trip time (seconds) of each call.
+        """
+        self.call_latency = call_latency
+        self.call_counts: Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def attach(self, client: Any) -> None:
+        """Answer every EC2 call made through a botocore client."""
+        client.meta.events.register('before-parameter-build.ec2.*', self._keep_params)
+        client.meta.events.register('before-call.ec2.*', self._handle_call)
+
+    def detach(self, client: Any) -> None:
+        """Stop answering the EC2 calls of a botocore client."""
+        client.meta.events.unregister('before-parameter-build.ec2.*', self._keep_params)
+        client.meta.events.unregister('before-call.ec2.*', self._handle_call)
+
+    @staticmethod
+    def _keep_params(params: Dict[str, Any], context: Dict[str, Any], **_: Any) -> None:
+        """Keep the API parameters, as before-call only receives the serialized request."""
+        context['simulated_api_params'] = dict(params)
+
+    def _handle_call(self, model: Any, context: Dict[str, Any],
+                     **_: Any) -> Tuple[_FakeHTTPResponse, Dict[str, Any]]:
+        """Return a successful response without sending the request."""
+        with self._lock:
+            self.call_counts[model.name] += 1
+        if self.call_latency:
+            time.sleep(self.call_latency)
+
+        instance_ids = context['simulated_api_params'].get('InstanceIds', [])
+        response: Dict[str, Any] = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if model.name in ('TerminateInstances', 'StopInstances'):
+            target_state = 'shutting-down' if model.name == 'TerminateInstances' else 'stopping'
+            response['TerminatingInstances' if model.name == 'TerminateInstances'
+                     else 'StoppingInstances'] = [
+                {'InstanceId': _, 'CurrentState': {'Name': target_state}} for _ in instance_ids]
+        elif model.name == 'DescribeInstanceStatus':
+            response['InstanceStatuses'] = [
+                {'InstanceId': _, 'InstanceState': {'Name': 'terminated'}} for _ in instance_ids]
+        return _FakeHTTPResponse(), response
+
+
+def parse_args() -> argparse.Namespace:
+    """Returns options to the caller.
+
+        This function parses out and returns arguments and options from the
+        commandline arguments.
+
+    Returns:
+        argparse.Namespace: The parsed arguments for the script.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark fleet teardown.')
+
+    parser.add_argument(
+        '--fleet-size', action='store', type=int, default=50, dest='fleet_size',
+        help='The number of (simulated) instances to terminate.'
+    )
+
+    parser.add_argument(
+        '--call-latency', action='store', type=float, default=0.05, dest='call_latency',
+        help='The simulated round-trip time (seconds) of each EC2 call.'
+    )
+
+    parser.add_argument(
+        '--chunk-size', action='store', type=int, default=20, dest='chunk_size',
+        help='The number of instances per TerminateInstances call in the bulk path.'
+    )
+
+    return parser.parse_args()
+
+
+def _legacy_teardown(aws_instance: AWSInstance, instance_ids: List[str]) -> None:
+    """Terminate the instances the way cleanup_instances did before the bulk path."""
+    for instance_id in instance_ids:
+        # pylint: disable=no-member
+        aws_instance.ec2_resource.Instance(instance_id).terminate()
+    aws_instance.wait_for_instance_state(instance_ids=instance_ids, state=['terminated'])
+
+
+def run_teardown(variant: str, fleet_size: int, call_latency: float,
+                 chunk_size: int) -> Dict[str, Any]:
+    """Tear down a simulated fleet and measure it.
+
+    Args:
+        variant (str): Either 'legacy' or 'bulk'.
+        fleet_size (int): The number of instances.
+        call_latency (float): The simulated round-trip time (seconds) of each call.
+        chunk_size (int): The number of instances per call in the bulk path.
+
+    Returns:
+        Dict[str, Any]: The call counts by operation, the total call count and the elapsed time.
+    """
+    aws_instance = AWSInstance(region_name=DEFAULT_AWS_REGION, clock=ManualClock())
+    instance_ids = [f'i-{_:017x}' for _ in range(fleet_size)]
+    simulator = SimulatedEC2(call_latency=call_latency)
+    clients = [aws_instance.ec2_client, aws_instance.ec2_resource.meta.client]
+    for client in clients:
+        simulator.attach(client)
+
+    start_time = time.perf_counter()
+    try:
+        if variant == 'legacy':
+            _legacy_teardown(aws_instance, instance_ids)
+        else:
+            aws_instance.cleanup_instances(
+                instance_ids=instance_ids, do_terminate=True, chunk_size=chunk_size)
+    finally:
+        for client in clients:
+            simulator.detach(client)
+
+    return {
+        'calls': dict(simulator.call_counts),
+        'total_calls': sum(simulator.call_counts.values()),
+        'elapsed': time.perf_counter() - start_time
+    }
+
+
+def main():
+    """The main execution method for the script."""
+    args = parse_args()
+
+    LOGGER.write(f'Tearing down {args.fleet_size} simulated instances '
+                 f'({args.call_latency} seconds per call).')
+    for variant in ('legacy', 'bulk'):
+        result = run_teardown(variant, args.fleet_size, args.call_latency, args.chunk_size)
+        LOGGER.write(f'{variant:<8}{result["total_calls"]:>6} calls{result["elapsed"]:>10.3f} s  '
+                     f'{result["calls"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,10 @@ import argparse
 import ast
 import os
 import sys
+from typing import Dict, List
 
-from syslinkats.framework.aws.aws_instance import AWSInstance
+from syslinkats.data.common.aws_default_parameters import DEFAULT_AWS_REGION
+from syslinkats.framework.aws.aws_fleet import AWSFleet
 from syslinkats.framework.logging.auto_indent import AutoIndent
 
 LOGGER = AutoIndent(sys.stdout)
@@ -33,12 +35,20 @@ def parse_args() -> argparse.Namespace:
         multiple instances.'''
     )
 
+    parser.add_argument(
+        '-R', '--region-name', action='append', type=str, default=None,
+        dest='region_names',
+        help=f'''The AWS region(s) to search for the instances.  All regions are searched
+        concurrently.  Please note that this is an appending list, so use -R <region> -R <region>
+        for multiple regions.  Defaults to {DEFAULT_AWS_REGION}.'''
+    )
+
     return parser.parse_args()
 
 
 def main(args: argparse.Namespace):
     if args.instance_dns_names:
-        aws_instance = AWSInstance(region_name='us-east-1')
+        aws_fleet = AWSFleet(region_names=args.region_names or [DEFAULT_AWS_REGION])
         try:
             _instance_dns_names = ast.literal_eval(args.instance_dns_names)
         except ValueError:
@@ -48,12 +58,18 @@ def main(args: argparse.Namespace):
 
         if _instance_dns_names:
             if isinstance(_instance_dns_names, str):
-                instance_ids = aws_instance.public_dns_names_to_ids([_instance_dns_names])
-            else:
-                instance_ids = aws_instance.public_dns_names_to_ids(_instance_dns_names)
+                _instance_dns_names = [_instance_dns_names]
+
+            # Find the region of each instance, then terminate all regions concurrently.
+            instance_ids_by_region: Dict[str, List[str]] = {}
+            for instance in aws_fleet.map_public_dns_names_to_ids(_instance_dns_names).values():
+                if instance:
+                    instance_ids_by_region.setdefault(instance['Region'], []).append(
+                        instance['InstanceId'])
 
-            if instance_ids:
-                aws_instance.cleanup_instances(instance_ids=instance_ids, do_terminate=True)
+            if instance_ids_by_region:
+                aws_fleet.cleanup_instances(
+                    instance_ids_by_region=instance_ids_by_region, do_terminate=True)
             else:
                 LOGGER.write(
                     f'No instance Ids were found for the specified DNS names: '
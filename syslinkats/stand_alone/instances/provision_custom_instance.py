@@ -13,13 +13,38 @@ This module is responsible for the following:
     * The URL to the instance.
     * The build of the SystemLink Suite that the feeds came from.
     * The feeds which were installed.
+
+The phases run as a task graph (see build_task_graph): each phase starts as soon as the phases
+it depends on are done, so independent phases (such as scraping the feeds and deploying the
+instances) overlap, and the per-instance phases run for all instances concurrently.
+
+Software provisioning first probes the feeds and packages already on the instances (see
+remote_feed_state), logs the plan of each instance and only runs the feed operations which are
+still needed, so re-provisioning a dev worker with the same feeds is close to a no-op.
+
+With --use-baked-image-cache, the instances are launched from a previously baked AMI of the
+same feeds and configuration (skipping software provisioning), or else an AMI is baked from
+the first instance once its software is provisioned.
+
+With --trace-path, every phase and every AWS, SSM and HTTP call is recorded as a timing span.
+The spans are written to a Chrome trace and summarized at the end of the run.  The critical
+path of the phases is logged, as are the call counts, latencies, retries and throttles of every
+AWS API operation (which are also written to --aws-metrics-path, if given).
+
+With --cassette-path, the AWS, HTTP and readiness-probe traffic of a run is recorded to a
+cassette (--cassette-mode record), or replayed from one offline and without waits (see
+network_utils.cassette).
+
+With --checkpoint-path, every completed phase is recorded in a checkpoint journal.  A failed run
+can be continued with --resume (and the same --checkpoint-path), which reuses the journaled
+instances and feeds and skips the phases that already completed for them.
 """
 __author__ = 'sedwards'
 
 import argparse
 import sys
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from syslinkats import (
     ats_config_file,
@@ -29,6 +54,8 @@ from syslinkats import (
 )
 from syslinkats.data.common.aws_default_parameters import (
     DEFAULT_AMI_FILTERS,
+    DEFAULT_BAKED_IMAGE_MAX_AGE_DAYS,
+    DEFAULT_BAKED_IMAGE_MAX_COUNT,
     DEFAULT_BLOCK_DEV_MAPPINGS,
     DEFAULT_DIRECT_CONNECT_TAGS,
     DEFAULT_IAM_INSTANCE_PROFILE,
@@ -38,18 +65,29 @@ from syslinkats.data.common.aws_default_parameters import (
     DEFAULT_SUBNET_ID
 )
 from syslinkats.framework.aws.aws_image import AWSImage
+from syslinkats.framework.aws.aws_image_cache import BakedImageCache
 from syslinkats.framework.aws.aws_instance import AWSInstance
+from syslinkats.framework.aws.aws_session_registry import AWSSessionRegistry
 from syslinkats.framework.common.argparse_helpers import bool_from_str, int_from_str
+from syslinkats.framework.common.checkpoint_journal import CheckpointJournal
 from syslinkats.framework.common.string_parse_helpers import parse_date_range
+from syslinkats.framework.common.task_graph import TaskGraph
 from syslinkats.framework.errors.custom_errors import FeedMissingError
 from syslinkats.framework.file_io.json_file_operations import read_json_data_from_file
 from syslinkats.framework.logging.auto_indent import AutoIndent
+from syslinkats.framework.logging.span_recorder import SPAN_RECORDER
 from syslinkats.framework.msteams.common.constants import (
     DAILY_INSTANCES_WEBHOOK,
     TEST_DAY_INSTANCE_WEBHOOK
 )
 from syslinkats.framework.msteams.msteams_operations import post_teams_instance_deployment_message
-from syslinkats.framework.remote.remote_commands import run_aws_remote_command
+from syslinkats.framework.network_utils.cassette import add_cassette_arguments, install_cassette
+from syslinkats.framework.remote.remote_commands import run_aws_remote_command_fan_out
+from syslinkats.framework.remote.remote_feed_state import (
+    DEFAULT_NIPKG_PATH,
+    FeedStatePlan,
+    probe_feed_state
+)
 from syslinkats.stand_alone.front_loaded_data.data_loader import call_uploaders
 from syslinkats.tests.common.systemlink_server.systemlink_server_helpers import restart_web_server
 from syslinkats.tests.setup.installation.utils.feed_utils import (
@@ -82,6 +120,33 @@ SYSTEMLINK_SERVER_CONFIG_DATA: Dict[str, Any] = {}
 USER_CONFIG_DATA: Dict[str, Any] = {}
 INSTALLATION_CONFIG_DATA: Dict[str, Any] = {}
 FEED_ITEMS: Optional[Tuple[str, List[Tuple[str, str]]]]
+BAKED_IMAGE_CACHE_KEY: Optional[str] = None
+BAKED_IMAGE_ID: Optional[str] = None
+
+
+class InstanceContext:
+    """The state of one instance being provisioned."""
+
+    def __init__(self, index: int, instance_id: str = None, public_dns_name: str = None):
+        """Initialize the context.
+
+        Args:
+            index (int): The position of the instance among the provisioned instances.
+            instance_id (str): The instance Id (filled in once the instance is deployed).
+            public_dns_name (str): The public DNS name (filled in once the instance is deployed).
+        """
+        self.index = index
+        self.instance_id = instance_id
+        self.public_dns_name = public_dns_name
+
+    @property
+    def ats_config_data(self) -> Dict[str, Any]:
+        """A copy of the ATS configuration data which targets this instance."""
+        return dict(ATS_CONFIG_DATA, syslink_worker_name=self.public_dns_name,
+                    syslink_worker_instance_id=self.instance_id)
+
+    def __str__(self) -> str:
+        return self.public_dns_name or f'instance {self.index}'
 
 
 def parse_args() -> argparse.Namespace:
@@ -211,7 +276,75 @@ def parse_args() -> argparse.Namespace:
         help='Whether data should be front-loaded to this instance.'
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        '--max-concurrency', action='store', default=4, type=int_from_str,
+        dest='max_concurrency',
+        help='The most provisioning phases (or per-instance phases) run at the same time.'
+    )
+
+    parser.add_argument(
+        '--diff-feed-state', action='store', default=True, type=bool_from_str,
+        dest='diff_feed_state',
+        help='''Whether to probe the feeds and packages already on the instance(s) and only
+            run the feed operations which are still needed (the plan is logged first).'''
+    )
+
+    parser.add_argument(
+        '--use-baked-image-cache', action='store', default=False, type=bool_from_str,
+        dest='use_baked_image_cache',
+        help='''Whether to launch from (or else bake) an AMI which already has the requested
+            feeds and configuration.  Ignored with --use-dev-worker or --ami-id.'''
+    )
+
+    parser.add_argument(
+        '--baked-image-max-count', action='store', default=DEFAULT_BAKED_IMAGE_MAX_COUNT,
+        type=int_from_str, dest='baked_image_max_count',
+        help='The most baked images kept.  The oldest ones are evicted.'
+    )
+
+    parser.add_argument(
+        '--baked-image-max-age-days', action='store', default=DEFAULT_BAKED_IMAGE_MAX_AGE_DAYS,
+        type=int_from_str, dest='baked_image_max_age_days',
+        help='The age (days) after which baked images are evicted.'
+    )
+
+    parser.add_argument(
+        '--checkpoint-path', action='store', default=None, type=str,
+        dest='checkpoint_path',
+        help='''(OPTIONAL) The path of the checkpoint journal, which records the completed
+            phases of each instance.  Nothing is journaled if this is not given.'''
+    )
+
+    parser.add_argument(
+        '--resume', action='store', default=False, type=bool_from_str,
+        dest='resume',
+        help='''Whether to resume a failed run from its checkpoint journal (--checkpoint-path,
+            which is required).  The journaled instances and feeds are reused and the phases
+            which already completed for them are skipped.'''
+    )
+
+    parser.add_argument(
+        '--trace-path', action='store', default=None, type=str,
+        dest='trace_path',
+        help='''(OPTIONAL) The path of the Chrome trace (open it in chrome://tracing or
+            Perfetto) of the timing spans of every phase and AWS, SSM and HTTP call.  Spans are
+            only recorded if this is given.'''
+    )
+
+    parser.add_argument(
+        '--aws-metrics-path', action='store', default=None, type=str,
+        dest='aws_metrics_path',
+        help='''(OPTIONAL) The path the AWS API call metrics (calls, latency histogram, retries
+            and throttles per operation) are written to at exit.  Paths ending with .prom are
+            written as a Prometheus textfile, others as JSON.'''
+    )
+
+    add_cassette_arguments(parser)
+
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint_path:
+        parser.error('--resume requires the --checkpoint-path of the run to resume.')
+    return args
 
 
 def populate_global_data(args: argparse.Namespace) -> None:
@@ -236,14 +369,7 @@ def populate_global_data(args: argparse.Namespace) -> None:
         # CREATED_INSTANCE_IDS from what's in the json conf file.
         PUBLIC_DNS_NAMES = [ATS_CONFIG_DATA['syslink_worker_name']]
         if not ATS_CONFIG_DATA['syslink_worker_instance_id']:
-            CREATED_INSTANCE_IDS = AWS_INSTANCE.describe_instance_ids(
-                filters=[
-                    {
-                        'Name': 'private-dns-name',
-                        'Values': AWSInstance.public_dns_names_to_private(PUBLIC_DNS_NAMES)
-                    }
-                ]
-            )
+            CREATED_INSTANCE_IDS = AWS_INSTANCE.public_dns_names_to_ids(PUBLIC_DNS_NAMES)
         else:
             CREATED_INSTANCE_IDS = [ATS_CONFIG_DATA['syslink_worker_instance_id']]
 
@@ -255,8 +381,10 @@ def deploy_base_instance(args: argparse.Namespace) -> None:
 
     LOGGER.write('Deploying base instance.')
 
-    # If the user didn't specify an AMI Id to deploy from, then get the id of the base image.
-    if not args.ami_id:
+    # If the user didn't specify an AMI Id to deploy from (and there is no baked image), then
+    # get the id of the base image.
+    ami_id = BAKED_IMAGE_ID or args.ami_id
+    if not ami_id:
         with AWSImage(region_name=ATS_CONFIG_DATA['region_name']) as aws_image:
             ami_id = aws_image.describe_image_ids(
                 filters=DEFAULT_AMI_FILTERS, owners=['self'], state=['available'])
@@ -284,36 +412,21 @@ def deploy_base_instance(args: argparse.Namespace) -> None:
     LOGGER.write(f'Created instance Ids: {CREATED_INSTANCE_IDS}')
 
     # Get the public DNS name(s) of the instance(s) that you deployed.
-    # NOTE: I had to refactor this into a loop as the internal AWS describe instance call was
-    # re-ordering the list such that public DNS names were not matching the list of created
-    # instance ids.  This *forces* it to be in the same order.
-    for instance_id in CREATED_INSTANCE_IDS:
-        private_dns_names = AWS_INSTANCE.describe_instance_dns_names(
-            instance_ids=[instance_id], get_private_dns_name=True, newest_only=False)
-        PUBLIC_DNS_NAMES.extend(AWS_INSTANCE.private_dns_names_to_public(
-            private_dns_names=private_dns_names
-        ))
+    # NOTE: The describe call may re-order its results, so the names are resolved into a
+    # mapping keyed (and ordered) by the created instance ids.
+    dns_names = AWS_INSTANCE.map_instance_ids_to_dns_names(instance_ids=CREATED_INSTANCE_IDS)
+    PUBLIC_DNS_NAMES.extend(_['PublicDnsName'] for _ in dns_names.values())
     LOGGER.write(f'Public DNS Names: {PUBLIC_DNS_NAMES}')
 
 
-def software_provisioning(args: argparse.Namespace) -> None:
-    """Install feeds onto the specified instances.
+def scrape_feeds(args: argparse.Namespace) -> None:
+    """Scrape argohttp for the suite to install and extract its feeds.
 
-    Notes:
-        This function performs the following operations:
-        - Scrapes argohttp for the appropriate suite to install and extracts its feeds (
-        including its associated Package Manager feed).
-        - Remove existing instances of the feeds to be installed.
-        - Adds instances of the feeds to be installed to Package Manager.
-        - Tells Package Manager to update the feeds.
-        - Upgrades the Package Manager upgrader.
-        - Upgrades Package Manager.
-        - Installs the feeds.
-        - Restarts the instance(s).
+    The feeds include the suite's associated Package Manager feed.
     """
     global FEED_ITEMS  # pylint: disable=global-statement
 
-    LOGGER.write('Installing SystemLink software.')
+    LOGGER.write('Finding the feeds to install.')
 
     FEED_ITEMS = get_feeds_to_install(
         installation_config_data=INSTALLATION_CONFIG_DATA,
@@ -329,71 +442,135 @@ def software_provisioning(args: argparse.Namespace) -> None:
     for feed_item in FEED_ITEMS:
         LOGGER.write(feed_item)
 
-    LOGGER.write('Removing feeds...')
-    remove_feeds(
-        region_name=ATS_CONFIG_DATA['region_name'],
-        target_public_dns_names=PUBLIC_DNS_NAMES,
-        instance_ids=CREATED_INSTANCE_IDS,
-        installation_config_data=INSTALLATION_CONFIG_DATA,
-        feed_items=FEED_ITEMS
-    )
 
-    LOGGER.write('Adding feeds...')
-    add_feeds(
-        region_name=ATS_CONFIG_DATA['region_name'],
-        target_public_dns_names=PUBLIC_DNS_NAMES,
-        instance_ids=CREATED_INSTANCE_IDS,
-        installation_config_data=INSTALLATION_CONFIG_DATA,
-        feed_items=FEED_ITEMS
-    )
+def _apply_feed_plan(plan: Optional[FeedStatePlan], public_dns_names: List[str],
+                     instance_ids: List[str]) -> None:
+    """Run the feed operations of a plan (every operation, if there is no plan)."""
+    feeds_to_remove = plan.feeds_to_remove if plan else FEED_ITEMS[1]
+    feeds_to_add = plan.feeds_to_add if plan else FEED_ITEMS[1]
+    feeds_to_install = plan.feeds_to_install if plan else FEED_ITEMS[1]
 
-    LOGGER.write('Updating all feeds.')
-    update_feeds(
-        region_name=ATS_CONFIG_DATA['region_name'],
-        target_public_dns_names=PUBLIC_DNS_NAMES,
-        instance_ids=CREATED_INSTANCE_IDS,
-        installation_config_data=INSTALLATION_CONFIG_DATA
-    )
+    if feeds_to_remove:
+        LOGGER.write('Removing feeds...')
+        remove_feeds(
+            region_name=ATS_CONFIG_DATA['region_name'],
+            target_public_dns_names=public_dns_names,
+            instance_ids=instance_ids,
+            installation_config_data=INSTALLATION_CONFIG_DATA,
+            feed_items=(FEED_ITEMS[0], feeds_to_remove)
+        )
 
-    LOGGER.write('Upgrading Package Manager Updater.')
-    package_manager_feed_item: Tuple[str, str]
-    try:
-        package_manager_feed_item = next(_ for _ in FEED_ITEMS[1] if 'package-manager' in _[0])
-    except StopIteration:
-        raise FeedMissingError(
-            'The package-manager feed item was missing from the list of feed items.')
+    if feeds_to_add:
+        LOGGER.write('Adding feeds...')
+        add_feeds(
+            region_name=ATS_CONFIG_DATA['region_name'],
+            target_public_dns_names=public_dns_names,
+            instance_ids=instance_ids,
+            installation_config_data=INSTALLATION_CONFIG_DATA,
+            feed_items=(FEED_ITEMS[0], feeds_to_add)
+        )
 
-    upgrade_updater_manager(
-        region_name=ATS_CONFIG_DATA['region_name'],
-        target_public_dns_names=PUBLIC_DNS_NAMES,
-        instance_ids=CREATED_INSTANCE_IDS,
-        installation_config_data=INSTALLATION_CONFIG_DATA,
-        package_manager_feed_item=package_manager_feed_item
-    )
+    if plan is None or plan.update_feeds:
+        LOGGER.write('Updating all feeds.')
+        update_feeds(
+            region_name=ATS_CONFIG_DATA['region_name'],
+            target_public_dns_names=public_dns_names,
+            instance_ids=instance_ids,
+            installation_config_data=INSTALLATION_CONFIG_DATA
+        )
 
-    LOGGER.write('Upgrading Package Manager.')
-    upgrade_package_manager(
-        region_name=ATS_CONFIG_DATA['region_name'],
-        target_public_dns_names=PUBLIC_DNS_NAMES,
-        instance_ids=CREATED_INSTANCE_IDS,
-        installation_config_data=INSTALLATION_CONFIG_DATA
-    )
+    if plan is None or plan.upgrade_package_manager:
+        LOGGER.write('Upgrading Package Manager Updater.')
+        package_manager_feed_item: Tuple[str, str]
+        try:
+            package_manager_feed_item = next(
+                _ for _ in FEED_ITEMS[1] if 'package-manager' in _[0])
+        except StopIteration:
+            raise FeedMissingError(
+                'The package-manager feed item was missing from the list of feed items.')
+
+        upgrade_updater_manager(
+            region_name=ATS_CONFIG_DATA['region_name'],
+            target_public_dns_names=public_dns_names,
+            instance_ids=instance_ids,
+            installation_config_data=INSTALLATION_CONFIG_DATA,
+            package_manager_feed_item=package_manager_feed_item
+        )
 
-    LOGGER.write('Installing feeds...')
-    install_feeds(
-        region_name=ATS_CONFIG_DATA['region_name'],
-        target_public_dns_names=PUBLIC_DNS_NAMES,
-        instance_ids=CREATED_INSTANCE_IDS,
-        installation_config_data=INSTALLATION_CONFIG_DATA,
-        feed_items=FEED_ITEMS
-    )
+        LOGGER.write('Upgrading Package Manager.')
+        upgrade_package_manager(
+            region_name=ATS_CONFIG_DATA['region_name'],
+            target_public_dns_names=public_dns_names,
+            instance_ids=instance_ids,
+            installation_config_data=INSTALLATION_CONFIG_DATA
+        )
+
+    if feeds_to_install:
+        LOGGER.write('Installing feeds...')
+        install_feeds(
+            region_name=ATS_CONFIG_DATA['region_name'],
+            target_public_dns_names=public_dns_names,
+            instance_ids=instance_ids,
+            installation_config_data=INSTALLATION_CONFIG_DATA,
+            feed_items=(FEED_ITEMS[0], feeds_to_install)
+        )
+
+    if plan is None or plan.restart_instance:
+        LOGGER.write('Restarting instance...')
+        restart_instance(
+            region_name=ATS_CONFIG_DATA['region_name'],
+            target_public_dns_names=public_dns_names,
+            instance_ids=instance_ids
+        )
+
+
+def software_provisioning(diff_feed_state: bool = True) -> None:
+    """Install the feeds (see scrape_feeds) onto the specified instances.
+
+    Args:
+        diff_feed_state (bool): Whether to probe the feeds and packages already on the
+        instances first, and only run the feed operations that are still needed.
+
+    Notes:
+        This function performs the following operations:
+        - Remove existing instances of the feeds to be installed.
+        - Adds instances of the feeds to be installed to Package Manager.
+        - Tells Package Manager to update the feeds.
+        - Upgrades the Package Manager upgrader.
+        - Upgrades Package Manager.
+        - Installs the feeds.
+        - Restarts the instance(s).
+        With diff_feed_state, the plan of each instance is reported first, and instances
+        with the same plan are provisioned together.
+    """
+    LOGGER.write('Installing SystemLink software.')
 
-    LOGGER.write('Restarting instance...')
-    restart_instance(
+    if not diff_feed_state:
+        _apply_feed_plan(None, PUBLIC_DNS_NAMES, CREATED_INSTANCE_IDS)
+        return
+
+    LOGGER.write('Probing the current feed state...')
+    plans = probe_feed_state(
         region_name=ATS_CONFIG_DATA['region_name'],
         target_public_dns_names=PUBLIC_DNS_NAMES,
-        instance_ids=CREATED_INSTANCE_IDS
+        instance_ids=CREATED_INSTANCE_IDS,
+        feed_items=FEED_ITEMS[1],
+        nipkg_path=INSTALLATION_CONFIG_DATA.get('nipkg_path', DEFAULT_NIPKG_PATH)
     )
+    dns_names = dict(zip(CREATED_INSTANCE_IDS, PUBLIC_DNS_NAMES))
+    groups: Dict[tuple, List[str]] = {}
+    for instance_id, plan in plans.items():
+        LOGGER.write(f'Feed plan for {dns_names.get(instance_id, instance_id)}:')
+        for line in plan.describe() or ['Nothing to do']:
+            LOGGER.write(f'    {line}')
+        groups.setdefault(plan.key, []).append(instance_id)
+
+    for instance_ids in groups.values():
+        plan = plans[instance_ids[0]]
+        if plan.is_empty:
+            LOGGER.write(f'The requested feeds are already installed on {instance_ids}.')
+            continue
+        _apply_feed_plan(plan, [dns_names[_] for _ in instance_ids], instance_ids)
 
 
 def add_windows_users() -> None:
@@ -412,18 +589,17 @@ def configure_ni_web_server() -> None:
     """Configures the NI Web Server on all created instances."""
     LOGGER.write('Configuring the NI Web Server.')
 
-    # For each instance, run the NI Web Server configuration command.
-    for public_dns_name, instance_id in zip(PUBLIC_DNS_NAMES, CREATED_INSTANCE_IDS):
-        run_aws_remote_command(
-            region_name=ATS_CONFIG_DATA['region_name'],
-            target_public_dns_names=[public_dns_name],
-            instance_ids=[instance_id],
-            remote_command=SYSTEMLINK_SERVER_CONFIG_DATA['ni_web_server_config_command'].format(
-                public_dns_name
-            ),
-            output_ignore_list=SYSTEMLINK_SERVER_CONFIG_DATA['output_ignore_list'],
-            total_command_run_time=300
-        )
+    # Run the NI Web Server configuration command on all instances at once, each with its own
+    # public DNS name.
+    run_aws_remote_command_fan_out(
+        region_name=ATS_CONFIG_DATA['region_name'],
+        target_public_dns_names=PUBLIC_DNS_NAMES,
+        instance_ids=CREATED_INSTANCE_IDS,
+        remote_command_template=SYSTEMLINK_SERVER_CONFIG_DATA['ni_web_server_config_command'],
+        instance_parameters=[(_,) for _ in PUBLIC_DNS_NAMES],
+        output_ignore_list=SYSTEMLINK_SERVER_CONFIG_DATA['output_ignore_list'],
+        total_command_run_time=300
+    )
 
 
 def configure_user_language_preferences() -> None:
@@ -439,21 +615,30 @@ def configure_user_language_preferences() -> None:
     )
 
 
-def set_security_defaults() -> None:
+def set_security_defaults(context: InstanceContext) -> None:
     """Set up default workspaces, users and mappings based on built-in templates."""
-    for public_dns_name in PUBLIC_DNS_NAMES:
-        ATS_CONFIG_DATA['syslink_worker_name'] = public_dns_name
-
-        templates = get_builtin_templates(ats_config_data=ATS_CONFIG_DATA)
-        workspaces = create_workspaces_from_templates(
-            templates=templates, ats_config_data=ATS_CONFIG_DATA)
-        users = create_users_from_templates(templates=templates, ats_config_data=ATS_CONFIG_DATA)
-        create_mappings_from_templates(
-            templates=templates,
-            workspaces=workspaces,
-            users=users,
-            ats_config_data=ATS_CONFIG_DATA
-        )
+    ats_config_data = context.ats_config_data
+
+    templates = get_builtin_templates(ats_config_data=ats_config_data)
+    workspaces = create_workspaces_from_templates(
+        templates=templates, ats_config_data=ats_config_data)
+    users = create_users_from_templates(templates=templates, ats_config_data=ats_config_data)
+    create_mappings_from_templates(
+        templates=templates,
+        workspaces=workspaces,
+        users=users,
+        ats_config_data=ats_config_data
+    )
+
+
+def restart_instance_web_server(context: InstanceContext) -> None:
+    """Restart the web server of an instance."""
+    restart_web_server(ats_config_data=context.ats_config_data)
+
+
+def front_load_instance_data(context: InstanceContext) -> None:
+    """Front-load data to an instance."""
+    call_uploaders(context.ats_config_data)
 
 
 def send_teams_notification(args: argparse.Namespace) -> None:
@@ -486,42 +671,239 @@ def send_teams_notification(args: argparse.Namespace) -> None:
     )
 
 
-if __name__ == '__main__':
-    ARGS = parse_args()
+def make_baked_image_cache(args: argparse.Namespace) -> BakedImageCache:
+    """Create the baked-AMI cache of the region."""
+    return BakedImageCache(
+        AWSImage(region_name=ATS_CONFIG_DATA['region_name']),
+        max_images=args.baked_image_max_count,
+        max_age_days=args.baked_image_max_age_days)
 
-    # Fill in any necessary globals.
-    populate_global_data(ARGS)
 
-    # Deploy a base instance.
-    if not ARGS.use_dev_worker:
-        deploy_base_instance(ARGS)
+def resolve_baked_image(args: argparse.Namespace) -> None:
+    """Look up a baked AMI of the feeds (see scrape_feeds) and the user / web server config."""
+    global BAKED_IMAGE_CACHE_KEY  # pylint: disable=global-statement
+    global BAKED_IMAGE_ID  # pylint: disable=global-statement
+
+    BAKED_IMAGE_CACHE_KEY = BakedImageCache.compute_cache_key(
+        FEED_ITEMS, USER_CONFIG_DATA, SYSTEMLINK_SERVER_CONFIG_DATA)
+    BAKED_IMAGE_ID = make_baked_image_cache(args).lookup(BAKED_IMAGE_CACHE_KEY)
+
+
+def bake_image(args: argparse.Namespace, contexts: List[InstanceContext]) -> None:
+    """Bake an AMI of the first provisioned instance, unless it was launched from one."""
+    if BAKED_IMAGE_ID or not BAKED_IMAGE_CACHE_KEY:
+        return
+    LOGGER.write('Baking an image of the provisioned software.')
+    make_baked_image_cache(args).bake(
+        instance_id=contexts[0].instance_id,
+        cache_key=BAKED_IMAGE_CACHE_KEY,
+        description=f'SystemLink {FEED_ITEMS[0]} with feeds '
+                    f'{", ".join(_[0] for _ in FEED_ITEMS[1])}')
+
+
+def make_instance_contexts(args: argparse.Namespace) -> List[InstanceContext]:
+    """Create the contexts of the instances to provision.
+
+    The contexts of the dev worker (or of resumed instances) are complete.  Otherwise the
+    contexts are filled in by fill_instance_contexts once the instances are deployed.
+    """
+    if args.use_dev_worker or (args.resume and CREATED_INSTANCE_IDS):
+        return [InstanceContext(index, instance_id, public_dns_name) for index, (
+            instance_id, public_dns_name) in enumerate(zip(CREATED_INSTANCE_IDS, PUBLIC_DNS_NAMES))]
+    return [InstanceContext(_) for _ in range(args.instance_count)]
+
+
+def fill_instance_contexts(contexts: List[InstanceContext]) -> None:
+    """Fill in the instance Ids and public DNS names of the deployed instances."""
+    for context, instance_id, public_dns_name in zip(
+            contexts, CREATED_INSTANCE_IDS, PUBLIC_DNS_NAMES):
+        context.instance_id = instance_id
+        context.public_dns_name = public_dns_name
+
+
+def resume_from_journal(journal: CheckpointJournal) -> None:
+    """Reuse the instances and feeds of a previous run.
+
+    The public DNS names are looked up again, in case the instances were stopped and started.
+    """
+    global CREATED_INSTANCE_IDS  # pylint: disable=global-statement
+    global PUBLIC_DNS_NAMES  # pylint: disable=global-statement
+    global FEED_ITEMS  # pylint: disable=global-statement
+    global BAKED_IMAGE_CACHE_KEY  # pylint: disable=global-statement
+    global BAKED_IMAGE_ID  # pylint: disable=global-statement
+
+    if journal.instance_ids:
+        CREATED_INSTANCE_IDS = journal.instance_ids
+        dns_names = AWS_INSTANCE.map_instance_ids_to_dns_names(instance_ids=CREATED_INSTANCE_IDS)
+        PUBLIC_DNS_NAMES = [_['PublicDnsName'] for _ in dns_names.values()]
+        if not all(PUBLIC_DNS_NAMES):
+            raise ValueError(f'Not every journaled instance is running: {dns_names}')
+        LOGGER.write(f'Resuming instance Ids: {CREATED_INSTANCE_IDS}')
 
-    # Install SW.
-    software_provisioning(ARGS)
+    feed_items = journal.get_value('feed_items')
+    if feed_items is not None:
+        FEED_ITEMS = (feed_items[0], [tuple(_) for _ in feed_items[1]])
 
-    # Add Windows users.
-    add_windows_users()
+    # Whether the instances were launched from a baked image (so its phases are skipped).
+    baked_image = journal.get_value('baked_image')
+    if baked_image is not None:
+        BAKED_IMAGE_CACHE_KEY = baked_image['cache_key']
+        BAKED_IMAGE_ID = baked_image['image_id']
 
-    # Configure the NI Web Server.
-    configure_ni_web_server()
 
-    # Configure user language preferences.
-    configure_user_language_preferences()
+def make_checkpoint_hooks(journal: CheckpointJournal, contexts: List[InstanceContext]) \
+        -> Tuple[Callable[[str, Optional[InstanceContext]], bool],
+                 Callable[[str, Optional[InstanceContext]], None]]:
+    """Build the task graph hooks which skip and journal completed phases.
+
+    A global phase counts as completed only once it has completed for every instance.  The
+    global phases which run before the instances are deployed (scrape_feeds and
+    resolve_baked_image) journal their results as values instead.
+
+    Args:
+        journal (CheckpointJournal): The checkpoint journal.
+        contexts (List[InstanceContext]): The contexts of the instances being provisioned.
+
+    Returns:
+        Tuple[Callable, Callable]: The is_completed and on_completed hooks of TaskGraph.run.
+    """
+    def _instance_ids(context: Optional[InstanceContext]) -> List[str]:
+        return [context.instance_id] if context is not None \
+            else [_.instance_id for _ in contexts]
+
+    def _is_completed(phase: str, context: Optional[InstanceContext]) -> bool:
+        if phase == 'scrape_feeds':
+            return journal.get_value('feed_items') is not None
+        if phase == 'resolve_baked_image':
+            return journal.get_value('baked_image') is not None
+        instance_ids = _instance_ids(context)
+        return bool(instance_ids) and all(instance_ids) \
+            and all(journal.is_completed(phase, _) for _ in instance_ids)
+
+    def _on_completed(phase: str, context: Optional[InstanceContext]) -> None:
+        if phase == 'scrape_feeds':
+            journal.set_value('feed_items', FEED_ITEMS)
+            return
+        if phase == 'resolve_baked_image':
+            journal.set_value(
+                'baked_image', {'cache_key': BAKED_IMAGE_CACHE_KEY, 'image_id': BAKED_IMAGE_ID})
+            return
+        if phase == 'deploy_base_instance':
+            for _ in contexts:
+                journal.add_instance(_.instance_id, public_dns_name=_.public_dns_name)
+        journal.mark_completed(phase, _instance_ids(context))
+
+    return _is_completed, _on_completed
+
+
+def build_task_graph(args: argparse.Namespace, contexts: List[InstanceContext]) -> TaskGraph:
+    """Build the graph of provisioning phases.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments for the script.
+        contexts (List[InstanceContext]): The contexts of the instances to provision.
+
+    Returns:
+        TaskGraph: The phases and their dependencies.
+    """
+    def _deploy_instances() -> None:
+        if not args.use_dev_worker and not all(_.instance_id for _ in contexts):
+            deploy_base_instance(args)
+            fill_instance_contexts(contexts)
+
+    def _unless_baked(func: Callable[[], None]) -> Callable[[], None]:
+        # Instances launched from a baked image already have this phase's work done.
+        return lambda: None if BAKED_IMAGE_ID else func()
+
+    graph = TaskGraph(max_workers=args.max_concurrency)
+    graph.add_task('scrape_feeds', lambda: scrape_feeds(args))
+    if args.use_baked_image_cache and not args.use_dev_worker and not args.ami_id:
+        # The image to deploy from depends on the feeds, so deployment waits for them.
+        graph.add_task('resolve_baked_image', lambda: resolve_baked_image(args),
+                       depends_on=['scrape_feeds'])
+        graph.add_task('deploy_base_instance', _deploy_instances,
+                       depends_on=['resolve_baked_image'])
+    else:
+        graph.add_task('deploy_base_instance', _deploy_instances)
+    graph.add_task('software_provisioning',
+                   _unless_baked(lambda: software_provisioning(args.diff_feed_state)),
+                   depends_on=['deploy_base_instance', 'scrape_feeds'])
+    graph.add_task('add_windows_users', _unless_baked(add_windows_users),
+                   depends_on=['software_provisioning'])
+    # CreateImage reboots the instance, so the configuration waits for the image.
+    graph.add_task('bake_image', lambda: bake_image(args, contexts),
+                   depends_on=['add_windows_users'])
+    graph.add_task('configure_ni_web_server', configure_ni_web_server,
+                   depends_on=['bake_image'])
+    graph.add_task('configure_user_language_preferences', configure_user_language_preferences,
+                   depends_on=['add_windows_users', 'configure_ni_web_server'])
+    # The security defaults keep the order of the serial provisioning (after the language
+    # preferences).
+    graph.add_task('set_security_defaults', set_security_defaults,
+                   depends_on=['configure_user_language_preferences'], per_context=True)
+    graph.add_task('restart_web_server', restart_instance_web_server,
+                   depends_on=['set_security_defaults'], per_context=True)
+    last_phase = 'restart_web_server'
+    if args.front_load_data:
+        graph.add_task('front_load_data', front_load_instance_data,
+                       depends_on=['restart_web_server'], per_context=True)
+        last_phase = 'front_load_data'
+    graph.add_task('send_teams_notification', lambda: send_teams_notification(args),
+                   depends_on=[last_phase])
+    return graph
+
+
+def report_timings(args: argparse.Namespace, graph: TaskGraph,
+                 results: Optional[Dict[Tuple[str, Optional[int]], Dict[str, Any]]]) -> None:
+    """Export the timing spans (if recorded), and log the critical path and the AWS API calls.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments for the script.
+        graph (TaskGraph): The graph of provisioning phases.
+        results (Optional[Dict[Tuple[str, Optional[int]], Dict[str, Any]]]): The results of
+        the graph run (None if it failed, in which case there is no critical path).
+    """
+    if args.trace_path:
+        SPAN_RECORDER.export_chrome_trace(args.trace_path)
+        LOGGER.write(f'Wrote the provisioning trace to {args.trace_path}')
+        LOGGER.write(f'Provisioning timing summary:\n{SPAN_RECORDER.format_summary_table()}')
+    if results:
+        path, total = graph.critical_path(results)
+        LOGGER.write(f'Critical path ({total:.1f} seconds): ' + ' -> '.join(
+            name if index is None else f'{name} [{index}]' for name, index in path))
+    LOGGER.write('Busiest AWS API operations:')
+    for line in AWSSessionRegistry.call_metrics.summary_lines():
+        LOGGER.write(f'    {line}')
 
-    # Set up the workspaces, users and mappings for each built-in template.
-    set_security_defaults()
 
-    # Restart the web server.
-    for public_dns_name_, instance_id_ in zip(PUBLIC_DNS_NAMES, CREATED_INSTANCE_IDS):
-        ATS_CONFIG_DATA['syslink_worker_name'] = public_dns_name_
-        ATS_CONFIG_DATA['syslink_worker_instance_id'] = instance_id_
-        restart_web_server(ats_config_data=ATS_CONFIG_DATA)
+if __name__ == '__main__':
+    ARGS = parse_args()
+    if ARGS.cassette_path:
+        install_cassette(ARGS.cassette_path, ARGS.cassette_mode)
 
-    # Front-load data to the instances.
-    if ARGS.front_load_data:
-        for public_dns_name_ in PUBLIC_DNS_NAMES:
-            ATS_CONFIG_DATA['syslink_worker_name'] = public_dns_name_
-            call_uploaders(ATS_CONFIG_DATA)
+    # Fill in any necessary globals.
+    populate_global_data(ARGS)
 
-    # Send a Teams notification.
-    send_teams_notification(ARGS)
+    if ARGS.aws_metrics_path:
+        AWSSessionRegistry.call_metrics.dump_at_exit(ARGS.aws_metrics_path)
+    if ARGS.trace_path:
+        SPAN_RECORDER.enabled = True
+
+    # Load (or start) the checkpoint journal, if one was requested.
+    JOURNAL = None
+    if ARGS.checkpoint_path:
+        JOURNAL = CheckpointJournal(ARGS.checkpoint_path, resume=ARGS.resume)
+        if ARGS.resume:
+            resume_from_journal(JOURNAL)
+
+    # Deploy the instance(s), install SW, configure them and send a Teams notification.
+    INSTANCE_CONTEXTS = make_instance_contexts(ARGS)
+    IS_COMPLETED, ON_COMPLETED = make_checkpoint_hooks(JOURNAL, INSTANCE_CONTEXTS) \
+        if JOURNAL is not None else (None, None)
+    GRAPH = build_task_graph(ARGS, INSTANCE_CONTEXTS)
+    RESULTS = None
+    try:
+        RESULTS = GRAPH.run(
+            INSTANCE_CONTEXTS, is_completed=IS_COMPLETED, on_completed=ON_COMPLETED)
+    finally:
+        report_timings(ARGS, GRAPH, RESULTS)
@@ -0,0 +1,87 @@
+"""
+test_aws_command_output.py
+
+Tests of S3CommandOutputStream against a moto S3 bucket.
+"""
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from syslinkats.framework.aws.aws_command_output import S3CommandOutputStream
+
+BUCKET_NAME = 'ssm-command-output'
+KEY_PREFIX = 'provisioning'
+COMMAND_ID = '0123abcd-0000-1111-2222-333344445555'
+INSTANCE_ID = 'i-0123456789abcdef0'
+# The prefix SSM uploads the output of a step of the aws:runPowerShellScript plugin under.
+STEP_PREFIX = (f'{KEY_PREFIX}/{COMMAND_ID}/{INSTANCE_ID}/'
+               f'awsrunPowerShellScript/0.awsrunPowerShellScript')
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """An S3 client of a moto bucket for the command output."""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET_NAME)
+        yield client
+
+
+def _upload(s3_client, stream_name: str, data: bytes) -> None:
+    """Upload (or replace) the content of an output object, as SSM does while a command runs."""
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=f'{STEP_PREFIX}/{stream_name}', Body=data)
+
+
+def test_poll_reads_only_new_output(s3_client):
+    """Each poll returns only the bytes uploaded since the previous poll."""
+    output_stream = S3CommandOutputStream(s3_client, BUCKET_NAME, KEY_PREFIX, COMMAND_ID)
+    assert output_stream.poll(INSTANCE_ID) == []
+    assert not output_stream.has_output(INSTANCE_ID)
+
+    _upload(s3_client, 'stdout', b'Installing feeds\n')
+    chunks = output_stream.poll(INSTANCE_ID)
+    assert [(_['Stream'], _['Content']) for _ in chunks] == [('stdout', 'Installing feeds\n')]
+    assert chunks[0]['Key'] == f'{STEP_PREFIX}/stdout'
+
+    _upload(s3_client, 'stdout', b'Installing feeds\nDone\n')
+    _upload(s3_client, 'stderr', b'warning: reboot required\n')
+    chunks = output_stream.poll(INSTANCE_ID)
+    assert sorted((_['Stream'], _['Content']) for _ in chunks) == [
+        ('stderr', 'warning: reboot required\n'), ('stdout', 'Done\n')]
+    assert output_stream.poll(INSTANCE_ID) == []
+
+    assert output_stream.has_output(INSTANCE_ID)
+    assert output_stream.get_output(INSTANCE_ID, 'stdout') == 'Installing feeds\nDone\n'
+    assert output_stream.get_output(INSTANCE_ID, 'stderr') == 'warning: reboot required\n'
+
+
+def test_poll_holds_back_split_multibyte_characters(s3_client):
+    """A UTF-8 character split across two uploads is returned whole by the later poll."""
+    output_stream = S3CommandOutputStream(s3_client, BUCKET_NAME, KEY_PREFIX, COMMAND_ID)
+    encoded = 'Größe: 42 €\n'.encode('utf-8')
+    split_index = encoded.index('€'.encode('utf-8')) + 1
+
+    _upload(s3_client, 'stdout', encoded[:split_index])
+    assert [_['Content'] for _ in output_stream.poll(INSTANCE_ID)] == ['Größe: 42 ']
+
+    _upload(s3_client, 'stdout', encoded)
+    assert [_['Content'] for _ in output_stream.poll(INSTANCE_ID)] == ['€\n']
+    assert output_stream.get_output(INSTANCE_ID) == 'Größe: 42 €\n'
+
+
+def test_poll_ignores_other_instances_and_objects(s3_client):
+    """Only the stdout / stderr objects of the polled instance are read."""
+    output_stream = S3CommandOutputStream(s3_client, BUCKET_NAME, KEY_PREFIX, COMMAND_ID)
+    s3_client.put_object(Bucket=BUCKET_NAME, Body=b'other instance',
+                         Key=f'{KEY_PREFIX}/{COMMAND_ID}/i-0fedcba9876543210/step/stdout')
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=f'{STEP_PREFIX}/metadata', Body=b'{}')
+
+    assert output_stream.poll(INSTANCE_ID) == []
+    assert not output_stream.has_output(INSTANCE_ID)